@@ -0,0 +1,25 @@
+# Generated by Django 3.0.7 on 2026-10-16 20:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_auto_20200618_2204'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRecommendation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('organization_ids', models.BinaryField()),
+                ('preference_digest', models.CharField(max_length=32, verbose_name='Preference digest')),
+                ('computed_at', models.DateTimeField(verbose_name='Computed at')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-16 21:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_userrecommendation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usermldata',
+            name='preference_vector',
+            field=models.BinaryField(default=bytes),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.7 on 2026-10-16 21:45
+
+from django.db import migrations, models
+
+
+def count_preference_vectors(apps, schema_editor):
+    """
+    Counts the existing preference vectors of the users who visited organizations as a single visit, so that their
+    next visit is averaged with them rather than replacing them.
+
+    """
+    UserMLData = apps.get_model('accounts', 'UserMLData')
+    UserVisitHistory = apps.get_model('accounts', 'UserVisitHistory')
+    UserMLData.objects.exclude(preference_vector=b'').filter(
+        models.Exists(UserVisitHistory.objects.filter(user=models.OuterRef('user')))
+    ).update(visit_count=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_auto_20261016_2119'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usermldata',
+            name='visit_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Visit count'),
+        ),
+        migrations.RunPython(count_preference_vectors, migrations.RunPython.noop),
+    ]
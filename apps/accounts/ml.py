@@ -4,26 +4,40 @@ Why a different module? To protect the code with ``pyarmour`` :D
 
 """
 
-import numpy as np
-
 from django.conf import settings
 
-import mldb.database
+import mldb.metrics
 import mldb.vectorizer
 import apps.accounts.constants as constants
-from apps.accounts.models import UserVisitHistory
+from apps.organizations.ml import get_database
 
-def update_user_preference(request, user_ml_data, visited_organization_id):
+def get_visit_weight(visit_count):
     """
-    This function updates the preference vector provided in the parameter - ``user_ml_data``.
+    This function returns the weight, in the preference vector, of the ``visit_count``-th visit of a user.
+
+    That is ``1 / visit_count`` for a mean. For a mean decayed by a factor ``d`` per visit, it is
+    ``1 / (1 + d + ... + d ** (visit_count - 1))``: the first visit still weighs 1.
 
     """
+    half_life = settings.MLDB_PREFERENCE_HALF_LIFE
+    if not half_life:
+        return 1 / visit_count
+    decay = 0.5 ** (1 / half_life)
+    return (1 - decay) / (1 - decay ** visit_count)
+
+@mldb.metrics.timed('accounts.update_user_preference')
+def update_user_preference(request, preference_vector, visited_organization_id, visit_count):
+    """
+    This function updates (in place) and returns the preference vector provided in the parameter -
+    ``preference_vector``, for the ``visit_count``-th visit of the user.
 
-    preference_vector = np.fromstring(user_ml_data.preference_vector, dtype=np.float32)
+    Past the location, the preference vector is the mean of the vectors of the visited organizations,
+    updated incrementally, so that a visit costs the same however many visits preceded it. With
+    ``settings.MLDB_PREFERENCE_HALF_LIFE``, it is an exponentially-decayed mean instead.
 
-    vector = mldb.vectorizer.Vectorizer()
-    db = mldb.database.Database(settings.MLDB_DB_PATH, vector.dimension)
-    db.open()
+    """
+
+    db = get_database().get()
 
     organization_vector = db.search_vector(visited_organization_id)
 
@@ -42,10 +56,6 @@ def update_user_preference(request, user_ml_data, visited_organization_id):
             # Ignore if the location data was not provided.
             pass
 
-    preference_vector[2: ] += organization_vector[2: ]
-
-    organization_count = UserVisitHistory.objects.filter(user=request.user).count()
-
-    preference_vector[2: ] /= organization_count
+    preference_vector[2: ] += get_visit_weight(visit_count) * (organization_vector[2: ] - preference_vector[2: ])
 
     return preference_vector
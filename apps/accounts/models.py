@@ -114,12 +114,41 @@ class UserMLData(models.Model):
     Attributes:
         user: A ``models.OneToOneField`` field repsenting the user whose
               attributes are been referred to.
-        preference_vector: A ``models.BinaryField()`` representing the preference vector of the user.
+        preference_vector: A ``models.BinaryField()`` representing the preference vector of the user, as
+                           it was before preference vectors were moved to the preference store (see
+                           ``apps.organizations.ml.get_preference_store``). It is only read by the
+                           ``migrate_preference_vectors`` management command.
+        visit_count: A ``models.PositiveIntegerField`` representing the number of visits (to organizations)
+                     of the user, which the preference vector is the (running) mean of.
 
     """
 
     user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, verbose_name=_('User'))
-    preference_vector = models.BinaryField()
+    preference_vector = models.BinaryField(default=bytes)
+    visit_count = models.PositiveIntegerField(verbose_name=_('Visit count'), default=0)
+
+
+class UserRecommendation(models.Model):
+    """
+    ``UserRecommendation`` is the model representing the recommendations (of organizations) precomputed
+    for a user by the ``precompute_recommendations`` management command.
+
+    Attributes:
+        user: A ``models.OneToOneField`` field representing the user the recommendations are for.
+        organization_ids: A ``models.BinaryField()`` representing the ids of the recommended organizations,
+                          as an array of ``int64``, in order of preference.
+        preference_digest: A ``models.CharField()`` representing the digest of the preference vector the
+                           recommendations were computed from. They are only served while it matches the
+                           digest of the current preference vector of the user.
+        computed_at: A ``models.DateTimeField()`` representing the date and time when the recommendations
+                     were computed.
+
+    """
+
+    user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, verbose_name=_('User'))
+    organization_ids = models.BinaryField()
+    preference_digest = models.CharField(max_length=32, verbose_name=_('Preference digest'))
+    computed_at = models.DateTimeField(verbose_name=_('Computed at'))
 
 
 class UserCoupon(models.Model):
@@ -0,0 +1,78 @@
+"""
+This module contains the tests of the ``accounts`` app.
+
+"""
+
+import io
+
+import numpy as np
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from apps.accounts.ml import get_visit_weight
+from apps.accounts.models import UserMLData
+from apps.organizations.ml import get_database
+from apps.organizations.ml import get_preference_vector
+from apps.organizations.ml import get_vectorizer
+from apps.organizations.ml import set_preference_vector
+from apps.organizations.tests import MLDBTestCase
+
+class VisitWeightTest(SimpleTestCase):
+    """
+    Tests of ``get_visit_weight``, through the preference vectors its weights build up visit by visit.
+
+    """
+
+    def accumulate(self, vectors):
+        preference = np.zeros_like(vectors[0])
+        for visit_count, vector in enumerate(vectors, start=1):
+            preference += get_visit_weight(visit_count) * (vector - preference)
+        return preference
+
+    @override_settings(MLDB_PREFERENCE_HALF_LIFE=None)
+    def test_visits_weigh_the_same_without_a_half_life(self):
+        vectors = np.random.RandomState(0).rand(10, 4)
+
+        self.assertEqual(get_visit_weight(1), 1)
+        np.testing.assert_allclose(self.accumulate(vectors), vectors.mean(axis=0))
+
+    @override_settings(MLDB_PREFERENCE_HALF_LIFE=3)
+    def test_visits_weigh_half_as_much_a_half_life_later(self):
+        vectors = np.random.RandomState(0).rand(10, 4)
+        weights = 0.5 ** (np.arange(9, -1, -1) / 3)
+
+        self.assertEqual(get_visit_weight(1), 1)
+        np.testing.assert_allclose(self.accumulate(vectors), weights @ vectors / weights.sum())
+
+class UserVisitHistoryAPIViewTest(MLDBTestCase):
+    """
+    Tests of recording the visits of a user, through ``UserVisitHistoryAPIView``.
+
+    """
+
+    def visit(self, user, organization):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        return client.post(f'/api/user/{user.id}/visit-history', {'organization_id': organization.id})
+
+    def test_preference_vector_is_the_mean_of_the_visits(self):
+        organizations = [self.create_organization(f'Organization number {number}') for number in range(3)]
+        call_command('rebuild_mldb', stdout=io.StringIO())
+        preference_vector = np.zeros(get_vectorizer().dimension, dtype=np.float32)
+        preference_vector[2: ] = 1
+        user = self.create_user('visitor')
+        set_preference_vector(user, preference_vector)
+
+        for organization in organizations:
+            self.assertEqual(self.visit(user, organization).status_code, 204)
+
+        user_ml_data = UserMLData.objects.get(user=user)
+        db = get_database().get()
+        organization_vectors = np.vstack([db.search_vector(organization.id) for organization in organizations])
+        self.assertEqual(user_ml_data.visit_count, 3)
+        np.testing.assert_allclose(
+            get_preference_vector(user)[2: ], organization_vectors[:, 2: ].mean(axis=0), rtol=1e-5
+        )
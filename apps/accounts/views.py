@@ -10,6 +10,8 @@ from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
 
 import numpy as np
 from rest_framework import status
@@ -33,6 +35,9 @@ from apps.accounts.serializers import UserSerializer
 from apps.accounts.serializers_nested import UserCouponSerializer
 from apps.accounts.permissions import UserAPIPermission
 from apps.accounts.ml import update_user_preference
+from apps.organizations.ml import get_preference_store
+from apps.organizations.ml import get_preference_vector
+from apps.organizations.ml import set_preference_vector
 from apps.organizations.models import Organization
 from apps.organizations.serializers import OrganizationSerializer
 from utils.helpers import generate_api_response
@@ -76,7 +81,7 @@ class SessionAPIView(APIView):
                 email=email,
             )
 
-            preference_vector = np.zeros([99], dtype=np.float32)
+            preference_vector = np.zeros([get_preference_store().dimension], dtype=np.float32)
             if 'latitude' in request.data and 'longitude' in request.data:
                 try:
                     latitude = float(request.data.get('latitude'))
@@ -89,10 +94,8 @@ class SessionAPIView(APIView):
                     # Ignore if the location data was not provided.
                     pass
 
-            UserMLData.objects.create(
-                user=user,
-                preference_vector=preference_vector.tobytes()
-            )
+            UserMLData.objects.create(user=user)
+            set_preference_vector(user, preference_vector)
 
         OTP.objects.filter(user=user, is_used=False).update(is_used=True)
 
@@ -322,19 +325,21 @@ class UserVisitHistoryAPIView(APIView):
 
         UserVisitHistory.objects.create(user=request.user, organization=visited_organization)
 
-        user_ml_data = None
-        try:
-            user_ml_data = UserMLData.objects.get(user=request.user)
-        except UserMLData.DoesNotExist:
-            user_ml_data = UserMLData.objects.create(
-                user=request.user,
-                preference_vector=np.zeros([99], dtype=np.float32).tobytes()
+        # The visit count and the preference vector are read and written under the lock of the ``UserMLData``,
+        # so that concurrent visits of the same user are applied one after the other. The preference vector is
+        # written (to the preference store) last, so that a failed visit leaves it as it was.
+        with transaction.atomic():
+            user_ml_data, _ = UserMLData.objects.select_for_update().get_or_create(user=request.user)
+            user_ml_data.visit_count = F('visit_count') + 1
+            user_ml_data.save(update_fields=['visit_count'])
+            user_ml_data.refresh_from_db(fields=['visit_count'])
+            preference_vector = get_preference_vector(request.user)
+
+            updated_preference_vector = update_user_preference(
+                request, preference_vector, visited_organization_id, user_ml_data.visit_count
             )
 
-        updated_preference_vector = update_user_preference(request, user_ml_data, visited_organization_id)
-
-        user_ml_data.preference_vector = updated_preference_vector.tobytes()
-        user_ml_data.save()
+            set_preference_vector(request.user, updated_preference_vector)
 
         return Response(
             generate_api_response(
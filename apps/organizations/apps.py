@@ -0,0 +1,21 @@
+"""
+This module provides the configuration of the ``organizations`` app.
+
+"""
+
+from django.apps import AppConfig
+
+class OrganizationsConfig(AppConfig):
+    """
+    ``OrganizationsConfig`` is the configuration of the ``organizations`` app.
+
+    """
+
+    name = 'apps.organizations'
+
+    def ready(self):
+        # Connect the signal receivers.
+        import apps.organizations.signals # pylint: disable=import-outside-toplevel,unused-import
+        # Add the sinks of the ``mldb`` metrics, if any.
+        from apps.organizations.ml import configure_metrics # pylint: disable=import-outside-toplevel
+        configure_metrics()
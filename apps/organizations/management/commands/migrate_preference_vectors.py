@@ -0,0 +1,71 @@
+"""
+This module provides the ``migrate_preference_vectors`` management command.
+
+"""
+
+import numpy as np
+
+from django.core.management.base import BaseCommand
+
+from apps.accounts.models import UserMLData
+from apps.organizations.ml import get_preference_store
+
+class Command(BaseCommand):
+    """
+    ``migrate_preference_vectors`` copies the preference vectors of the users, as they were kept in their
+    ``UserMLData`` before they were moved to the preference store (see
+    ``apps.organizations.ml.get_preference_store``), to the store. It is to be run once, when the store is
+    deployed.
+
+    The store is locked while a chunk is copied, and users who are already in it (e.g. who visited an
+    organization since the store was deployed) are left as they are. Preference vectors of another dimension
+    than the store's are skipped.
+
+    """
+
+    help = 'Copies the preference vectors of the users from the UserMLData table to the preference store.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of users read and copied at a time.'
+        )
+
+    def handle(self, *args, **options):
+        store = get_preference_store()
+        size = store.dimension * np.dtype(np.float32).itemsize
+        rows = UserMLData.objects.exclude(preference_vector=b'').order_by('user_id').values_list(
+            'user_id', 'preference_vector'
+        )
+
+        last_id, copied, skipped = 0, 0, 0
+        while True:
+            chunk = list(rows.filter(user_id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+
+            user_ids, preference_vectors = [], []
+            for user_id, preference_vector in chunk:
+                if len(preference_vector) != size:
+                    skipped += 1
+                    continue
+                user_ids.append(user_id)
+                preference_vectors.append(np.frombuffer(bytes(preference_vector), dtype=np.float32))
+            if not user_ids:
+                continue
+
+            with store.lock():
+                _, found = store.get_many(user_ids)
+                missing = np.flatnonzero(~found)
+                if len(missing):
+                    store.put_many(
+                        [user_ids[row] for row in missing], np.vstack([preference_vectors[row] for row in missing])
+                    )
+            copied += len(missing)
+
+        self.stdout.write(self.style.SUCCESS(f'Copied {copied} preference vectors to the preference store.'))
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'Skipped {skipped} preference vectors, which are not of dimension {store.dimension}.'
+            ))
@@ -0,0 +1,142 @@
+"""
+This module provides the ``precompute_recommendations`` management command.
+
+"""
+
+import concurrent.futures
+import time
+
+import numpy as np
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db import transaction
+from django.utils import timezone
+
+import mldb.database
+from apps.accounts.models import UserMLData
+from apps.accounts.models import UserRecommendation
+from apps.organizations.ml import get_database_options
+from apps.organizations.ml import get_preference_digest
+from apps.organizations.ml import get_preference_vectors
+
+# The database searched by the processes of the pool, opened once per process.
+_database = None
+
+def _open_database(db_path, vector_dim, options):
+    global _database
+    _database = mldb.database.Database(db_path, vector_dim, **options)
+    # Read-only, i.e. memory-mapped: the processes share one copy of the DB.
+    _database.open(read_only=True)
+
+def _search(preference_vectors, number_of_recommendations):
+    organization_ids, _ = _database.nearest_many(preference_vectors, number_of_recommendations)
+    return organization_ids
+
+class Command(BaseCommand):
+    """
+    ``precompute_recommendations`` computes the recommendations (of organizations) of every user with a
+    preference vector, and stores them as ``UserRecommendation``s, from which they are served.
+
+    The preference vectors are loaded into a single matrix and searched for in chunks, with batched
+    (``nearest_many``) searches spread across a pool of processes that share the (memory-mapped) DB.
+
+    """
+
+    help = 'Precomputes the recommendations of every user, from their preference vector.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--number', type=int, default=settings.MLDB_PRECOMPUTED_RECOMMENDATIONS.get('NUMBER'),
+            help='Number of recommendations computed per user.'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of users searched for, and stored, at a time.'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Number of processes searching the mldb database.'
+        )
+
+    def handle(self, *args, **options):
+        started_at = time.monotonic()
+        user_ids, preference_vectors, preference_digests = self._preference_vectors()
+        if not user_ids:
+            self.stdout.write('No preference vectors found.')
+            return
+
+        chunks = range(0, len(user_ids), options['chunk_size'])
+        arguments = (settings.MLDB_DB_PATH, preference_vectors.shape[1], get_database_options())
+
+        executor = None
+        if options['processes'] > 1:
+            # The processes do not use the (forked) connections to the database.
+            connections.close_all()
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=options['processes'], initializer=_open_database, initargs=arguments
+            )
+            results = executor.map(
+                _search,
+                [preference_vectors[start:start + options['chunk_size']] for start in chunks],
+                [options['number']] * len(chunks)
+            )
+        else:
+            _open_database(*arguments)
+            results = (
+                _search(preference_vectors[start:start + options['chunk_size']], options['number'])
+                for start in chunks
+            )
+
+        computed = 0
+        try:
+            for start, organization_ids in zip(chunks, results):
+                end = start + len(organization_ids)
+                self._store(user_ids[start:end], preference_digests[start:end], organization_ids)
+                computed += len(organization_ids)
+                elapsed = time.monotonic() - started_at
+                self.stdout.write(f'Computed the recommendations of {computed} users ({computed / elapsed:.1f} users/s).')
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        elapsed = time.monotonic() - started_at
+        self.stdout.write(self.style.SUCCESS(
+            f'Precomputed the recommendations of {computed} users in {elapsed:.1f}s '
+            f'({computed / max(elapsed, 1e-9):.1f} users/s).'
+        ))
+
+    def _preference_vectors(self):
+        """
+        This method returns the ids of the users with a preference vector, a matrix of their preference
+        vectors (one per row), read from the preference store in one go, and the digests of those.
+
+        """
+        user_ids = list(UserMLData.objects.order_by('user_id').values_list('user_id', flat=True))
+        preference_vectors, found = get_preference_vectors(user_ids)
+        user_ids = [user_id for user_id, is_found in zip(user_ids, found) if is_found]
+        if not user_ids:
+            return user_ids, None, []
+        preference_vectors = preference_vectors[found]
+        preference_digests = [get_preference_digest(preference_vector) for preference_vector in preference_vectors]
+        return user_ids, preference_vectors, preference_digests
+
+    @staticmethod
+    def _store(user_ids, preference_digests, organization_ids):
+        """
+        This method replaces the ``UserRecommendation``s of the users identified by ``user_ids``.
+
+        """
+        computed_at = timezone.now()
+        with transaction.atomic():
+            UserRecommendation.objects.filter(user_id__in=user_ids).delete()
+            UserRecommendation.objects.bulk_create([
+                UserRecommendation(
+                    user_id=user_id,
+                    organization_ids=np.asarray(ids, dtype=np.int64).tobytes(),
+                    preference_digest=preference_digest,
+                    computed_at=computed_at
+                )
+                for user_id, preference_digest, ids in zip(user_ids, preference_digests, organization_ids)
+            ])
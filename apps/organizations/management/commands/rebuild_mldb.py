@@ -0,0 +1,147 @@
+"""
+This module provides the ``rebuild_mldb`` management command.
+
+"""
+
+import json
+import os
+import shutil
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+import mldb.database
+from apps.organizations.ml import get_database_options
+from apps.organizations.ml import get_vectorizer
+from apps.organizations.models import Organization
+
+class Command(BaseCommand):
+    """
+    ``rebuild_mldb`` builds a fresh ``mldb`` database out of every organization, and atomically swaps it in
+    place of the one at ``settings.MLDB_DB_PATH``.
+
+    The organizations are read in keyset-paginated chunks and vectorized with ``nlp.pipe``. The new database
+    is built in a directory next to ``settings.MLDB_DB_PATH``, along with a checkpoint of the progress made,
+    so that an interrupted rebuild can be resumed with ``--resume``. Descriptions whose embedding is cached
+    (see ``settings.MLDB_EMBEDDING_CACHE``) are not vectorized again.
+
+    Organizations saved or deleted while the rebuild runs are logged by the live database, which is not
+    checkpointed until the rebuild is done; the changes it logged since the rebuild started are replayed
+    onto the new database right before the swap.
+
+    """
+
+    help = 'Rebuilds the mldb database (used for recommendations) from the organizations table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of organizations fetched, vectorized and inserted at a time.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=256,
+            help='Batch size used by spaCy (nlp.pipe) to vectorize the descriptions.'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Number of processes used by spaCy (nlp.pipe) to vectorize the descriptions.'
+        )
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Resume an interrupted rebuild, instead of starting from scratch.'
+        )
+
+    def handle(self, *args, **options):
+        db_path = os.path.normpath(settings.MLDB_DB_PATH)
+        name = os.path.basename(db_path)
+        build_directory = os.path.join(os.path.dirname(db_path), f'.{name}.rebuild')
+
+        vectorizer = get_vectorizer()
+
+        # Changes made to the live database while it is rebuilt are replayed onto the new one before the swap; it
+        # is not checkpointed in the meantime, so that they stay in its write-ahead log.
+        live_db = mldb.database.Database(db_path, vectorizer.dimension, **get_database_options())
+        with live_db.hold_checkpoints():
+            self._rebuild(live_db, db_path, build_directory, vectorizer, options)
+
+    def _rebuild(self, live_db, db_path, build_directory, vectorizer, options):
+        name = os.path.basename(db_path)
+        checkpoint_path = os.path.join(build_directory, 'checkpoint.json')
+
+        checkpoint = {'last_id': 0, 'count': 0, 'since': live_db.log_position()}
+        if options['resume'] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            self.stdout.write(f'Resuming after organization {checkpoint["last_id"]} ({checkpoint["count"]} indexed).')
+        elif os.path.exists(build_directory):
+            shutil.rmtree(build_directory)
+
+        # The new database is only written once, at the end; in the meantime, the
+        # write-ahead log (which survives interruptions) holds the inserted vectors.
+        database_options = get_database_options()
+        database_options.update(checkpoint_bytes=float('inf'), checkpoint_interval=float('inf'))
+        db = mldb.database.Database(os.path.join(build_directory, name), vectorizer.dimension, **database_options)
+        db.open()
+
+        started_at = time.monotonic()
+        indexed = 0
+        chunks = vectorizer.vectorize_many(
+            self._organizations(checkpoint['last_id'], options['chunk_size']),
+            chunk_size=options['chunk_size'],
+            batch_size=options['batch_size'],
+            n_process=options['processes']
+        )
+        for rows, matrix in chunks:
+            db.insert_many([row['id'] for row in rows], matrix)
+            db.commit()
+
+            indexed += len(rows)
+            checkpoint = {
+                'last_id': rows[-1]['id'], 'count': checkpoint['count'] + len(rows), 'since': checkpoint['since']
+            }
+            self._write_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.monotonic() - started_at
+            self.stdout.write(
+                f'Indexed {checkpoint["count"]} organizations ({indexed / elapsed:.1f} organizations/s).'
+            )
+
+        try:
+            db.swap_into(db_path, since=checkpoint['since'])
+        except ValueError as e:
+            # Only when resuming: the live database was checkpointed while no rebuild was running.
+            raise CommandError(f'{e}. Rebuild without --resume.') from e
+        shutil.rmtree(build_directory)
+
+        elapsed = time.monotonic() - started_at
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {db_path} with {checkpoint["count"]} organizations in {elapsed:.1f}s '
+            f'({indexed / max(elapsed, 1e-9):.1f} organizations/s).'
+        ))
+
+    @staticmethod
+    def _organizations(last_id, chunk_size):
+        """
+        This method yields the fields of the organizations (that need to be vectorized) with an id
+        greater than ``last_id``, in order of their ids, fetching ``chunk_size`` of them at a time.
+
+        """
+        while True:
+            chunk = list(
+                Organization.objects.filter(id__gt=last_id).order_by('id').values(
+                    'id', 'latitude', 'longitude', 'created_at', 'description'
+                )[:chunk_size].iterator()
+            )
+            if not chunk:
+                return
+            yield from chunk
+            last_id = chunk[-1]['id']
+
+    @staticmethod
+    def _write_checkpoint(checkpoint_path, checkpoint):
+        temporary_path = f'{checkpoint_path}.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temporary_path, checkpoint_path)
@@ -4,40 +4,334 @@ Why a different module? To protect the code with ``pyarmour`` :D
 
 """
 
+import datetime
+import hashlib
+import os
+import threading
+
 import numpy as np
 
 from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
 
+import mldb.backends
+import mldb.cache
+import mldb.changes
 import mldb.database
+import mldb.embeddings
+import mldb.filters
+import mldb.handle
+import mldb.metrics
 import mldb.vectorizer
-from apps.accounts.models import UserMLData
+import mldb.vectorstore
+from apps.accounts.models import UserRecommendation
+
+def get_database_options():
+    """
+    This function returns the keyword arguments, built from the ``MLDB_*`` settings, with which
+    ``mldb.database.Database`` is to be created.
+
+    """
+    return {
+        'checkpoint_bytes': settings.MLDB_CHECKPOINT_BYTES,
+        'checkpoint_interval': settings.MLDB_CHECKPOINT_INTERVAL,
+        'compaction_threshold': settings.MLDB_COMPACTION_THRESHOLD,
+        'index_type': settings.MLDB_INDEX.get('TYPE'),
+        'storage': settings.MLDB_INDEX.get('STORAGE'),
+        'promote_at': settings.MLDB_INDEX.get('PROMOTE_AT'),
+        'index_options': {
+            'nlist': settings.MLDB_INDEX.get('NLIST'),
+            'pq_m': settings.MLDB_INDEX.get('PQ_M'),
+            'hnsw_m': settings.MLDB_INDEX.get('HNSW_M'),
+            'nprobe': settings.MLDB_INDEX.get('NPROBE'),
+            'ef_search': settings.MLDB_INDEX.get('EF_SEARCH'),
+        },
+        'num_attributes': mldb.vectorizer.Vectorizer.NUM_NUMERIC_FIELDS,
+    }
+
+def configure_metrics():
+    """
+    This function adds the ``mldb.metrics`` sinks listed by ``settings.MLDB_METRICS``, once per process.
+
+    """
+    if mldb.metrics.enabled():
+        return
+    for sink in settings.MLDB_METRICS.get('SINKS'):
+        mldb.metrics.add_sink(import_string(sink)())
+
+def get_vectorizer():
+    """
+    This function returns a ``mldb.vectorizer.Vectorizer``, configured by ``settings.MLDB_VECTORIZER``, consulting
+    the (per-process) embedding cache configured by ``settings.MLDB_EMBEDDING_CACHE``, if any.
+
+    """
+    cache = None
+    if settings.MLDB_EMBEDDING_CACHE.get('PATH'):
+        cache = mldb.embeddings.get_embedding_cache(
+            settings.MLDB_EMBEDDING_CACHE.get('PATH'), settings.MLDB_EMBEDDING_CACHE.get('MAX_ENTRIES')
+        )
+    backend = mldb.backends.get_backend(
+        settings.MLDB_VECTORIZER.get('BACKEND'),
+        lean=settings.MLDB_VECTORIZER.get('LEAN'),
+        dimension=settings.MLDB_VECTORIZER.get('DIMENSION')
+    )
+    return mldb.vectorizer.Vectorizer(cache=cache, backend=backend)
+
+def get_database():
+    """
+    This function returns the per-process, shared handle to the DB at ``settings.MLDB_DB_PATH``.
+
+    The handle stays open across requests and reloads itself (in the background) whenever
+    another worker writes to the DB. Use ``get_database().get()`` to read from the DB; the
+    returned instance must not be modified.
+
+    """
+    return mldb.handle.get_shared_database(
+        settings.MLDB_DB_PATH, get_vectorizer().dimension,
+        check_interval=settings.MLDB_RELOAD_CHECK_INTERVAL,
+        **get_database_options()
+    )
+
+_preference_store = None
+_preference_store_lock = threading.Lock()
+
+def get_preference_store():
+    """
+    This function returns the per-process ``mldb.vectorstore.VectorStore`` of the preference vectors of the users,
+    by user id, at ``settings.MLDB_PREFERENCE_STORE_PATH``. It is the only copy of the preference vectors; use
+    :func:`get_preference_vectors` to read from it.
+
+    The store is named after the dimension of the vectorizer: once it changes, a new, empty store is started.
+
+    """
+    global _preference_store
+    with _preference_store_lock:
+        if _preference_store is None:
+            dimension = get_vectorizer().dimension
+            path = settings.MLDB_PREFERENCE_STORE_PATH
+            os.makedirs(path, exist_ok=True)
+            _preference_store = mldb.vectorstore.VectorStore(
+                path, dimension, name=f'preferences.{dimension}', fsync=True
+            )
+        return _preference_store
+
+def get_preference_vectors(user_ids):
+    """
+    This function returns the preference vectors of the users identified by ``user_ids``, as the rows of a matrix,
+    read from the preference store (see :func:`get_preference_store`) in one go, and a boolean mask of the users
+    who have one. Users without one get a zero vector.
+
+    """
+    return get_preference_store().get_many(user_ids)
+
+def get_preference_vector(user):
+    """
+    This function returns the preference vector of a user (see :func:`get_preference_vectors`), or a zero vector.
+
+    """
+    return get_preference_vectors([user.id])[0][0]
+
+def set_preference_vector(user, preference_vector):
+    """
+    This function stores the preference vector of a user in the preference store.
+
+    """
+    get_preference_store().put(user.id, np.asarray(preference_vector, dtype=np.float32))
+
+_recommendation_cache = None
+_recommendation_cache_lock = threading.Lock()
+
+def get_recommendation_cache():
+    """
+    This function returns the per-process ``mldb.cache.ResultCache`` of recommendations.
+
+    """
+    global _recommendation_cache
+    with _recommendation_cache_lock:
+        if _recommendation_cache is None:
+            _recommendation_cache = mldb.cache.ResultCache(
+                max_size=settings.MLDB_RECOMMENDATION_CACHE.get('MAX_SIZE'),
+                ttl=settings.MLDB_RECOMMENDATION_CACHE.get('TTL')
+            )
+        return _recommendation_cache
 
 def insert_semantic_vector(organization):
     """
-    This function inserts the semantic vector (of an organization) into the DB.
+    This function inserts (or updates) the semantic vector of an organization in the DB, synchronously.
+    Saved organizations are otherwise applied to the DB in the background (see :func:`get_change_queue`).
+
+    """
+    apply_organization_changes({organization.id: get_organization_fields(organization)}, [])
+
+@mldb.metrics.timed('organizations.apply_changes')
+def apply_organization_changes(upserts, deletes):
+    """
+    This function applies a batch of changes to organizations to the DB, under a single lock and commit.
+
+    Args:
+        upserts: A ``dict`` of the fields (see :func:`get_organization_fields`) of the created or updated
+                 organizations, by id. Organizations whose vector did not change are left untouched.
+        deletes: A ``list`` of the ids of the deleted organizations.
+
+    """
+    vectorizer = get_vectorizer()
+    vectors = {}
+    if upserts:
+        rows, matrix = next(vectorizer.vectorize_many(list(upserts.values()), chunk_size=len(upserts)))
+        vectors = {row['id']: vector for row, vector in zip(rows, matrix)}
+
+    db = mldb.database.Database(settings.MLDB_DB_PATH, vectorizer.dimension, **get_database_options())
+    with db.lock():
+        db.open()
+        for organization_id in deletes:
+            db.remove_by_key(organization_id)
+        changed = []
+        for organization_id, vector in vectors.items():
+            if organization_id in db:
+                if np.allclose(db.search_vector(organization_id), vector, atol=1e-6):
+                    continue
+                db.remove_by_key(organization_id)
+            changed.append(organization_id)
+        if changed:
+            db.insert_many(changed, np.vstack([vectors[organization_id] for organization_id in changed]))
+        db.commit()
+
+    # Let this worker pick up the changes right away; other workers notice them on their own.
+    get_database().reload()
+
+def get_organization_fields(organization):
+    """
+    This function returns the fields of an organization that its semantic vector is computed from.
+
+    """
+    return {
+        field: getattr(organization, field) for field in ('id', ) + mldb.vectorizer.Vectorizer.FIELDS
+    }
+
+_change_queue = None
+_change_queue_lock = threading.Lock()
+
+def get_change_queue():
+    """
+    This function returns the per-process ``mldb.changes.ChangeQueue`` through which changes to organizations
+    are applied to the DB, in batches (see :func:`apply_organization_changes`).
+
+    """
+    global _change_queue
+    with _change_queue_lock:
+        if _change_queue is None:
+            _change_queue = mldb.changes.ChangeQueue(
+                apply_organization_changes,
+                batch_size=settings.MLDB_SYNC.get('BATCH_SIZE'),
+                interval=settings.MLDB_SYNC.get('INTERVAL'),
+                max_pending=settings.MLDB_SYNC.get('MAX_PENDING')
+            )
+        return _change_queue
+
+def get_recommendation_filter(exclude_ids=None, latitude_range=None, longitude_range=None, created_at_range=None):
+    """
+    This function returns the ``mldb.filters.Filter`` restricting recommendations to organizations
+    located within the given bounding box and created within the given range, except the ones
+    identified by ``exclude_ids``. Either bound of a range may be ``None``.
+
+    Args:
+        exclude_ids: An iterable of ids of organizations not to be recommended.
+        latitude_range: A ``(min_latitude, max_latitude)`` tuple.
+        longitude_range: A ``(min_longitude, max_longitude)`` tuple.
+        created_at_range: A ``(from, to)`` tuple of ``datetime`` objects.
+
+    Returns:
+        The ``mldb.filters.Filter``, or ``None`` if there is nothing to filter on.
 
     """
-    vector = mldb.vectorizer.Vectorizer()
-    db = mldb.database.Database(settings.MLDB_DB_PATH, vector.dimension)
+    Vectorizer = mldb.vectorizer.Vectorizer
 
-    semantic_vector = vector.vectorize(
-        organization.latitude, organization.longitude, organization.created_at, organization.description
-    ).astype('float32')
+    def scaled(bounds, scale):
+        return [None if bound is None else bound / scale for bound in bounds]
 
-    db.open()
-    db.insert(organization.id, semantic_vector)
-    db.write()
+    filters = []
+    if exclude_ids:
+        filters.append(mldb.filters.Exclude(exclude_ids))
+    if latitude_range:
+        filters.append(mldb.filters.AttributeRange(Vectorizer.LATITUDE, *scaled(latitude_range, Vectorizer.MAX_LAT)))
+    if longitude_range:
+        filters.append(
+            mldb.filters.AttributeRange(Vectorizer.LONGITUDE, *scaled(longitude_range, Vectorizer.MAX_LONG))
+        )
+    if created_at_range:
+        timestamps = [None if bound is None else bound.timestamp() for bound in created_at_range]
+        filters.append(mldb.filters.AttributeRange(Vectorizer.CREATED_AT, *scaled(timestamps, Vectorizer.MAX_POSIX)))
+    return mldb.filters.All(*filters) if filters else None
 
-def get_recommendations(user, number_of_recommendations):
+def get_preference_digest(preference_vector):
+    """
+    This function returns the (hex) digest of a preference vector.
+
+    """
+    return hashlib.blake2b(bytes(preference_vector), digest_size=16).hexdigest()
+
+def get_precomputed_recommendations(user, preference_digest, number_of_recommendations):
+    """
+    This function returns the ids of the recommended organizations for a particular user, as precomputed
+    by the ``precompute_recommendations`` management command, or ``None`` if there are no (fresh enough)
+    precomputed recommendations for the preference vector with the digest - ``preference_digest``.
+
+    """
+    oldest = timezone.now() - datetime.timedelta(seconds=settings.MLDB_PRECOMPUTED_RECOMMENDATIONS.get('MAX_AGE'))
+    recommendation = UserRecommendation.objects.filter(
+        user=user, preference_digest=preference_digest, computed_at__gte=oldest
+    ).first()
+    if recommendation is None:
+        return None
+    organization_ids = np.frombuffer(recommendation.organization_ids, dtype=np.int64)
+    if len(organization_ids) < number_of_recommendations and \
+       len(organization_ids) >= settings.MLDB_PRECOMPUTED_RECOMMENDATIONS.get('NUMBER'):
+        # Fewer recommendations were computed than are asked for now (rather than all there are).
+        return None
+    return organization_ids[:number_of_recommendations].tolist()
+
+@mldb.metrics.timed('organizations.recommendations')
+def get_recommendations(user, number_of_recommendations, **filters):
     """
     This function returns the ids of the recommended organizations for a particular user.
 
+    Recommendations can be restricted with the keyword arguments of :func:`get_recommendation_filter`;
+    the filtering happens within the search, so that ``number_of_recommendations`` organizations are
+    returned whenever that many pass the filters.
+
+    Unfiltered recommendations are served from the ones precomputed by the ``precompute_recommendations``
+    management command, when there are any for the current preference vector of the user.
+
+    Otherwise, recommendations are cached (see :func:`get_recommendation_cache`) under the user, a digest of
+    their preference vector and the version of the DB, so that a visit (which updates the preference vector)
+    or a change to the DB make the next call search again. Concurrent calls for the same user search once.
+
     """
-    user_ml_data = UserMLData.objects.get(user=user)
-    preference_vector = np.fromstring(user_ml_data.preference_vector, dtype=np.float32)
+    preference_vector = get_preference_vector(user)
+    preference_digest = get_preference_digest(preference_vector)
+
+    if not filters:
+        organization_ids = get_precomputed_recommendations(user, preference_digest, number_of_recommendations)
+        if organization_ids is not None:
+            mldb.metrics.count('organizations.recommendations.precomputed')
+            return organization_ids
+
+    db = get_database().get()
+
+    key = (
+        user.id,
+        preference_digest,
+        db.version,
+        number_of_recommendations,
+        tuple(sorted((name, repr(value)) for name, value in filters.items())),
+    )
 
-    vector = mldb.vectorizer.Vectorizer()
-    db = mldb.database.Database(settings.MLDB_DB_PATH, vector.dimension)
-    db.open()
+    def search():
+        mldb.metrics.count('organizations.recommendations.searches')
+        return db.nearest(
+            preference_vector, num_closest=number_of_recommendations,
+            where=get_recommendation_filter(**filters)
+        )
 
-    return db.nearest(preference_vector, num_closest=number_of_recommendations)
+    return list(get_recommendation_cache().get(key, search))
@@ -0,0 +1,33 @@
+"""
+This module provides the signal receivers of the ``organizations`` app.
+
+"""
+
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from apps.organizations.ml import get_change_queue
+from apps.organizations.ml import get_organization_fields
+from apps.organizations.models import Organization
+
+@receiver(post_save, sender=Organization)
+def organization_saved(sender, instance, **kwargs):
+    """
+    This receiver queues the (re-)insertion of the semantic vector of a created or updated organization
+    into the DB, once the transaction that saved it commits.
+
+    """
+    fields = get_organization_fields(instance)
+    transaction.on_commit(lambda: get_change_queue().upsert(fields['id'], fields))
+
+@receiver(post_delete, sender=Organization)
+def organization_deleted(sender, instance, **kwargs):
+    """
+    This receiver queues the removal of the semantic vector of a deleted organization from the DB, once
+    the transaction that deleted it commits.
+
+    """
+    organization_id = instance.id
+    transaction.on_commit(lambda: get_change_queue().delete(organization_id))
@@ -0,0 +1,200 @@
+"""
+This module contains the tests of the ``organizations`` app.
+
+"""
+
+import io
+import shutil
+import tempfile
+
+import numpy as np
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from django.test import override_settings
+
+import mldb.database
+import apps.organizations.ml
+from apps.accounts.models import UserMLData
+from apps.accounts.models import UserRecommendation
+from apps.organizations.ml import apply_organization_changes
+from apps.organizations.ml import get_database
+from apps.organizations.ml import get_database_options
+from apps.organizations.ml import get_organization_fields
+from apps.organizations.ml import get_preference_vectors
+from apps.organizations.ml import get_recommendation_cache
+from apps.organizations.ml import get_recommendations
+from apps.organizations.ml import get_vectorizer
+from apps.organizations.ml import insert_semantic_vector
+from apps.organizations.ml import set_preference_vector
+from apps.organizations.models import Organization
+
+class MLDBTestCase(TestCase):
+    """
+    ``MLDBTestCase`` points ``settings.MLDB_DB_PATH`` and ``settings.MLDB_PREFERENCE_STORE_PATH`` to empty,
+    temporary directories, and embeds with the ``hashing`` backend, which needs no spaCy model.
+
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = f'{self.directory}/mldb'
+        overrides = override_settings(
+            MLDB_DB_PATH=self.db_path,
+            MLDB_PREFERENCE_STORE_PATH=f'{self.directory}/preferences',
+            MLDB_EMBEDDING_CACHE={'PATH': None, 'MAX_ENTRIES': 0},
+            MLDB_VECTORIZER={'BACKEND': 'hashing', 'LEAN': True, 'DIMENSION': 16},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.reset_preference_store()
+        self.addCleanup(self.reset_preference_store)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.owner = get_user_model().objects.create(username='owner', email='owner@example.com')
+
+    @staticmethod
+    def reset_preference_store():
+        apps.organizations.ml._preference_store = None
+
+    def create_user(self, username, preference_vector=None):
+        user = get_user_model().objects.create(username=username, email=f'{username}@example.com')
+        UserMLData.objects.create(
+            user=user, preference_vector=b'' if preference_vector is None else preference_vector.tobytes()
+        )
+        return user
+
+    def create_organization(self, description):
+        return Organization.objects.create(
+            name=description, description=description, owner=self.owner, email='organization@example.com',
+            amount_to_be_raised=100, address='Address', latitude=12.0, longitude=77.0
+        )
+
+    def open_database(self, read_only=False):
+        db = mldb.database.Database(self.db_path, get_vectorizer().dimension, **get_database_options())
+        db.open(read_only=read_only)
+        return db
+
+
+class RebuildMLDBTest(MLDBTestCase):
+    """
+    Tests of the ``rebuild_mldb`` management command.
+
+    """
+
+    def test_rebuild_indexes_every_organization(self):
+        organizations = [self.create_organization(f'Organization number {number}') for number in range(5)]
+
+        call_command('rebuild_mldb', chunk_size=2, stdout=io.StringIO())
+
+        db = self.open_database(read_only=True)
+        self.assertEqual(sorted(db._keys.live_keys.tolist()), [organization.id for organization in organizations])
+        _, matrix = next(get_vectorizer().vectorize_many([organizations[3]]))
+        np.testing.assert_allclose(db.search_vector(organizations[3].id), matrix[0], rtol=1e-6)
+
+
+class ApplyOrganizationChangesTest(MLDBTestCase):
+    """
+    Tests of ``apply_organization_changes``.
+
+    """
+
+    def test_updated_organization_stays_visible_to_read_only_handles(self):
+        organizations = [self.create_organization(f'Organization number {number}') for number in range(5)]
+        call_command('rebuild_mldb', stdout=io.StringIO())
+        organization = organizations[2]
+        organization.description = 'An entirely different description'
+        fields = get_organization_fields(organization)
+
+        apply_organization_changes({organization.id: fields}, [])
+
+        db = self.open_database(read_only=True)
+        self.assertIsNotNone(db._delta)
+        _, matrix = next(get_vectorizer().vectorize_many([fields]))
+        self.assertIn(organization.id, db)
+        np.testing.assert_allclose(db.search_vector(organization.id), matrix[0], rtol=1e-6)
+        self.assertEqual(db.nearest(matrix[0]), [organization.id])
+        self.assertEqual(len(db.nearest(matrix[0], 5)), 5)
+
+
+class PreferenceVectorTest(MLDBTestCase):
+    """
+    Tests of the preference vectors of the users, and of their store.
+
+    """
+
+    def test_store_is_the_only_copy(self):
+        user = self.create_user('visitor')
+        preference_vector = np.arange(get_vectorizer().dimension, dtype=np.float32)
+
+        set_preference_vector(user, preference_vector)
+
+        preference_vectors, found = get_preference_vectors([user.id])
+        self.assertEqual(found.tolist(), [True])
+        np.testing.assert_array_equal(preference_vectors[0], preference_vector)
+        self.assertEqual(bytes(UserMLData.objects.get(user=user).preference_vector), b'')
+
+    def test_migrate_preference_vectors(self):
+        dimension = get_vectorizer().dimension
+        users = [
+            self.create_user('migrated', np.ones(dimension, dtype=np.float32)),
+            self.create_user('outdated', np.ones(8, dtype=np.float32)),
+            self.create_user('new'),
+            self.create_user('visitor', np.ones(dimension, dtype=np.float32)),
+        ]
+        # Visited an organization since the store was deployed.
+        set_preference_vector(users[3], np.full(dimension, 2, dtype=np.float32))
+
+        call_command('migrate_preference_vectors', chunk_size=2, stdout=io.StringIO())
+
+        preference_vectors, found = get_preference_vectors([user.id for user in users])
+        self.assertEqual(found.tolist(), [True, False, False, True])
+        np.testing.assert_array_equal(preference_vectors[0], np.ones(dimension))
+        np.testing.assert_array_equal(preference_vectors[1], np.zeros(dimension))
+        np.testing.assert_array_equal(preference_vectors[3], np.full(dimension, 2))
+
+    def test_precompute_skips_users_without_a_preference_vector(self):
+        for number in range(5):
+            self.create_organization(f'Organization number {number}')
+        call_command('rebuild_mldb', stdout=io.StringIO())
+        user = self.create_user('visitor')
+        set_preference_vector(user, np.ones(get_vectorizer().dimension, dtype=np.float32))
+        self.create_user('new')
+
+        call_command('precompute_recommendations', number=3, stdout=io.StringIO())
+
+        self.assertEqual(list(UserRecommendation.objects.values_list('user_id', flat=True)), [user.id])
+
+
+class RecommendationCacheTest(MLDBTestCase):
+    """
+    Tests of the caching of recommendations by ``get_recommendations``.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+        apps.organizations.ml._recommendation_cache = None
+        self.addCleanup(setattr, apps.organizations.ml, '_recommendation_cache', None)
+        for number in range(5):
+            self.create_organization(f'Organization number {number}')
+        call_command('rebuild_mldb', stdout=io.StringIO())
+        get_database().reload(wait=True)
+        self.user = self.create_user('visitor')
+        set_preference_vector(self.user, np.ones(get_vectorizer().dimension, dtype=np.float32))
+
+    def test_recommendations_are_searched_again_once_the_preference_vector_changes(self):
+        recommendations = get_recommendations(self.user, 3)
+        self.assertEqual(get_recommendations(self.user, 3), recommendations)
+        self.assertEqual((get_recommendation_cache().hits, get_recommendation_cache().misses), (1, 1))
+
+        set_preference_vector(self.user, np.zeros(get_vectorizer().dimension, dtype=np.float32))
+        get_recommendations(self.user, 3)
+        self.assertEqual(get_recommendation_cache().misses, 2)
+
+    def test_recommendations_are_searched_again_once_the_database_changes(self):
+        get_recommendations(self.user, 3)
+        insert_semantic_vector(self.create_organization('Another organization'))
+        get_database().reload(wait=True)
+        get_recommendations(self.user, 3)
+        self.assertEqual(get_recommendation_cache().misses, 2)
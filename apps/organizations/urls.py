@@ -14,6 +14,7 @@ from apps.organizations.views import ReviewAPIView
 from apps.organizations.views import ReviewDetailAPIView
 from apps.organizations.views import CouponAPIView
 from apps.organizations.views import CouponDetailAPIView
+from apps.organizations.views import MLDBMetricsAPIView
 
 urlpatterns = [
     path('organization', OrganizationAPIView.as_view(), name='organization'),
@@ -29,5 +30,6 @@ urlpatterns = [
         'organization/<int:organization_id>/coupon/<int:coupon_id>',
         CouponDetailAPIView.as_view(),
         name='coupon_detail'
-    )
+    ),
+    path('mldb/metrics', MLDBMetricsAPIView.as_view(), name='mldb_metrics')
 ]
@@ -9,9 +9,12 @@ from django.db.models import Sum
 
 from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.generics import ListCreateAPIView
 from rest_framework.generics import RetrieveUpdateDestroyAPIView
+from rest_framework.permissions import IsAdminUser
 
+import mldb.metrics
 from apps.organizations.models import Organization
 from apps.organizations.models import Review
 from apps.organizations.models import Coupon
@@ -21,7 +24,6 @@ from apps.organizations.serializers import CouponSerializer
 from apps.organizations.permissions import OrganizationAPIPermission
 from apps.organizations.permissions import ReviewAPIPermission
 from apps.organizations.permissions import CouponAPIPermission
-from apps.organizations.ml import insert_semantic_vector
 from apps.organizations.ml import get_recommendations
 from apps.payments.models import Payment
 from utils.helpers import generate_api_response
@@ -48,10 +50,9 @@ class OrganizationAPIView(ListCreateAPIView):
                 user=request.user,
                 number_of_recommendations=100
             )
-            serializer = OrganizationSerializer(
-                Organization.objects.filter(id__in=recommended_organization_ids),
-                many=True
-            )
+            with mldb.metrics.timer('organizations.recommendations.query'):
+                recommended_organizations = list(Organization.objects.filter(id__in=recommended_organization_ids))
+            serializer = OrganizationSerializer(recommended_organizations, many=True)
             response = Response(serializer.data, status=status.HTTP_200_OK)
         else:
             response = super().get(request, *args, **kwargs)
@@ -70,11 +71,9 @@ class OrganizationAPIView(ListCreateAPIView):
         Create an organization.
 
         """
+        # The semantic vector of the organization is inserted into the DB in the background
+        # (see ``apps.organizations.signals``).
         response = super().post(request, *args, **kwargs)
-        organization = Organization.objects.get(id=response.data.get('id'))
-
-        insert_semantic_vector(organization)
-
         return Response(
             generate_api_response(
                 status=settings.API_RESPONSE_STATUS.get('SUCCESS'),
@@ -432,3 +431,29 @@ class CouponDetailAPIView(RetrieveUpdateDestroyAPIView):
             ),
             status=response.status_code
         )
+
+class MLDBMetricsAPIView(APIView):
+    """
+    ``MLDBMetricsAPIView`` provides the ``mldb`` metrics recorded by this process (see ``settings.MLDB_METRICS``).
+
+    """
+
+    permission_classes = (IsAdminUser, )
+
+    def get(self, request, *args, **kwargs):
+        """
+        Return the timers and counters kept by the ``mldb.metrics.HistogramSink``s of this process.
+
+        """
+        return Response(
+            generate_api_response(
+                status=settings.API_RESPONSE_STATUS.get('SUCCESS'),
+                data={
+                    'metrics': [
+                        sink.snapshot() for sink in mldb.metrics.get_sinks()
+                        if isinstance(sink, mldb.metrics.HistogramSink)
+                    ]
+                }
+            ),
+            status=status.HTTP_200_OK
+        )
@@ -10,8 +10,15 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fables.settings.development')
 
 application = get_asgi_application()
+
+# Load the models used for recommendations while the worker boots, instead of
+# on the first request it serves.
+if settings.MLDB_WARM_UP:
+    from apps.organizations.ml import get_vectorizer # pylint: disable=wrong-import-position
+    get_vectorizer()
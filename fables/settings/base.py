@@ -199,6 +199,9 @@ LOGGING = {
         'django': {
             'handlers': ['development_logfile', 'production_logfile'],
         },
+        'mldb': {
+            'handlers': ['development_logfile', 'production_logfile'],
+        },
         'py.warnings': {
             'handlers': ['development_logfile'],
         },
@@ -252,3 +255,125 @@ specified at https://github.com/omniti-labs/jsend.
 """
 
 MLDB_DB_PATH = os.path.join(BASE_DIR, 'logs')
+
+# Should the models used by ``mldb`` be loaded when a worker starts (see ``fables.wsgi`` and
+# ``fables.asgi``)? If not, they are loaded lazily, on the first request that needs them.
+
+MLDB_WARM_UP = config('MLDB_WARM_UP', default=True, cast=bool)
+
+# Options of the ``mldb.vectorizer.Vectorizer`` of organizations. BACKEND embeds the descriptions (see
+# ``mldb.backends``): ``spacy`` uses the ``en_core_web_sm`` model, ``hashing`` a feature hashing embedder of
+# DIMENSION components, which needs no model and starts instantly (for small deployments, CI and tests), but only
+# relates descriptions sharing words. The ``mldb`` database must be rebuilt (see ``rebuild_mldb``) after switching
+# backends. With LEAN, the spaCy model is loaded without the components (parser, NER, ...) that do not contribute to
+# the vectors, which loads and vectorizes faster and takes less memory; the vectors are the same.
+
+MLDB_VECTORIZER = {
+    'BACKEND': config('MLDB_VECTORIZER_BACKEND', default='spacy'),
+    'LEAN': True,
+    'DIMENSION': 96,
+}
+
+# Minimum number of seconds between two checks (by a worker) for changes made to the ``mldb``
+# database by other workers. See ``apps.organizations.ml.get_database``.
+
+MLDB_RELOAD_CHECK_INTERVAL = 1.0
+
+# Changes to the ``mldb`` database are appended to a write-ahead log, which is folded into a new
+# snapshot of the database once it grows beyond MLDB_CHECKPOINT_BYTES bytes, or once the last
+# snapshot is older than MLDB_CHECKPOINT_INTERVAL seconds.
+
+MLDB_CHECKPOINT_BYTES = 4 * 1024 * 1024
+
+MLDB_CHECKPOINT_INTERVAL = 60 * 60
+
+# Organizations removed from the ``mldb`` database are only marked as removed (and skipped by
+# searches) until more than this fraction of its rows is removed; they are then dropped from it.
+
+MLDB_COMPACTION_THRESHOLD = 0.2
+
+# The index used by ``mldb`` to search for similar organizations. The database starts with an exact
+# (flat) index, and is rebuilt as an index of TYPE ('flat', 'ivf_flat', 'ivf_pq' or 'hnsw') once it
+# holds PROMOTE_AT organizations. NLIST (IVF) and PQ_M (PQ) are chosen from the data when ``None``.
+# NPROBE (IVF) and EF_SEARCH (HNSW) trade the speed of searches for their accuracy. STORAGE ('float32',
+# 'fp16' or 'sq8') quantizes the vectors of the promoted index, to a half or a quarter of their memory,
+# at the cost of some recall (see ``python -m mldb.benchmark storage``). See ``mldb.indexes``.
+# The workers memory-map the index, which faiss releases before 1.8 can only do for 'flat' indexes of
+# 'float32' vectors and for IVF ones: every worker reads its own copy of 'hnsw' or quantized 'flat' indexes.
+
+MLDB_INDEX = {
+    'TYPE': 'flat',
+    'STORAGE': 'float32',
+    'PROMOTE_AT': 100000,
+    'NLIST': None,
+    'PQ_M': None,
+    'HNSW_M': 32,
+    'NPROBE': 16,
+    'EF_SEARCH': 64,
+}
+
+# Recommendations are cached, per worker, for up to TTL seconds and for at most MAX_SIZE users (the least
+# recently served ones are evicted first). Cached recommendations are keyed on the preference vector of the
+# user and on the version of the ``mldb`` database, so they are never stale. See ``mldb.cache``.
+
+MLDB_RECOMMENDATION_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 5 * 60,
+}
+
+# The ``precompute_recommendations`` management command stores NUMBER recommendations for every user, which
+# are served (instead of searching the ``mldb`` database) until the preference vector of the user changes, or
+# for at most MAX_AGE seconds.
+
+MLDB_PRECOMPUTED_RECOMMENDATIONS = {
+    'NUMBER': 100,
+    'MAX_AGE': 24 * 60 * 60,
+}
+
+# The embeddings of the descriptions of organizations are cached (on disk, in a SQLite database at PATH) so that
+# rebuilding the ``mldb`` database, or re-saving an organization, only runs the spaCy model on the descriptions
+# that changed. At most MAX_ENTRIES embeddings (~450 bytes each) are kept. Set PATH to ``None`` to disable it.
+# It is kept in a directory of its own, ``cache``, not among the logs.
+
+MLDB_EMBEDDING_CACHE = {
+    'PATH': config('MLDB_EMBEDDING_CACHE_PATH', default=os.path.join(BASE_DIR, 'cache', 'embeddings.sqlite3')),
+    'MAX_ENTRIES': 1000000,
+}
+
+# The preference vectors of the users are stored (by user id) in a single float32 matrix file and a file of the user
+# ids, ``preferences.<dimension>.vectors`` and ``preferences.<dimension>.keys`` in the folder
+# MLDB_PREFERENCE_STORE_PATH, so that they are read in batches and shared (memory-mapped) by the workers. It is their
+# only copy: writes are fsynced, and every host must see the same folder (as for MLDB_DB_PATH). The vectors
+# ``UserMLData`` used to hold are copied to it, once, by the ``migrate_preference_vectors`` management command.
+# See ``mldb.vectorstore``.
+
+MLDB_PREFERENCE_STORE_PATH = config('MLDB_PREFERENCE_STORE_PATH', default=os.path.join(BASE_DIR, 'preferences'))
+
+# The preference vector of a user is the mean of the vectors of the organizations they visited, updated with every
+# visit. With a half-life (a number of visits), it is an exponentially-decayed mean instead, in which a visit weighs
+# half as much as the one MLDB_PREFERENCE_HALF_LIFE visits after it. ``None`` weighs every visit the same.
+
+MLDB_PREFERENCE_HALF_LIFE = None
+
+# Created, updated and deleted organizations are applied to the ``mldb`` database in the background, in batches
+# of at most BATCH_SIZE changes, after waiting INTERVAL seconds for further changes to the same organizations
+# (only the latest change to an organization is applied). At most MAX_PENDING changes are queued per process:
+# once as many are, saving an organization blocks until the queue catches up. The lag from saving an organization
+# to its vector being in the DB is logged (by the ``mldb.changes`` logger) with every applied batch. The changes
+# still queued when a worker exits are applied before it does; those of a killed worker are lost until
+# ``python manage.py rebuild_mldb`` runs. See ``mldb.changes``.
+
+MLDB_SYNC = {
+    'BATCH_SIZE': 256,
+    'INTERVAL': 1.0,
+    'MAX_PENDING': 10000,
+}
+
+# Timers and counters of the ``mldb`` operations (model load, open, search, reconstruct, write, vectorize, ...) and
+# of the recommendations are recorded by the SINKS listed here, as dotted paths of ``mldb.metrics.Sink`` classes:
+# e.g. ``mldb.metrics.LogSink`` logs them, ``mldb.metrics.HistogramSink`` keeps histograms of them, served to
+# admins at ``/api/mldb/metrics``. Nothing is recorded without sinks. See ``mldb.metrics``.
+
+MLDB_METRICS = {
+    'SINKS': [],
+}
@@ -0,0 +1,138 @@
+"""
+  Backends Module: Text embedders the `Vectorizer` embeds descriptions
+  with.
+  Classes:
+    - Backend
+    - SpacyBackend
+    - HashingBackend
+  Functions:
+    - get_backend
+"""
+import functools
+import re
+import zlib
+
+import numpy as np
+
+class Backend:
+  """
+    Embeds texts into `np.float32` vectors of `dimension` components.
+    The vectors need not be normalized, the `Vectorizer` does it.
+    Properties:
+      name (str): Name of the embedding model
+      version (str): Version of the embedding model. Embeddings are
+                     cached by name and version, so the version must
+                     change whenever the embeddings do
+      dimension (int): Size of the embeddings
+  """
+  name = None
+  version = None
+  dimension = None
+
+  def embed(self, text):
+    """
+      Returns the embedding of a text.
+    """
+    raise NotImplementedError
+
+  def embed_many(self, texts, batch_size=256, n_process=1):
+    """
+      Embeds a stream of texts.
+      Args:
+        texts (iterable): The texts, consumed lazily
+        batch_size (int): Number of texts embedded at a time
+        n_process (int): Number of processes embedding the texts
+      Yields:
+        The embedding of every text, in input order
+    """
+    for text in texts:
+      yield self.embed(text)
+
+class SpacyBackend(Backend):
+  """
+    Embeds texts as the `doc.vector` of a spaCy model.
+  """
+  def __init__(self, model_name="en_core_web_sm", lean=False, **_):
+    """
+      Args:
+        model_name (str): Name of the spaCy model, shared through
+                          `mldb.registry`
+        lean (bool): See `mldb.registry.ModelRegistry`
+    """
+    # spaCy is only imported by the deployments using it.
+    import mldb.registry # pylint: disable=import-outside-toplevel
+    self._model = mldb.registry.get_model(model_name, lean)
+    self._unneeded_components = [name for name in self._model.pipe_names
+                                 if name not in mldb.registry.VECTOR_COMPONENTS]
+    self.name = model_name
+    self.version = self._model.meta.get("version", "")
+    self.dimension = mldb.registry.get_dimension(model_name, lean)
+
+  @property
+  def pipe_names(self):
+    return self._model.pipe_names
+
+  def _vector(self, doc):
+    # The vector of a doc without tokens is empty.
+    if not len(doc):
+      return np.zeros(self.dimension, dtype=np.float32)
+    return doc.vector
+
+  def embed(self, text):
+    return self._vector(self._model(text))
+
+  def embed_many(self, texts, batch_size=256, n_process=1):
+    # The components that do not contribute to `doc.vector` are not run.
+    docs = self._model.pipe(texts, batch_size=batch_size, n_process=n_process,
+                            disable=self._unneeded_components)
+    for doc in docs:
+      yield self._vector(doc)
+
+class HashingBackend(Backend):
+  """
+    Embeds texts by feature hashing: every word and pair of adjacent
+    words of a text is hashed to a component of the embedding, which
+    it adds +1 or -1 to. It needs no model, so it starts instantly, but
+    only texts sharing words are similar.
+  """
+  VERSION = "1"
+  WORD = re.compile(r"\w+")
+
+  def __init__(self, dimension=96, **_):
+    """
+      Args:
+        dimension (int): Size of the embeddings
+    """
+    self.name = "hashing"
+    self.version = "%s-%d" % (HashingBackend.VERSION, dimension)
+    self.dimension = dimension
+
+  @staticmethod
+  @functools.lru_cache(maxsize=65536)
+  def _hash(feature):
+    # Stable across processes, unlike `hash`.
+    return zlib.crc32(feature.encode("utf-8"))
+
+  def embed(self, text):
+    words = HashingBackend.WORD.findall(text.lower())
+    features = words + [" ".join(pair) for pair in zip(words, words[1:])]
+    hashes = np.fromiter((HashingBackend._hash(feature) for feature in features),
+                         dtype=np.uint32, count=len(features))
+    signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+    vector = np.zeros(self.dimension, dtype=np.float32)
+    np.add.at(vector, hashes % self.dimension, signs)
+    return vector
+
+BACKENDS = {
+    "spacy": SpacyBackend,
+    "hashing": HashingBackend,
+}
+
+def get_backend(name, **options):
+  """
+    Creates the backend called `name` (one of `BACKENDS`), with the
+    options it takes among `options`.
+  """
+  if name not in BACKENDS:
+    raise ValueError("Unknown vectorizer backend: %s" % name)
+  return BACKENDS[name](**options)
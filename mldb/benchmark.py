@@ -0,0 +1,359 @@
+"""
+  Benchmark Module: Measures the cost of `Database` operations.
+  Usage:
+    $ python -m mldb.benchmark keys [--sizes 1000 10000 100000 1000000] [--dim 8]
+    $ python -m mldb.benchmark storage [--sizes 100000] [--dim 99] [--index-type flat]
+    $ python -m mldb.benchmark suite [--sizes 1000 10000 100000 1000000] [--dim 99]
+                                     [--index-types flat ivf_flat ivf_pq hnsw]
+                                     [--ks 1 10 100] [--output results.json]
+    $ python -m mldb.benchmark vectorizer [--model en_core_web_sm] [--docs 2000]
+  Functions:
+    - bench_database
+    - bench_keys
+    - bench_storage
+    - bench_vectorizer
+    - run_suite
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+import mldb.indexes as indexes
+from mldb.database import Database
+from mldb.vectorizer import Vectorizer
+
+def _per_op(function, arguments):
+  start = time.perf_counter()
+  for argument in arguments:
+    function(*argument)
+  return (time.perf_counter() - start) / max(len(arguments), 1)
+
+def bench_keys(size, dim=8, probes=1000):
+  """
+    Fills a database with `size` rows and measures the mean time of
+    `insert`, `search_vector` and `remove_by_key` once it is full.
+    Returns:
+      A dict of seconds per operation
+  """
+  rng = np.random.default_rng(0)
+  vectors = rng.random((size + probes, dim), dtype=np.float32)
+  with tempfile.TemporaryDirectory() as path:
+    db = Database(path, dim)
+    db.open()
+    start = time.perf_counter()
+    for key in range(size):
+      db.insert(key, vectors[key])
+    fill = time.perf_counter() - start
+
+    extra = range(size, size + probes)
+    keys = rng.integers(0, size, probes).tolist()
+    return {
+        "size": size,
+        "fill": fill,
+        "insert": _per_op(db.insert, [(key, vectors[key]) for key in extra]),
+        "search_vector": _per_op(db.search_vector, [(key,) for key in keys]),
+        "remove_by_key": _per_op(db.remove_by_key, [(key,) for key in extra]),
+    }
+
+def _clustered(rng, size, dim, clusters=256):
+  # Embeddings are clustered by topic, unlike uniform noise.
+  centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+  vectors = centers[rng.integers(0, clusters, size)]
+  return vectors + rng.normal(scale=0.3, size=(size, dim)).astype(np.float32)
+
+def _snapshot_bytes(db):
+  return sum(os.path.getsize(path) for path in db.snapshot_files.values())
+
+def bench_storage(size, dim=99, index_type=indexes.FLAT, queries=1000, k=10):
+  """
+    Builds a database of `size` clustered vectors with every storage
+    type, and measures the size of its snapshot against the recall@k of
+    its searches (relative to exact float32 ones).
+    Returns:
+      A list of dicts, one per storage type
+  """
+  rng = np.random.default_rng(0)
+  vectors = _clustered(rng, size + queries, dim)
+  keys = np.arange(size, dtype=np.int64)
+  probes = vectors[size:]
+  expected = None
+  results = []
+  # float32 comes first, its searches are the exact ones.
+  for storage in indexes.STORAGE_TYPES:
+    with tempfile.TemporaryDirectory() as path:
+      db = Database(path, dim, index_type=index_type, storage=storage, promote_at=0,
+                    index_options={"nprobe": 16, "ef_search": 64})
+      db.open()
+      db.insert_many(keys, vectors[:size])
+      db.write()
+      start = time.perf_counter()
+      found, _ = db.nearest_many(probes, k)
+      search = (time.perf_counter() - start) / queries
+      if expected is None:
+        # Exact neighbours, from a float32 flat index.
+        exact = Database(os.path.join(path, "exact"), dim)
+        exact.open()
+        exact.insert_many(keys, vectors[:size])
+        expected, _ = exact.nearest_many(probes, k)
+      recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, expected)])
+      sample = keys[rng.integers(0, size, min(size, 1000))]
+      error = np.mean([np.abs(db.search_vector(key) - vectors[key]).max() for key in sample.tolist()])
+      results.append({
+          "size": size,
+          "index_type": db.index_type,
+          "storage": db.storage,
+          "snapshot_bytes": _snapshot_bytes(db),
+          "recall@%d" % k: float(recall),
+          "search": search,
+          "reconstruction_error": float(error),
+      })
+  return results
+
+def _rss_bytes():
+  # Current (not peak) resident memory of the process.
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except OSError:
+    return None
+
+def _peak_rss_bytes():
+  # Kilobytes on Linux, bytes on macOS.
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if platform.system() == "Darwin" else peak * 1024
+
+def _latencies(function, arguments):
+  latencies = np.empty(len(arguments))
+  for i, argument in enumerate(arguments):
+    start = time.perf_counter()
+    function(*argument)
+    latencies[i] = time.perf_counter() - start
+  return {"p50": float(np.percentile(latencies, 50)), "p99": float(np.percentile(latencies, 99))}
+
+def _open(db_path, dim, options, read_only):
+  # Run in a fresh process, so that the memory of the database is the
+  # only memory it gains.
+  rss = _rss_bytes()
+  start = time.perf_counter()
+  db = Database(db_path, dim, **options)
+  db.open(read_only=read_only)
+  seconds = time.perf_counter() - start
+  return seconds, _rss_bytes() - rss if rss is not None else None
+
+def bench_database(size, dim=99, index_type=indexes.FLAT, ks=(1, 10, 100),
+                   batch_size=1000, singles=1000, queries=1000):
+  """
+    Measures every operation of a database of `size` clustered vectors.
+    The database is filled with batched inserts (`insert_many`) and
+    written, which builds the index as `index_type`, then `singles`
+    vectors are inserted one at a time and written again. It is then
+    opened from disk, read-write and read-only (each in a fresh process,
+    to measure the memory it takes), and searched with
+    `queries` single-vector `nearest` searches per k in `ks` and with
+    one batched search per k. Finally `singles` keys are removed.
+    Returns:
+      A dict of throughputs (rows per second), durations and latency
+      percentiles (seconds), and memory (bytes)
+  """
+  rng = np.random.default_rng(0)
+  vectors = _clustered(rng, size + singles + queries, dim)
+  keys = np.arange(size + singles, dtype=np.int64)
+  probes = vectors[size + singles:]
+  # Checkpoints are only made by the explicit writes.
+  options = dict(index_type=index_type, promote_at=1, checkpoint_bytes=float("inf"),
+                 checkpoint_interval=float("inf"), index_options={"nprobe": 16, "ef_search": 64})
+  result = {"size": size, "dim": dim, "index_type": index_type}
+  context = multiprocessing.get_context("spawn")
+  with tempfile.TemporaryDirectory() as path:
+    db = Database(path, dim, **options)
+    db.open()
+    db.write()
+    start = time.perf_counter()
+    for offset in range(0, size, batch_size):
+      db.insert_many(keys[offset:offset + batch_size], vectors[offset:offset + batch_size])
+    db.commit()
+    result["insert_many_rows_per_s"] = size / (time.perf_counter() - start)
+    start = time.perf_counter()
+    db.write()
+    # The first write builds (and trains) the index.
+    result["write"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in range(size, size + singles):
+      db.insert(key, vectors[key])
+    db.commit()
+    result["insert_rows_per_s"] = singles / (time.perf_counter() - start)
+    start = time.perf_counter()
+    db.write()
+    result["checkpoint"] = time.perf_counter() - start
+    result["snapshot_bytes"] = _snapshot_bytes(db)
+    del db
+
+    for read_only, suffix in ((False, ""), (True, "_read_only")):
+      with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        seconds, rss = executor.submit(_open, path, dim, options, read_only).result()
+      result["open" + suffix] = seconds
+      result["rss" + suffix + "_bytes"] = rss
+
+    db = Database(path, dim, **options)
+    db.open()
+
+    for k in ks:
+      result["nearest@%d" % k] = _latencies(db.nearest, [(probe, k) for probe in probes])
+      start = time.perf_counter()
+      db.nearest_many(probes, k)
+      result["nearest_many@%d_queries_per_s" % k] = queries / (time.perf_counter() - start)
+
+    removed = rng.choice(len(keys), singles, replace=False).tolist()
+    result["remove_by_key"] = _per_op(db.remove_by_key, [(key,) for key in removed])
+    start = time.perf_counter()
+    db.compact()
+    result["compact"] = time.perf_counter() - start
+  result["peak_rss_bytes"] = _peak_rss_bytes()
+  return result
+
+def _environment():
+  try:
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {
+      "commit": commit,
+      "python": platform.python_version(),
+      "numpy": np.__version__,
+      "faiss": faiss.__version__,
+      "machine": platform.machine(),
+      "cpus": os.cpu_count(),
+  }
+
+def run_suite(sizes, index_types, dim=99, ks=(1, 10, 100), output=None):
+  """
+    Runs `bench_database` for every size and index type, each in a
+    fresh process so that its memory is measured on its own. Results
+    are printed as they come, one JSON object per line. A configuration
+    that fails is recorded with its `error`, and the suite goes on.
+    Args:
+      output (str): Path of a JSON file to also write the results to,
+                    with the environment they were measured in (commit,
+                    versions), for comparison between commits
+    Returns:
+      The list of results
+  """
+  results = []
+  context = multiprocessing.get_context("spawn")
+  for size in sizes:
+    for index_type in index_types:
+      try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+          result = executor.submit(bench_database, size, dim, index_type, tuple(ks)).result()
+      except Exception as e:
+        result = {"size": size, "dim": dim, "index_type": index_type, "error": repr(e)}
+      print(json.dumps(result), flush=True)
+      results.append(result)
+  if output is not None:
+    with open(output, "w") as f:
+      json.dump({"environment": _environment(), "results": results}, f, indent=2)
+  return results
+
+_WORDS = ("school", "children", "water", "clean", "village", "health", "food", "shelter", "animals",
+          "rescue", "education", "women", "support", "community", "books", "library", "trees", "river",
+          "medical", "care", "elderly", "disaster", "relief", "art", "music", "sports", "youth", "local")
+
+def _descriptions(rng, size):
+  lengths = rng.integers(5, 60, size)
+  return [" ".join(rng.choice(_WORDS, length)).capitalize() + "." for length in lengths]
+
+def _vectorize(model_name, lean, descriptions, singles):
+  # Run in a fresh process, so that the model is loaded cold.
+  rss = _rss_bytes()
+  start = time.perf_counter()
+  vectorizer = Vectorizer(model_name, lean=lean)
+  load = time.perf_counter() - start
+  rss = _rss_bytes() - rss if rss is not None else None
+  created_at = datetime.datetime(2020, 6, 1)
+  latencies = _latencies(vectorizer.vectorize, [(0.0, 0.0, created_at, text) for text in descriptions[:singles]])
+  rows = [(0.0, 0.0, created_at, text) for text in descriptions]
+  start = time.perf_counter()
+  matrix = np.vstack([chunk for _, chunk in vectorizer.vectorize_many(rows)])
+  many = len(rows) / (time.perf_counter() - start)
+  return {
+      "lean": lean,
+      "pipeline": list(vectorizer.backend.pipe_names),
+      "load": load,
+      "rss_bytes": rss,
+      "vectorize": latencies,
+      "vectorize_many_docs_per_s": many,
+  }, matrix
+
+def bench_vectorizer(model_name="en_core_web_sm", docs=2000, singles=200):
+  """
+    Measures the full and the lean vectorizer (see `mldb.registry`):
+    the time and memory it takes to load the model (in a fresh
+    process), the `vectorize` latency of `singles` descriptions and the
+    `vectorize_many` throughput of `docs` of them, and how much the
+    vectors of the lean one differ from the full one's.
+    Returns:
+      A list of dicts, one per mode
+  """
+  descriptions = _descriptions(np.random.default_rng(0), docs)
+  context = multiprocessing.get_context("spawn")
+  results, expected = [], None
+  for lean in (False, True):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+      result, matrix = executor.submit(_vectorize, model_name, lean, descriptions, singles).result()
+    if expected is None:
+      expected = matrix
+    result["max_difference"] = float(np.abs(matrix - expected).max())
+    results.append(dict(model=model_name, docs=docs, **result))
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1].strip())
+  suites = parser.add_subparsers(dest="suite")
+  suites.required = True
+  keys = suites.add_parser("keys", help=bench_keys.__doc__.split("\n")[1].strip())
+  keys.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+  keys.add_argument("--dim", type=int, default=8)
+  storage = suites.add_parser("storage", help=bench_storage.__doc__.split("\n")[1].strip())
+  storage.add_argument("--sizes", type=int, nargs="+", default=[100000])
+  storage.add_argument("--dim", type=int, default=99)
+  storage.add_argument("--index-type", choices=indexes.INDEX_TYPES, default=indexes.FLAT)
+  suite = suites.add_parser("suite", help=run_suite.__doc__.split("\n")[1].strip())
+  suite.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+  suite.add_argument("--dim", type=int, default=99)
+  suite.add_argument("--index-types", choices=indexes.INDEX_TYPES, nargs="+",
+                     default=list(indexes.INDEX_TYPES))
+  suite.add_argument("--ks", type=int, nargs="+", default=[1, 10, 100])
+  suite.add_argument("--output")
+  vectorizer = suites.add_parser("vectorizer", help=bench_vectorizer.__doc__.split("\n")[1].strip())
+  vectorizer.add_argument("--model", default="en_core_web_sm")
+  vectorizer.add_argument("--docs", type=int, default=2000)
+  args = parser.parse_args()
+  if args.suite == "vectorizer":
+    for result in bench_vectorizer(args.model, args.docs):
+      print(json.dumps(result))
+    return
+  if args.suite == "suite":
+    run_suite(args.sizes, args.index_types, args.dim, args.ks, args.output)
+    return
+  for size in args.sizes:
+    if args.suite == "storage":
+      for result in bench_storage(size, args.dim, args.index_type):
+        print(json.dumps(result))
+    else:
+      print(json.dumps(bench_keys(size, args.dim)))
+
+if __name__ == "__main__":
+  main()
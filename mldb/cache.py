@@ -0,0 +1,95 @@
+"""
+  Cache Module: In-process cache of the results of searches.
+  Classes:
+    - ResultCache
+"""
+import collections
+import threading
+import time
+
+class _Flight:
+  """
+    A computation of a missing value, that concurrent callers wait on.
+  """
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+
+class ResultCache:
+  """
+    Thread-safe cache with LRU and TTL eviction, and single-flight
+    computation of missing values: concurrent misses for the same key
+    compute the value once, the other callers wait for it.
+    Keys should name everything the value depends on (e.g. the
+    version of the database searched), so that stale values are
+    never looked up rather than invalidated.
+  """
+  def __init__(self, max_size=1024, ttl=60.0):
+    """
+      Args:
+        max_size (int): Number of values kept, the least recently used
+                        ones are evicted first
+        ttl (float): Number of seconds a value is kept for
+    """
+    self._max_size = max_size
+    self._ttl = ttl
+    self._lock = threading.Lock()
+    self._values = collections.OrderedDict()
+    self._flights = dict()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._values)
+
+  def get(self, key, compute):
+    """
+      Returns the value of `key`, calling `compute()` to get it if it
+      is not cached (or expired).
+      Args:
+        key: Hashable key of the value
+        compute (callable): Computes the value. If it raises, the
+                            error is raised to every caller waiting
+                            for the value, and nothing is cached
+    """
+    with self._lock:
+      item = self._values.get(key, None)
+      if item is not None:
+        value, expires_at = item
+        if expires_at > time.monotonic():
+          self._values.move_to_end(key)
+          self.hits += 1
+          return value
+        del self._values[key]
+      self.misses += 1
+      flight = self._flights.get(key, None)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = _Flight()
+
+    if not leader:
+      flight.done.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.value
+
+    try:
+      flight.value = compute()
+    except BaseException as error:
+      flight.error = error
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+        if flight.error is None:
+          self._values[key] = (flight.value, time.monotonic() + self._ttl)
+          self._values.move_to_end(key)
+          while len(self._values) > self._max_size:
+            self._values.popitem(last=False)
+      flight.done.set()
+    return flight.value
+
+  def clear(self):
+    with self._lock:
+      self._values.clear()
@@ -0,0 +1,187 @@
+"""
+  Changes Module: Applies changes to a database in batches.
+  Classes:
+    - ChangeQueue
+"""
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+
+import mldb.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+class ChangeQueue:
+  """
+    In-process queue of upserts and deletes of items, applied in
+    batches by a background (daemon) thread. Changes to the same key
+    are coalesced: only the latest one is applied.
+    The changes still pending when the process exits are applied by an
+    `atexit` handler. Those of a process that is killed are lost, and
+    only recovered by rebuilding the database.
+    The queue can be bounded, in which case queueing a change blocks
+    while it is full (back-pressure). The lag of a change is the time
+    from it being queued to it being applied, see `stats`.
+  """
+  UPSERT = "upsert"
+  DELETE = "delete"
+
+  def __init__(self, apply, batch_size=256, interval=1.0, max_pending=None):
+    """
+      Args:
+        apply (callable): Called as `apply(upserts, deletes)` with a
+                          dict of the upserted items by key and a list
+                          of the deleted keys. If it raises, the batch
+                          is queued again (unless superseded)
+        batch_size (int): Maximum number of changes per batch
+        interval (float): Number of seconds changes are left to
+                          coalesce before they are applied
+        max_pending (int): Maximum number of queued changes, `None` for
+                           an unbounded queue
+    """
+    self._apply = apply
+    self._batch_size = batch_size
+    self._interval = interval
+    self._max_pending = max_pending
+    self._pending = collections.OrderedDict()
+    self._thread = None
+    self._create_conditions()
+    self._applied = 0
+    self._failed = 0
+    self._last_lag = 0.0
+    self._max_lag = 0.0
+    os.register_at_fork(after_in_child=self._after_fork)
+    atexit.register(self._flush_at_exit)
+
+  def __len__(self):
+    return len(self._pending)
+
+  def _create_conditions(self):
+    lock = threading.Lock()
+    # Notified when a full batch is pending, and when room is made.
+    self._condition = threading.Condition(lock)
+    self._not_full = threading.Condition(lock)
+    # Held from taking a batch to applying it, so that batches are
+    # applied in order, whichever thread applies them.
+    self._batch_lock = threading.Lock()
+
+  def _after_fork(self):
+    # The applying thread is not carried over to a child.
+    self._create_conditions()
+    self._thread = None
+
+  def stats(self):
+    """
+      Returns:
+        A `dict` of the number of `pending`, `applied` and `failed`
+        changes, the lag (in seconds) of the latest applied batch
+        (`last_lag`), of the most lagging one (`max_lag`) and the age of
+        the oldest pending change (`pending_lag`)
+    """
+    with self._condition:
+      now = time.monotonic()
+      oldest = min((queued_at for _, _, queued_at in self._pending.values()), default=now)
+      return {
+          "pending": len(self._pending),
+          "applied": self._applied,
+          "failed": self._failed,
+          "last_lag": self._last_lag,
+          "max_lag": self._max_lag,
+          "pending_lag": now - oldest,
+      }
+
+  def upsert(self, key, item):
+    """
+      Queues the insertion of `item` under `key`, replacing the item
+      stored under it, if any.
+    """
+    self._push(key, ChangeQueue.UPSERT, item)
+
+  def delete(self, key):
+    """
+      Queues the removal of the item stored under `key`.
+    """
+    self._push(key, ChangeQueue.DELETE, None)
+
+  def _push(self, key, operation, item):
+    with self._condition:
+      if self._max_pending is not None:
+        while key not in self._pending and len(self._pending) >= self._max_pending:
+          self._not_full.wait()
+      # A coalesced change lags from the first change it replaces.
+      _, _, queued_at = self._pending.pop(key, (None, None, time.monotonic()))
+      self._pending[key] = (operation, item, queued_at)
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+      if len(self._pending) >= self._batch_size:
+        self._condition.notify()
+
+  def _take(self):
+    batch = []
+    while self._pending and len(batch) < self._batch_size:
+      batch.append(self._pending.popitem(last=False))
+    if batch:
+      self._not_full.notify_all()
+    return batch
+
+  def _run(self):
+    while True:
+      with self._condition:
+        if len(self._pending) < self._batch_size:
+          self._condition.wait(self._interval)
+      if not self._apply_next():
+        # Give the cause of the failure time to go away.
+        time.sleep(self._interval)
+
+  def _apply_next(self):
+    # Applies the next batch, if any. Returns `False` if it failed.
+    with self._batch_lock:
+      with self._condition:
+        batch = self._take()
+      return not batch or self._apply_batch(batch)
+
+  def _apply_batch(self, batch):
+    upserts = {key: item for key, (operation, item, _) in batch if operation == ChangeQueue.UPSERT}
+    deletes = [key for key, (operation, _, _) in batch if operation == ChangeQueue.DELETE]
+    try:
+      self._apply(upserts, deletes)
+    except Exception: # pylint: disable=broad-except
+      logger.exception("Applying %d changes failed, they are queued again", len(batch))
+      with self._condition:
+        self._failed += len(batch)
+        for key, change in reversed(batch):
+          # Changes queued in the meantime are newer.
+          if key not in self._pending:
+            self._pending[key] = change
+            self._pending.move_to_end(key, last=False)
+      metrics.count("mldb.changes.failed", len(batch))
+      return False
+    lag = time.monotonic() - min(queued_at for _, (_, _, queued_at) in batch)
+    with self._condition:
+      self._applied += len(batch)
+      self._last_lag = lag
+      self._max_lag = max(self._max_lag, lag)
+    metrics.count("mldb.changes.applied", len(batch))
+    metrics.timing("mldb.changes.lag", lag)
+    logger.info("Applied %d changes (%d upserts, %d deletes), lag: %.3fs",
+                len(batch), len(upserts), len(deletes), lag)
+    return True
+
+  def flush(self):
+    """
+      Applies every queued change in the calling thread.
+      Returns:
+        `True` if they were all applied, `False` if a batch failed
+    """
+    while self._pending:
+      if not self._apply_next():
+        return False
+    return True
+
+  def _flush_at_exit(self):
+    if self._pending and not self.flush():
+      logger.error("%d changes were not applied before exiting", len(self._pending))
@@ -5,62 +5,367 @@
 
   Author: @captain-pool
 """
+import contextlib
+import fcntl
+import json
 import os
+import re
+import time
 
 import faiss
 import numpy as np
-import _pickle as pickle
+
+import mldb.filters as filters
+import mldb.indexes as indexes
+import mldb.metrics as metrics
+import mldb.payload as payload
+from mldb.keyindex import KeyIndex
+from mldb.wal import WriteAheadLog
+
+# The index file is not written for flat, float32 indexes: their vectors
+# are stored in the payload file, which read-only databases memory-map
+# (see `indexes.MappedFlatIndex`).
+SNAPSHOT_FILES = ("index", "payload")
+# Files of the snapshots written before the keys, tombstones and
+# attributes were stored together, in the payload file, and before the
+# vectors of flat indexes were.
+LEGACY_SNAPSHOT_FILES = ("tombstones", "attributes", "vectors")
+# Number of times `open` re-reads the manifest if the files it names
+# are removed by a writer before they are opened.
+OPEN_ATTEMPTS = 3
+# Maximum number of logged inserts added to the index at a time when
+# the write-ahead log is replayed.
+REPLAY_BATCH_SIZE = 4096
 
 class Database:
   """
     Database for storing Vectors and searching them by
     similarity.
+    Items are stored in the index under their (64 bit) key, so their
+    ids never change. Removed items are tombstoned and skipped by
+    searches until they are compacted away.
+    A database opened read-only memory-maps its snapshot, which is
+    then shared by every process reading it. Items inserted since the
+    snapshot are kept apart, in a small in-memory index.
+    Every snapshot is a set of files named after its generation, and a
+    manifest names the current one. `write` only replaces the manifest
+    (atomically) once the new files are durable, so readers always see
+    a consistent snapshot and never wait. Writers serialize their
+    read-modify-write cycles with `lock`.
   """
-  def __init__(self, db_path, vector_dim):
+  def __init__(self, db_path, vector_dim,
+               checkpoint_bytes=4 * 1024 * 1024, checkpoint_interval=3600,
+               compaction_threshold=0.2, index_type=indexes.FLAT,
+               promote_at=100000, index_options=None, num_attributes=0,
+               storage=indexes.FLOAT32):
     """
       Creates Database Instance.
       Args:
         db_path (str): Path to database storage folder
         vector_dim (int): Dimension of the vectors
+        checkpoint_bytes (int): Size of the write-ahead log after which
+                                `commit` folds it into a new snapshot
+        checkpoint_interval (float): Number of seconds since the last
+                                     snapshot after which `commit` folds
+                                     the write-ahead log into a new one
+        compaction_threshold (float): Fraction of removed rows above which
+                                      `commit` drops them from the index
+        index_type (str): One of `mldb.indexes.INDEX_TYPES`. A new database
+                          starts with a flat index, which is rebuilt as
+                          `index_type` by `write` once it holds `promote_at`
+                          items
+        promote_at (int): See `index_type` and `storage`
+        index_options (dict): Options of `mldb.indexes.build_index`
+                              (nlist, pq_m, hnsw_m) and default search
+                              parameters (nprobe, ef_search)
+        num_attributes (int): Number of leading components of every
+                              vector that are also kept uncompressed,
+                              for searches to be filtered on (see
+                              `mldb.filters`)
+        storage (str): One of `mldb.indexes.STORAGE_TYPES`. Vectors are
+                       quantized (fp16 or sq8) once the index is
+                       promoted, `search_vector` then returns
+                       approximations of them
     """
     name = os.path.basename(db_path)
     path = os.path.normpath(db_path)
     if not os.path.exists(path) or not os.path.isdir(path):
       os.makedirs(path)
-    self._index_file = os.path.join(path, "%s.index" % name)
-    self._payload_path = os.path.join(path, "%s.payload" % name)
-    self._inv_payload_path = os.path.join(path, "%s.invpayload" % name)
+    self._path = path
+    self._name = name
+    self._manifest_path = os.path.join(path, "%s.manifest" % name)
+    self._lock_path = os.path.join(path, "%s.lock" % name)
+    self._hold_path = os.path.join(path, "%s.hold" % name)
+    self._wal = WriteAheadLog(os.path.join(path, "%s.wal" % name))
+    self._snapshot_files = dict()
+    self._lock_fd = None
+    self._lock_depth = 0
     self._vector_dim = vector_dim
+    self._generation = 0
+    self._checkpoint_bytes = checkpoint_bytes
+    self._checkpoint_interval = checkpoint_interval
+    self._compaction_threshold = compaction_threshold
+    self._target_index_type = index_type
+    # ivf_pq indexes are quantized anyway.
+    self._target_storage = indexes.FLOAT32 if index_type == indexes.IVF_PQ else storage
+    self._promote_at = promote_at
+    self._index_options = dict(index_options or {})
+    self._num_attributes = num_attributes
+    self._read_only = False
+    self._legacy = False
+    self._delta = None
+    self._mask_cache = None
 
   def __repr__(self):
-    if hasattr(self, "_payload"):
+    if hasattr(self, "_keys"):
       result = []
       result.append("Index \t| Path \t| Vector")
       result.append("-" * (len("Index t| Path | Vector") + 2*8))
-      for idx, data in enumerate(self._payload):
-        result.append(f"{idx} \t| {data} \t| <float32 vector representation>")
+      for idx, data in enumerate(self._keys.keys.tolist()):
+        if not self._keys.is_tombstoned(data):
+          result.append(f"{idx} \t| {data} \t| <float32 vector representation>")
       return "\n".join(result)
     return "Datbase not yet opened"
 
-  def open(self):
+  def __contains__(self, key):
+    """
+      Tells whether an item is stored (and not removed) under `key`.
+    """
+    return key in self._keys
+
+  @property
+  def manifest_path(self):
+    return self._manifest_path
+
+  @property
+  def wal_path(self):
+    return self._wal.path
+
+  @property
+  def index_type(self):
+    return self._index_type
+
+  @property
+  def storage(self):
+    return self._storage
+
+  @property
+  def generation(self):
+    """
+      Generation of the data on disk this instance was opened from.
+      Bumped by every `write`, so that other processes can notice
+      that the database has changed.
+    """
+    return self._generation
+
+  @property
+  def version(self):
+    """
+      Identifies the data this instance was opened from: its generation
+      and the length of the write-ahead log replayed on top of it. Two
+      instances opened with the same version hold the same items.
+    """
+    return (self._generation, self._replayed)
+
+  @property
+  def snapshot_files(self):
+    """
+      Paths of the files of the snapshot last opened or written, by
+      kind ("index" and "payload", see `mldb.payload`).
+    """
+    return dict(self._snapshot_files)
+
+  def _snapshot_file(self, kind, generation):
+    return os.path.join(self._path, "%s.%d.%s" % (self._name, generation, kind))
+
+  def _legacy_file(self, kind):
+    return os.path.join(self._path, "%s.%s" % (self._name, kind))
+
+  def _read_manifest(self):
+    """
+      Returns the current generation and the paths of its files.
+    """
+    try:
+      with open(self._manifest_path, "r") as f:
+        manifest = json.load(f)
+      return manifest["generation"], {kind: os.path.join(self._path, name)
+                                      for kind, name in manifest["files"].items()}
+    except FileNotFoundError:
+      pass
+    # Older databases kept a single snapshot, written in place.
+    try:
+      with open(self._legacy_file("generation"), "r") as f:
+        generation = int(f.read().strip() or 0)
+    except (OSError, ValueError):
+      generation = 0
+    files = {kind: self._legacy_file(kind) for kind in SNAPSHOT_FILES + LEGACY_SNAPSHOT_FILES}
+    return generation, {kind: path for kind, path in files.items() if os.path.exists(path)}
+
+  @contextlib.contextmanager
+  def lock(self):
     """
-      Opens the database for reading and writing
+      Holds an exclusive, advisory (`flock`) lock on the database.
+      Writers take it around their whole read-modify-write cycle
+      (`open`, changes, `commit`) so that they never interleave;
+      `write` also takes it. Readers never do. It is reentrant.
     """
-    if os.path.exists(self._index_file) and os.path.exists(self._payload_path):
-      self._index = faiss.read_index(self._index_file)
-      with open(self._payload_path, "rb") as f:
-        self._payload = np.load(f)
-      with open(self._inv_payload_path, "rb") as f:
-        self._inv_payload = pickle.load(f)
-      assert self._index.ntotal == len(self._payload),\
+    if not self._lock_depth:
+      self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+      fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+    self._lock_depth += 1
+    try:
+      yield self
+    finally:
+      self._lock_depth -= 1
+      if not self._lock_depth:
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+  @metrics.timed("mldb.database.open")
+  def open(self, read_only=False):
+    """
+      Opens the database for reading and writing: loads the latest
+      snapshot and replays the write-ahead log on top of it. A snapshot
+      in an older format is converted (written anew) by the first
+      process opening it for writing.
+      Args:
+        read_only (bool): Memory-map the snapshot instead of reading it,
+                          and leave the files on disk untouched, even if
+                          the log has a torn tail. The database cannot
+                          be modified then. Indexes that cannot be
+                          memory-mapped are read into memory (see
+                          `mldb.indexes.read_index`)
+    """
+    self._read_only = read_only
+    self._delta = None
+    self._mask_cache = None
+    for attempt in range(OPEN_ATTEMPTS):
+      self._generation, files = self._read_manifest()
+      try:
+        self._load(files, read_only)
+        break
+      except FileNotFoundError:
+        # A writer dropped this generation in the meantime.
+        if attempt == OPEN_ATTEMPTS - 1:
+          raise
+    self._snapshot_files = files
+    self._wal.generation = self._generation
+    self._replay(read_only)
+    if self._legacy and not read_only:
+      self.write()
+
+  def _load(self, files, read_only):
+    self._legacy = False
+    if "payload" in files:
+      vectors = None
+      if payload.is_payload(files["payload"]):
+        snapshot = payload.read_payload(files["payload"], mmap=read_only)
+        if snapshot.vector_dim != self._vector_dim:
+          raise ValueError("The database holds vectors of dimension %d, not %d"
+                           % (snapshot.vector_dim, self._vector_dim))
+        keys, order, tombstones = snapshot.keys, snapshot.order, snapshot.tombstones
+        attributes, vectors = snapshot.attributes, snapshot.vectors
+      else:
+        keys, tombstones, attributes = self._load_legacy(files, read_only)
+        order = None
+        self._legacy = True
+      if vectors is not None and read_only:
+        self._index = indexes.MappedFlatIndex(vectors, keys, order)
+      elif vectors is not None:
+        self._index = indexes.build_index(indexes.FLAT, self._vector_dim)
+        if len(keys):
+          self._index.add_with_ids(vectors, keys)
+      else:
+        self._index = indexes.read_index(files["index"], mmap=read_only)
+        if isinstance(faiss.downcast_index(self._index), faiss.IndexFlat):
+          self._index = self._with_ids(self._index, keys)
+          self._legacy = True
+      assert self._index.ntotal == len(keys),\
              "Number of Rows doesn't match"
+      attributes = self._checked_attributes(attributes, keys)
+      self._keys = KeyIndex(keys, tombstones, attributes, self._num_attributes, order)
+    else:
+      print("No database found. Initializing a new one")
+      self._index = indexes.build_index(indexes.FLAT, self._vector_dim)
+      self._keys = KeyIndex(num_attributes=self._num_attributes)
+    self._index_type = indexes.index_type_of(self._index)
+    self._storage = indexes.storage_of(self._index)
+
+  @staticmethod
+  def _load_legacy(files, read_only):
+    # Snapshots made of `np.save`d arrays. Older ones stored the keys
+    # as strings.
+    mmap_mode = "r" if read_only else None
+    keys = _integer_keys(np.load(files["payload"], mmap_mode=mmap_mode), files["payload"])
+    tombstones = attributes = None
+    if "tombstones" in files:
+      tombstones = np.load(files["tombstones"])
+    if "attributes" in files:
+      attributes = np.load(files["attributes"], mmap_mode=mmap_mode)
+    return keys, tombstones, attributes
+
+  def _checked_attributes(self, attributes, keys):
+    if not self._num_attributes:
+      return None
+    if attributes is not None and attributes.shape == (len(keys), self._num_attributes):
+      return attributes
+    # Missing, or kept for another number of attributes.
+    if not len(keys):
+      return None
+    return self._index.reconstruct_batch(keys)[:, :self._num_attributes]
+
+  def _with_ids(self, index, keys):
+    # Older databases addressed the rows of a plain index by position.
+    vectors = index.reconstruct_n(0, index.ntotal)
+    index = indexes.build_index(indexes.FLAT, self._vector_dim)
+    if len(keys):
+      index.add_with_ids(vectors, keys)
+    return index
+
+  def _check_writable(self):
+    if self._read_only:
+      raise RuntimeError("The database was opened read-only")
+
+  def _replay(self, read_only):
+    # Logs written before generations were recorded apply as they are.
+    generation = self._generation
+    offset = 0
+    inserts, num_inserts = [], 0
+    for operation, key, vector, offset in self._wal.replay():
+      if operation == WriteAheadLog.GENERATION:
+        generation = key
+        continue
+      if generation != self._generation:
+        # Folded into the snapshot already (or, for a newer generation,
+        # into one that is not opened yet).
+        continue
+      if operation in (WriteAheadLog.INSERT, WriteAheadLog.INSERT_MANY):
+        keys = np.atleast_1d(np.asarray(key, dtype=np.int64))
+        inserts.append((keys, vector.reshape(len(keys), -1)))
+        num_inserts += len(keys)
+        # Runs of inserts are added with a single call per batch.
+        if num_inserts < REPLAY_BATCH_SIZE:
+          continue
+      self._replay_inserts(inserts)
+      inserts, num_inserts = [], 0
+      if operation == WriteAheadLog.REMOVE:
+        self._keys.remove(key)
+    self._replay_inserts(inserts)
+    self._replayed = offset
+    if read_only:
       return
-    print("No database found. Initializing a new one")
-    self._index = faiss.IndexFlatL2(self._vector_dim)
-    self._payload = np.asarray([], dtype=str)
-    self._inv_payload = dict()
+    if generation < self._generation:
+      self._wal.truncate()
+    elif offset < self._wal.size:
+      self._wal.truncate(offset)
+
+  def _replay_inserts(self, inserts):
+    if inserts:
+      keys, vectors = zip(*inserts)
+      self._insert_many(np.concatenate(keys), np.vstack(vectors))
 
-  def nearest(self, vector, num_closest=1):
+  def nearest(self, vector, num_closest=1, nprobe=None, ef_search=None, where=None):
     """
       Searches for the most similar items and returns them.
       Args:
@@ -68,46 +373,218 @@ class Database:
         num_closest (default: 1): a `np.int32` variable
                                   to denote the number of
                                   closest matches to return
+        nprobe (int): Number of inverted lists to visit (IVF indexes)
+        ef_search (int): Size of the candidate list (HNSW indexes)
+        where (mldb.filters.Filter): Restricts the items that may be
+                                     returned
       Returns:
-        A list of strings containing the similar items
+        A list of keys of the similar items
     """
     if len(vector.shape) < 2:
       vector = vector[np.newaxis, :]
-    _, index = self._index.search(vector, num_closest)
-    payload_paths = self._payload[tuple(index)]
-    return payload_paths.tolist()
+    keys, _ = self.nearest_many(vector[:1], num_closest, nprobe, ef_search, where)
+    return keys[0]
 
-  def insert(self, string, vector):
+  @metrics.timed("mldb.database.search")
+  def nearest_many(self, vectors, num_closest=1, nprobe=None, ef_search=None, where=None):
+    """
+      Searches for the most similar items of every row of a matrix,
+      with a single (multi-threaded) faiss search.
+      Args:
+        vectors: a `np.float32` matrix of context vectors
+        num_closest (default: 1): number of closest matches to
+                                  return per row
+        nprobe (int): Number of inverted lists to visit (IVF indexes)
+        ef_search (int): Size of the candidate list (HNSW indexes)
+        where (mldb.filters.Filter): Restricts the items that may be
+                                     returned. It is applied inside the
+                                     search, through an id selector
+                                     (cached, for filters with a key).
+                                     Rows for which an IVF or HNSW
+                                     search finds less than
+                                     `num_closest` of them are searched
+                                     again with twice the nprobe or
+                                     ef_search, until it is exhaustive
+      Returns:
+        A tuple of two lists with one list per row: the keys of the
+        similar items and their (squared L2) distances
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    selectors = None
+    available = len(self._keys)
+    if where is None and self._keys.superseded:
+      # Their keys are live, in other rows: only live rows are searched.
+      where = filters.All()
+    if where is not None:
+      available, *selectors = self._selector(where)
+      num_search = min(num_closest, available)
+    else:
+      # Fetch enough extra rows for tombstoned ones never to crowd out live ones.
+      num_search = min(num_closest + self._keys.dead, self._keys.total)
+    if num_search <= 0:
+      return [[] for _ in vectors], [[] for _ in vectors]
+    nprobe = nprobe or self._index_options.get("nprobe")
+    ef_search = ef_search or self._index_options.get("ef_search")
+    keys, distances = self._search(vectors, num_search, num_closest, nprobe, ef_search, selectors)
+    # Filtered IVF and HNSW searches may come back short: the rows that
+    # did are searched again, wider, until the search is exhaustive.
+    expected = min(num_closest, available)
+    while True:
+      short = [row for row, row_keys in enumerate(keys) if len(row_keys) < expected]
+      if not short:
+        break
+      widened = indexes.widened_search(self._index, self._index_type, nprobe, ef_search)
+      if widened is None:
+        metrics.count("mldb.database.short_results", len(short))
+        break
+      nprobe, ef_search = widened
+      metrics.count("mldb.database.search_retries", len(short))
+      short_keys, short_distances = self._search(
+          vectors[short], num_search, num_closest, nprobe, ef_search, selectors)
+      for row, row_keys, row_distances in zip(short, short_keys, short_distances):
+        keys[row], distances[row] = row_keys, row_distances
+    return keys, distances
+
+  def _masks(self):
+    # The cache of the masks of filters, for the current rows.
+    masks = self._mask_cache
+    if masks is None or masks.version != self._keys.version:
+      masks = self._mask_cache = filters.MaskCache(self._keys)
+    return masks
+
+  def _selector(self, where):
+    """
+      Returns the number of live rows passing `where` and the id
+      selectors of the index and of the delta index picking them,
+      cached (until the items change) for filters that have a key.
+    """
+    masks = self._masks()
+
+    def compute():
+      mask = where.mask(self._keys.keys, self._keys.attributes, masks)
+      if self._keys.dead:
+        mask = mask & masks.get_or_compute(("live",), self._keys.live_mask)
+      rows = np.flatnonzero(mask)
+      # The rows of the delta index follow those of the snapshot.
+      num_indexed = self._index.ntotal
+      indexed = rows[rows < num_indexed]
+      if not indexes.selects_positions(self._index):
+        indexed = self._keys.keys[indexed]
+      delta_selector = None
+      if self._delta is not None:
+        delta_selector = indexes.id_selector(rows[rows >= num_indexed] - num_indexed)
+      return len(rows), indexes.id_selector(indexed), delta_selector
+
+    if where.key is None:
+      return compute()
+    return masks.get_or_compute(("selector", where.key), compute)
+
+  def _search(self, vectors, num_search, num_closest, nprobe, ef_search, selectors):
+    selector, delta_selector = selectors or (None, None)
+    distances, ids = indexes.search(self._index, vectors, num_search, self._index_type,
+                                    nprobe=nprobe, ef_search=ef_search, selector=selector)
+    if self._delta is not None:
+      delta_distances, delta_ids = indexes.search(
+          self._delta, vectors, min(num_search, self._delta.ntotal), selector=delta_selector)
+      distances = np.hstack([distances, delta_distances])
+      ids = np.hstack([ids, delta_ids])
+      # faiss pads with infinite distances, which sort last.
+      order = np.argsort(distances, axis=1, kind="stable")
+      distances = np.take_along_axis(distances, order, axis=1)
+      ids = np.take_along_axis(ids, order, axis=1)
+    # faiss pads with -1 when there are less than `num_search` rows.
+    valid = ids >= 0
+    dead = self._keys.dead
+    if dead and selectors is None:
+      tombstones = self._keys.tombstones
+      valid &= ~np.isin(ids, np.fromiter(tombstones, dtype=np.int64, count=len(tombstones)))
+    keys, key_distances = [], []
+    for row_ids, row_distances, row_valid in zip(ids, distances, valid):
+      keys.append(row_ids[row_valid][:num_closest].tolist())
+      key_distances.append(row_distances[row_valid][:num_closest].tolist())
+    return keys, key_distances
+
+  def insert(self, key, vector):
     """
       Inserts new item-vector pair to the database
       Args:
-        string (str): The string item to store
+        key (int): The integer key to store
         vector: a `np.float32` context vector for
                 storing with the key
       Returns:
         `True` if insertion was successful `False` if
         insertion fails.
     """
-    if not string in self._payload:
-      if len(vector.shape) < 2:
-        vector = vector[np.newaxis, :]
-      self._index.add(vector)
-      self._payload = np.append(self._payload, string)
-      self._inv_payload[string] = len(self._payload) - 1
+    self._check_writable()
+    if self._insert(key, vector):
+      self._wal.append_insert(key, vector)
+      metrics.count("mldb.database.inserts")
       return True
     return False
 
+  def insert_many(self, keys, vectors):
+    """
+      Inserts many item-vector pairs with a single faiss call, and logs
+      them with a few large writes and a single fsync. Keys that are
+      already stored, or repeated within `keys`, are skipped.
+      Args:
+        keys (list(int)): The integer keys to store
+        vectors: a `np.float32` matrix with one row per key
+      Returns:
+        A boolean `np.ndarray` telling which of the pairs were inserted
+    """
+    self._check_writable()
+    keys = np.asarray(keys, dtype=np.int64)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    inserted = self._insert_many(keys, vectors)
+    self._wal.append_inserts(keys[inserted], vectors[inserted])
+    metrics.count("mldb.database.inserts", int(np.count_nonzero(inserted)))
+    return inserted
+
+  def _insert_many(self, keys, vectors):
+    inserted = np.zeros(len(keys), dtype=bool)
+    _, first = np.unique(keys, return_index=True)
+    inserted[first] = True
+    inserted &= ~self._keys.contains_many(keys)
+    if not inserted.any():
+      return inserted
+    if self._read_only:
+      # The snapshot is memory-mapped read-only.
+      if self._delta is None:
+        self._delta = indexes.build_index(indexes.FLAT, self._vector_dim)
+      self._delta.add_with_ids(vectors[inserted], keys[inserted])
+    else:
+      replaced = [key for key in keys[inserted].tolist() if self._keys.is_tombstoned(key)]
+      if replaced and indexes.supports_remove(self._index_type):
+        # Each id may only be stored once in the index: the old rows of
+        # removed keys inserted again are dropped first. hnsw indexes
+        # keep them, superseded, until the next snapshot.
+        # An array (rather than an id selector) lets faiss pick the
+        # selector the direct map of ivf indexes requires.
+        replaced = np.asarray(replaced, dtype=np.int64)
+        self._index.remove_ids(replaced)
+        self._keys.drop(replaced)
+      self._index.add_with_ids(vectors[inserted], keys[inserted])
+    self._keys.extend(keys[inserted], vectors[inserted][:, :self._num_attributes])
+    return inserted
+
+  def _insert(self, key, vector):
+    vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+    return bool(self._insert_many(np.asarray([key], dtype=np.int64), vector)[0])
+
+  @metrics.timed("mldb.database.reconstruct")
   def search_vector(self, key):
     """
       Inverse Search for searching vectors for a given key.
       Args:
-        key (str): key to be searched
+        key (int): key to be searched
       Returns:
         A `np.float32` context vector associated with the key
     """
-    index = self._inv_payload.get(key, None)
-    if index is not None:
-      return self._index.reconstruct(index)
+    if key in self._keys:
+      if self._delta is not None and self._keys.row(key) >= self._index.ntotal:
+        return self._delta.reconstruct(int(key))
+      return self._index.reconstruct(int(key))
     return np.zeros(self._vector_dim, dtype=np.float32)
 
   def remove(self, index):
@@ -118,36 +595,280 @@ class Database:
       Returns:
         `True` if the deletion was successful, `False` if not.
     """
-    if self._payload.size:
-      index = np.asarray(index)
-      if index.ndim < 1:
-        index = index[np.newaxis, :]
-      keys = self._payload[index]
-      self._payload = np.delete(self._payload, index)
-      self._index.remove_ids(index)
-      for key in keys.tolist():
-        self._inv_payload.pop(key)
-      return True
+    self._check_writable()
+    if len(self._keys):
+      index = np.atleast_1d(np.asarray(index, dtype=np.int64))
+      removed = [self.remove_by_key(key) for key in self._keys.keys[index].tolist()]
+      return any(removed)
     return False
+
   def remove_by_key(self, key):
     """
       Removes item by a given key
       Args:
-        key (str): key to be removed
+        key (int): key to be removed
       Returns:
         `True` if deletion was successful else returns `False`
     """
-    index = self._inv_payload.get(key, None)
-    if index is not None:
-      return self.remove(index)
+    self._check_writable()
+    if self._keys.remove(key):
+      self._wal.append_remove(key)
+      metrics.count("mldb.database.removes")
+      return True
     return False
 
+  @property
+  def dead_fraction(self):
+    if not self._keys.total:
+      return 0.0
+    return self._keys.dead / self._keys.total
+
+  @metrics.timed("mldb.database.compact")
+  def compact(self):
+    """
+      Physically drops the tombstoned items from the index.
+    """
+    self._check_writable()
+    if not self._keys.dead:
+      return
+    if not indexes.supports_remove(self._index_type):
+      self.rebuild_index(self._index_type)
+      return
+    tombstones = self._keys.tombstones
+    self._index.remove_ids(np.fromiter(tombstones, dtype=np.int64, count=len(tombstones)))
+    self._keys.compact()
+
+  @metrics.timed("mldb.database.rebuild_index")
+  def rebuild_index(self, index_type=None, storage=None):
+    """
+      Rebuilds the index from the live items, as `index_type` with
+      `storage` (the current ones by default). IVF and 8-bit quantized
+      indexes are trained on the live vectors, which also re-balances
+      their lists and ranges.
+    """
+    self._check_writable()
+    index_type = index_type or self._index_type
+    storage = storage or self._storage
+    keys = self._keys.live_keys
+    vectors = self._index.reconstruct_batch(keys) if len(keys) else None
+    if not len(keys):
+      # Nothing to train on: start over like a new database.
+      index_type, storage = indexes.FLAT, indexes.FLOAT32
+    index = indexes.build_index(index_type, self._vector_dim, vectors, storage, **self._index_options)
+    if len(keys):
+      index.add_with_ids(vectors, keys)
+    self._index, self._index_type = index, index_type
+    self._storage = indexes.storage_of(index)
+    # Selectors of the old index may pick keys rather than positions.
+    self._mask_cache = None
+    self._keys.compact()
+
+  def _maybe_promote(self):
+    current = (self._index_type, self._storage)
+    target = (self._target_index_type, self._target_storage)
+    if current == (indexes.FLAT, indexes.FLOAT32) and target != current and \
+       len(self._keys) >= max(self._promote_at, indexes.min_training_rows(*target)):
+      self.rebuild_index(*target)
+
+  @metrics.timed("mldb.database.commit")
+  def commit(self):
+    """
+      Makes the changes durable by syncing the write-ahead log, and
+      checkpoints once the log is large or old enough (unless
+      checkpoints are held, see `hold_checkpoints`).
+    """
+    self._check_writable()
+    self._wal.sync()
+    if self.dead_fraction > self._compaction_threshold:
+      self.compact()
+    size = self._wal.size
+    if size >= self._checkpoint_bytes or \
+       (size and self._seconds_since_checkpoint() >= self._checkpoint_interval):
+      with self.lock():
+        if not self._checkpoints_held():
+          self.write()
+
+  def _seconds_since_checkpoint(self):
+    try:
+      return time.time() - os.path.getmtime(self._manifest_path)
+    except OSError:
+      return float("inf")
+
+  @metrics.timed("mldb.database.write")
   def write(self):
     """
-      Commits the Changes to disk
+      Commits the Changes to disk: writes a new snapshot and empties
+      the write-ahead log folded into it. The files of the snapshot
+      are named after its generation and made durable before the
+      manifest is (atomically) replaced to name it, so that a crash or
+      a concurrent reader never sees a partial snapshot. Files of older
+      generations are removed, bar the previous one, for readers that
+      were opening it.
+    """
+    self._check_writable()
+    with self.lock():
+      self._maybe_promote()
+      if self._keys.superseded:
+        # Snapshots only record tombstones, by key.
+        self.compact()
+      generation = max(self._generation, self._read_manifest()[0]) + 1
+      files = dict()
+      # The vectors of flat, float32 indexes are stored in the payload
+      # file instead of an index file.
+      vectors = indexes.flat_vectors(self._index)
+      if vectors is None:
+        files["index"] = self._write_file(
+            "index", generation, lambda path: faiss.write_index(self._index, path))
+      tombstones = np.fromiter(self._keys.tombstones, dtype=np.int64, count=len(self._keys.tombstones))
+      files["payload"] = self._write_file(
+          "payload", generation, lambda path: payload.write_payload(
+              path, generation, self._vector_dim, self._keys.keys, tombstones,
+              self._keys.attributes, vectors))
+      self._write_manifest(generation, files)
+      self._legacy = False
+      self._wal.truncate()
+      self._remove_stale_files()
+
+  def _write_file(self, kind, generation, write):
+    path = self._snapshot_file(kind, generation)
+    write(path)
+    _fsync(path)
+    return path
+
+  def _write_manifest(self, generation, files):
+    manifest = {
+        "generation": generation,
+        "files": {kind: os.path.basename(path) for kind, path in files.items()},
+    }
+    temp_path = "%s.%d.tmp" % (self._manifest_path, os.getpid())
+    with open(temp_path, "w") as f:
+      json.dump(manifest, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temp_path, self._manifest_path)
+    _fsync(self._path)
+    self._generation, self._snapshot_files = generation, dict(files)
+    # Records logged from now on apply to the new snapshot.
+    self._wal.generation = generation
+
+  def _remove_stale_files(self):
+    kinds = SNAPSHOT_FILES + LEGACY_SNAPSHOT_FILES
+    pattern = re.compile(r"%s\.(\d+)\.(%s)$" % (re.escape(self._name), "|".join(kinds)))
+    for name in os.listdir(self._path):
+      match = pattern.match(name)
+      if match and int(match.group(1)) < self._generation - 1:
+        os.remove(os.path.join(self._path, name))
+    # Older databases kept a single snapshot (and an inverse payload).
+    for kind in kinds + ("invpayload", "generation"):
+      if os.path.exists(self._legacy_file(kind)):
+        os.remove(self._legacy_file(kind))
+
+  def log_position(self):
+    """
+      Returns the position the database on disk has reached: the
+      generation of its snapshot and the size of its write-ahead log.
+      Changes logged past it can be replayed onto another database by
+      `swap_into`, as long as the database is not checkpointed in the
+      meantime (see `hold_checkpoints`).
+    """
+    with self.lock():
+      return self._read_manifest()[0], self._wal.size
+
+  @contextlib.contextmanager
+  def hold_checkpoints(self):
+    """
+      Keeps every process from checkpointing the database while it is
+      held: `commit` then leaves the write-ahead log to grow, so that the
+      changes logged past a `log_position` stay in it. The hold is a
+      shared, advisory (`flock`) lock, released if its process dies.
+    """
+    fd = os.open(self._hold_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_SH)
+      yield self
+    finally:
+      os.close(fd)
+
+  def _checkpoints_held(self):
+    fd = os.open(self._hold_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      return True
+    finally:
+      os.close(fd)
+    return False
+
+  def swap_into(self, db_path, since=None):
     """
-    faiss.write_index(self._index, self._index_file)
-    with open(self._payload_path, "wb") as f:
-      np.save(f, self._payload)
-    with open(self._inv_payload_path, "wb") as f:
-      pickle.dump(self._inv_payload, f)
+      Moves the snapshot last written by `write` over the database
+      at `db_path`, replacing its contents atomically. Processes
+      reading that database pick the new one up like any other change.
+      Args:
+        db_path (str): Path to the storage folder of the database to
+                       replace, named like this one
+        since (tuple): A `log_position` of the database to replace. The
+                       changes it logged past it are applied to this
+                       database, which is then written, before the swap
+      Raises:
+        ValueError: If the database to replace was checkpointed since
+                    `since`, the changes logged in between being lost
+    """
+    target = Database(db_path, self._vector_dim)
+    with target.lock():
+      if since is not None:
+        self._apply_log_of(target, *since)
+        self.write()
+      generation = target._read_manifest()[0] + 1
+      files = dict()
+      for kind, path in self._snapshot_files.items():
+        files[kind] = target._snapshot_file(kind, generation)
+        os.replace(path, files[kind])
+      target._write_manifest(generation, files)
+      # Records of the replaced database are in this one (or predate it).
+      target._wal.truncate()
+      target._remove_stale_files()
+
+  def _apply_log_of(self, other, since_generation, since_offset):
+    generation = other._read_manifest()[0]
+    if generation != since_generation:
+      raise ValueError("%s was checkpointed (generation %d, not %d) since the changes to "
+                       "replay were logged" % (other._path, generation, since_generation))
+    logged_generation = generation
+    for operation, key, vector, offset in other._wal.replay():
+      if operation == WriteAheadLog.GENERATION:
+        logged_generation = key
+        continue
+      if offset <= since_offset or logged_generation != generation:
+        continue
+      if operation == WriteAheadLog.REMOVE:
+        self.remove_by_key(key)
+      elif operation in (WriteAheadLog.INSERT, WriteAheadLog.INSERT_MANY):
+        keys = np.atleast_1d(np.asarray(key, dtype=np.int64))
+        # Items logged again replace the ones read from elsewhere.
+        for replaced in keys.tolist():
+          self.remove_by_key(replaced)
+        self.insert_many(keys, vector.reshape(len(keys), -1))
+
+def _fsync(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def _integer_keys(keys, path):
+  # Keys of a legacy payload, as `np.int64`. Older ones stored them as
+  # strings, which have to hold (64 bit) integers.
+  if keys.dtype.kind in "iu":
+    return keys.astype(np.int64, copy=False)
+  if keys.dtype.kind not in "US":
+    raise ValueError("%s holds keys of type %s, not integers" % (path, keys.dtype))
+  converted = np.empty(len(keys), dtype=np.int64)
+  for row, key in enumerate(keys.tolist()):
+    try:
+      converted[row] = int(key)
+    except (ValueError, OverflowError):
+      raise ValueError("%s holds a key that is not a 64 bit integer: %r (row %d)"
+                       % (path, key, row)) from None
+  return converted
@@ -0,0 +1,156 @@
+"""
+  Embeddings Module: Persistent cache of the embeddings of texts.
+  Classes:
+    - EmbeddingCache
+  Functions:
+    - embedding_key
+    - get_embedding_cache
+    - normalize_text
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+def normalize_text(text):
+  """
+    Normalizes a text before it is embedded (and hashed): Unicode NFC,
+    without surrounding whitespace, "NA" if it is empty.
+  """
+  text = unicodedata.normalize("NFC", text or "").strip()
+  return text or "NA"
+
+def embedding_key(model_name, model_version, text):
+  """
+    Returns the key of the embedding of a (normalized) text by a model.
+  """
+  return hashlib.sha256(
+      ("%s\0%s\0%s" % (model_name, model_version, text)).encode("utf-8")).digest()
+
+class EmbeddingCache:
+  """
+    Size-bounded cache of `np.float32` embeddings, kept in a SQLite
+    database so that it survives restarts and is shared by every
+    process on a host. Once it holds more than `max_entries`, the least
+    recently used embeddings are evicted, down to `EVICT_TO` of it.
+    Uses of cached embeddings (`touch`) are recorded in memory, and
+    written with the next `put_many`, or once `TOUCH_EVERY` of them are
+    pending, rather than with a write transaction per hit.
+  """
+  EVICT_TO = 0.9
+  # Number of embeddings put between two checks of the size.
+  CHECK_EVERY = 1000
+  # Number of pending uses of embeddings that are written at once.
+  TOUCH_EVERY = 1000
+
+  def __init__(self, path, max_entries=1000000):
+    """
+      Args:
+        path (str): Path of the SQLite database
+        max_entries (int): Maximum number of embeddings kept
+    """
+    self._path = path
+    self._max_entries = max_entries
+    self._local = threading.local()
+    self._put_since_check = 0
+    self._used = dict()
+    self._used_lock = threading.Lock()
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    with self._connection() as connection:
+      connection.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                         "key BLOB PRIMARY KEY, vector BLOB NOT NULL, used_at REAL NOT NULL)")
+      connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+
+  def _connection(self):
+    # SQLite connections can neither be shared by threads nor be
+    # carried over to a forked child.
+    connection = getattr(self._local, "connection", None)
+    if connection is None or self._local.pid != os.getpid():
+      connection = sqlite3.connect(self._path, timeout=30)
+      connection.execute("PRAGMA journal_mode=WAL")
+      connection.execute("PRAGMA synchronous=NORMAL")
+      self._local.connection, self._local.pid = connection, os.getpid()
+    return connection
+
+  def __len__(self):
+    return self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+  def get(self, key):
+    """
+      Returns the embedding under `key`, or `None`.
+    """
+    row = self._connection().execute(
+        "SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+    if row is None:
+      return None
+    return np.frombuffer(row[0], dtype=np.float32)
+
+  def touch(self, keys):
+    """
+      Records that the embeddings under `keys` were used, so that they
+      are evicted last. The uses are written later, in a batch.
+    """
+    now = time.time()
+    with self._used_lock:
+      self._used.update((key, now) for key in keys)
+      flush = len(self._used) >= EmbeddingCache.TOUCH_EVERY
+    if flush:
+      self.put_many([])
+
+  def put_many(self, items):
+    """
+      Stores embeddings, and writes the pending uses of others, in a
+      single transaction.
+      Args:
+        items (iterable): `(key, vector)` pairs to store
+    """
+    now = time.time()
+    rows = [(key, np.ascontiguousarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items]
+    with self._used_lock:
+      used, self._used = self._used, dict()
+    if not rows and not used:
+      return
+    with self._connection() as connection:
+      connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+      connection.executemany("UPDATE embeddings SET used_at = ? WHERE key = ?",
+                             [(used_at, key) for key, used_at in used.items()])
+    self._put_since_check += len(rows)
+    if self._put_since_check >= EmbeddingCache.CHECK_EVERY:
+      self._put_since_check = 0
+      self.evict()
+
+  def evict(self):
+    """
+      Evicts the least recently used embeddings if there are too many.
+    """
+    excess = len(self) - self._max_entries
+    if excess <= 0:
+      return
+    # Not to evict embeddings whose recent uses are not written yet.
+    self.put_many([])
+    excess += int(self._max_entries * (1 - EmbeddingCache.EVICT_TO))
+    with self._connection() as connection:
+      connection.execute("DELETE FROM embeddings WHERE key IN ("
+                         "SELECT key FROM embeddings ORDER BY used_at LIMIT ?)", (excess,))
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+def get_embedding_cache(path, max_entries=1000000):
+  """
+    Returns the process-wide `EmbeddingCache` at `path`.
+  """
+  key = os.path.abspath(path)
+  with _caches_lock:
+    cache = _caches.get(key, None)
+    if cache is None:
+      cache = EmbeddingCache(path, max_entries)
+      _caches[key] = cache
+    return cache
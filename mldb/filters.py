@@ -0,0 +1,156 @@
+"""
+  Filters Module: Predicates restricting which items a search may return.
+  Filters are evaluated with NumPy over every row of a `Database` at
+  once, and the result is handed to faiss as an id selector, so that
+  searches return the closest items that pass them in a single pass.
+  The masks of filters that do not change from search to search (see
+  `Filter.key`) are kept in a `MaskCache` until the database changes.
+  Classes:
+    - Filter
+    - AttributeRange
+    - Exclude
+    - All
+    - MaskCache
+"""
+import collections
+import threading
+
+import numpy as np
+
+class Filter:
+  """
+    Base class of the filters.
+  """
+  @property
+  def key(self):
+    """
+      Hashable identity of the filter: filters with the same key pass
+      the same rows. `None` if the filter is not worth caching.
+    """
+    return None
+
+  def mask(self, keys, attributes, cache=None):
+    """
+      Evaluates the filter.
+      Args:
+        keys: `np.int64` array of the keys of the rows
+        attributes: `np.float32` matrix of the attributes of the rows
+        cache (MaskCache): Cache of the masks of the same rows
+      Returns:
+        A boolean `np.ndarray` telling which rows pass the filter. It
+        may be cached, and must not be modified
+    """
+    key = self.key
+    if cache is None or key is None:
+      return self._mask(keys, attributes, cache)
+    return cache.get_or_compute(key, lambda: self._mask(keys, attributes, cache))
+
+  def _mask(self, keys, attributes, cache):
+    raise NotImplementedError
+
+  def __and__(self, other):
+    return All(self, other)
+
+class AttributeRange(Filter):
+  """
+    Passes the rows whose attribute `attribute` lies in [low, high].
+    Either bound may be left out.
+  """
+  def __init__(self, attribute, low=None, high=None):
+    self.attribute = attribute
+    self.low = low
+    self.high = high
+
+  @property
+  def key(self):
+    return ("range", self.attribute, self.low, self.high)
+
+  def _mask(self, keys, attributes, cache):
+    values = attributes[:, self.attribute]
+    mask = np.ones(len(values), dtype=bool)
+    if self.low is not None:
+      mask &= values >= np.float32(self.low)
+    if self.high is not None:
+      mask &= values <= np.float32(self.high)
+    return mask
+
+class Exclude(Filter):
+  """
+    Passes the rows whose key is not in `keys`. Its mask is not cached
+    (exclusions are usually specific to a search), but with a cache,
+    the rows of the excluded keys are looked up rather than searched
+    for among all the keys.
+  """
+  def __init__(self, keys):
+    self.keys = np.fromiter((int(key) for key in keys), dtype=np.int64)
+
+  def _mask(self, keys, attributes, cache):
+    if cache is None:
+      return ~np.isin(keys, self.keys)
+    mask = np.ones(len(keys), dtype=bool)
+    rows = cache.rows(self.keys)
+    mask[rows[rows >= 0]] = False
+    return mask
+
+class All(Filter):
+  """
+    Passes the rows that pass every one of `filters`.
+  """
+  def __init__(self, *filters):
+    self.filters = filters
+
+  @property
+  def key(self):
+    keys = tuple(item.key for item in self.filters)
+    if None in keys:
+      return None
+    return ("all",) + keys
+
+  def _mask(self, keys, attributes, cache):
+    mask = np.ones(len(keys), dtype=bool)
+    for item in self.filters:
+      mask &= item.mask(keys, attributes, cache)
+    return mask
+
+class MaskCache:
+  """
+    Least recently used cache of masks (or of anything computed from
+    them, such as id selectors) over the rows of a
+    `mldb.keyindex.KeyIndex`. It is only valid for the `version` of the
+    key index it was created for.
+  """
+  def __init__(self, key_index, max_entries=32):
+    """
+      Args:
+        key_index (mldb.keyindex.KeyIndex): The rows the masks are of
+        max_entries (int): Maximum number of cached masks
+    """
+    self._key_index = key_index
+    self._max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.version = key_index.version
+
+  def get_or_compute(self, key, compute):
+    """
+      Returns the entry under `key`, computing (and caching) it first
+      if it is missing.
+    """
+    with self._lock:
+      value = self._entries.get(key, None)
+      if value is not None:
+        self._entries.move_to_end(key)
+        return value
+    value = compute()
+    with self._lock:
+      self._entries[key] = value
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+    return value
+
+  def rows(self, keys):
+    """
+      Returns the rows of the live `keys`, -1 for the other ones.
+    """
+    return np.fromiter((self._key_index.row(key, -1) for key in keys.tolist()),
+                       dtype=np.int64, count=len(keys))
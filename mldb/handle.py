@@ -0,0 +1,131 @@
+"""
+  Shared Database Handle Module: Keeps a database open across requests.
+  Classes:
+    - SharedDatabase
+  Functions:
+    - get_shared_database
+"""
+import logging
+import os
+import threading
+import time
+
+from mldb.database import Database
+
+logger = logging.getLogger(__name__)
+
+class SharedDatabase:
+  """
+    Long-lived, per-process handle to a `Database`.
+    The database is opened read-only, i.e. memory-mapped, so that
+    every process on a host shares one copy of the snapshot, and it
+    is shared by every caller. Changes written to disk by any process
+    are detected through a cheap `os.stat` of the manifest and of the
+    write-ahead log, and the database is then re-opened in a
+    background thread while readers keep using the old snapshot.
+  """
+  def __init__(self, db_path, vector_dim, check_interval=1.0, **options):
+    """
+      Args:
+        db_path (str): Path to database storage folder
+        vector_dim (int): Dimension of the vectors
+        check_interval (float): Minimum number of seconds between two
+                                checks for changes on disk
+        options: Keyword arguments of `Database`
+    """
+    self._db_path = db_path
+    self._vector_dim = vector_dim
+    self._options = options
+    self._check_interval = check_interval
+    database = Database(db_path, vector_dim)
+    self._paths = (database.manifest_path, database.wal_path)
+    self._lock = threading.Lock()
+    self._database = None
+    self._stamp = None
+    self._checked_at = 0.0
+    self._reloading = False
+
+  def _current_stamp(self):
+    stamp = []
+    for path in self._paths:
+      try:
+        stat = os.stat(path)
+        stamp.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+      except OSError:
+        stamp.append(None)
+    return tuple(stamp)
+
+  def _load(self):
+    stamp = self._current_stamp()
+    database = Database(self._db_path, self._vector_dim, **self._options)
+    database.open(read_only=True)
+    return stamp, database
+
+  def _reload_in_background(self):
+    try:
+      stamp, database = self._load()
+      with self._lock:
+        self._stamp, self._database = stamp, database
+    except Exception: # pylint: disable=broad-except
+      logger.exception("Reloading %s failed, serving the old snapshot", self._db_path)
+    finally:
+      self._reloading = False
+
+  def _after_fork(self):
+    # The reloading thread, if any, is not carried over to a child.
+    self._lock = threading.Lock()
+    self._reloading = False
+
+  def get(self):
+    """
+      Returns the current snapshot, opening the database on first use
+      and scheduling a reload if it has changed on disk.
+      The returned `Database` must not be modified.
+    """
+    database = self._database
+    if database is None:
+      with self._lock:
+        if self._database is None:
+          self._stamp, self._database = self._load()
+          self._checked_at = time.monotonic()
+        return self._database
+
+    now = time.monotonic()
+    if now - self._checked_at >= self._check_interval:
+      self._checked_at = now
+      if self._current_stamp() != self._stamp:
+        self.reload()
+    return database
+
+  def reload(self, wait=False):
+    """
+      Re-opens the database, swapping the snapshot once it is loaded.
+      Args:
+        wait (bool): Load in the calling thread instead of in the background
+    """
+    if wait:
+      stamp, database = self._load()
+      with self._lock:
+        self._stamp, self._database = stamp, database
+      return
+    with self._lock:
+      if self._reloading:
+        return
+      self._reloading = True
+    threading.Thread(target=self._reload_in_background, daemon=True).start()
+
+_handles = dict()
+_handles_lock = threading.Lock()
+
+def get_shared_database(db_path, vector_dim, check_interval=1.0, **options):
+  """
+    Returns the process-wide `SharedDatabase` for `db_path`.
+  """
+  key = os.path.normpath(db_path)
+  with _handles_lock:
+    handle = _handles.get(key, None)
+    if handle is None:
+      handle = SharedDatabase(db_path, vector_dim, check_interval, **options)
+      _handles[key] = handle
+      os.register_at_fork(after_in_child=handle._after_fork) # pylint: disable=protected-access
+    return handle
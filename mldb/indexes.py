@@ -0,0 +1,372 @@
+"""
+  Index Module: Builds the faiss indexes backing a `Database`.
+  Index types:
+    - flat: exact, brute-force search
+    - ivf_flat: inverted lists of full vectors
+    - ivf_pq: inverted lists of product-quantized vectors
+    - hnsw: hierarchical navigable small world graph
+  Storage types (of the vectors of flat, ivf_flat and hnsw indexes):
+    - float32: full vectors
+    - fp16: half-precision floats, half the memory
+    - sq8: 8-bit scalar quantization, a quarter of the memory
+  Classes:
+    - MappedFlatIndex
+  Functions:
+    - build_index
+    - flat_vectors
+    - id_selector
+    - index_type_of
+    - min_training_rows
+    - read_index
+    - search
+    - search_parameters
+    - selects_positions
+    - storage_of
+    - supports_remove
+    - widened_search
+"""
+import math
+
+import faiss
+import numpy as np
+
+FLAT = "flat"
+IVF_FLAT = "ivf_flat"
+IVF_PQ = "ivf_pq"
+HNSW = "hnsw"
+INDEX_TYPES = (FLAT, IVF_FLAT, IVF_PQ, HNSW)
+
+FLOAT32 = "float32"
+FP16 = "fp16"
+SQ8 = "sq8"
+STORAGE_TYPES = (FLOAT32, FP16, SQ8)
+_QUANTIZER_TYPES = {
+    FP16: faiss.ScalarQuantizer.QT_fp16,
+    SQ8: faiss.ScalarQuantizer.QT_8bit,
+}
+
+DEFAULT_HNSW_M = 32
+PQ_BITS = 8
+# An id selector is a bitmap (of one bit per id up to the largest key)
+# rather than a hash set of the selected keys if at least one id in
+# BITMAP_DENSITY is selected: the bitmap is then no larger than the
+# array of the keys.
+BITMAP_DENSITY = 64
+
+def _nlist(num_rows, nlist=None):
+  # Rule of thumb from the faiss wiki: ~4 * sqrt(N) lists, and at
+  # least 39 training points per list.
+  if nlist is None:
+    nlist = int(4 * math.sqrt(max(num_rows, 1)))
+  return max(1, min(nlist, num_rows // 39))
+
+def _pq_m(dim, pq_m=None):
+  # The number of sub-quantizers has to divide the dimension.
+  if pq_m is not None:
+    return pq_m
+  return max(m for m in range(1, min(dim, 16) + 1) if dim % m == 0)
+
+def min_training_rows(index_type, storage=FLOAT32):
+  """
+    Number of vectors needed to train an index of `index_type`.
+  """
+  if index_type == IVF_FLAT:
+    return 39
+  if index_type == IVF_PQ:
+    return 2 ** PQ_BITS
+  # 8-bit quantization learns the range of every component.
+  if storage == SQ8:
+    return 1
+  return 0
+
+def build_index(index_type, dim, training_vectors=None, storage=FLOAT32,
+                nlist=None, pq_m=None, hnsw_m=None, **_):
+  """
+    Builds an empty, trained index that stores vectors under their key.
+    Args:
+      index_type (str): One of `INDEX_TYPES`
+      dim (int): Dimension of the vectors
+      training_vectors: `np.float32` matrix to train IVF and 8-bit
+                        quantized indexes on
+      storage (str): One of `STORAGE_TYPES`. Quantized vectors are
+                     searched and reconstructed approximately. Ignored
+                     by ivf_pq indexes, which are quantized anyway
+      nlist (int): Number of inverted lists (IVF), chosen from the
+                   number of training vectors if not given
+      pq_m (int): Number of sub-quantizers (PQ)
+      hnsw_m (int): Number of neighbours per node (HNSW)
+    Returns:
+      A faiss index supporting `add_with_ids`, `reconstruct` by key
+      and `search`
+  """
+  if index_type not in INDEX_TYPES:
+    raise ValueError("Unknown index type: %s" % index_type)
+  if storage not in STORAGE_TYPES:
+    raise ValueError("Unknown storage type: %s" % storage)
+  if index_type == IVF_PQ:
+    storage = FLOAT32
+  num_rows = 0 if training_vectors is None else len(training_vectors)
+  if num_rows < min_training_rows(index_type, storage):
+    raise ValueError("%s (%s) needs at least %d vectors to be trained, got %d"
+                     % (index_type, storage, min_training_rows(index_type, storage), num_rows))
+  if index_type in (FLAT, HNSW):
+    if storage == FLOAT32 and index_type == FLAT:
+      index = faiss.IndexFlatL2(dim)
+    elif storage == FLOAT32:
+      index = faiss.IndexHNSWFlat(dim, hnsw_m or DEFAULT_HNSW_M)
+    elif index_type == FLAT:
+      index = faiss.IndexScalarQuantizer(dim, _QUANTIZER_TYPES[storage])
+    else:
+      index = faiss.IndexHNSWSQ(dim, _QUANTIZER_TYPES[storage], hnsw_m or DEFAULT_HNSW_M)
+    if not index.is_trained:
+      index.train(training_vectors)
+    return faiss.IndexIDMap2(index)
+  # IVF indexes.
+  nlist = _nlist(num_rows, nlist)
+  quantizer = faiss.IndexFlatL2(dim)
+  if index_type == IVF_FLAT and storage == FLOAT32:
+    index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+  elif index_type == IVF_FLAT:
+    index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, _QUANTIZER_TYPES[storage])
+  else:
+    index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m(dim, pq_m), PQ_BITS)
+  index.train(training_vectors)
+  # Keys are stored as the ids of the inverted lists; a hash table
+  # makes them usable for `reconstruct` and `remove_ids`.
+  index.set_direct_map_type(faiss.DirectMap.Hashtable)
+  return index
+
+def read_index(path, mmap=False):
+  """
+    Reads an index written by `faiss.write_index`.
+    Args:
+      path (str): Path of the index file
+      mmap (bool): Memory-map the vectors of the index, read-only,
+                   instead of reading them into memory, so that every
+                   process opening the file shares one copy of them in
+                   the page cache. The index must not be modified then,
+                   and the file must be replaced rather than overwritten.
+                   faiss releases before 1.8 cannot map the codes of
+                   flat and hnsw indexes: those are read into memory
+                   instead (flat, float32 ones are mapped by
+                   `MappedFlatIndex`)
+  """
+  if not mmap:
+    return faiss.read_index(path)
+  with open(path, "rb") as f:
+    fourcc = f.read(4)
+  if fourcc.startswith(b"Iw"):
+    # The inverted lists are mapped as on-disk inverted lists.
+    flags = faiss.IO_FLAG_MMAP
+  elif hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+    # The codes of flat indexes (and of the storage of hnsw ones).
+    flags = faiss.IO_FLAG_MMAP_IFC
+  else:
+    return faiss.read_index(path)
+  return faiss.read_index(path, flags | faiss.IO_FLAG_READ_ONLY)
+
+def flat_vectors(index):
+  """
+    Returns the `np.float32` matrix of the vectors of a flat, float32
+    index, by position, as a view of the index (or `None` for other
+    indexes).
+  """
+  index = faiss.downcast_index(index)
+  if isinstance(index, faiss.IndexIDMap):
+    index = faiss.downcast_index(index.index)
+  if not isinstance(index, faiss.IndexFlat) or storage_of(index) != FLOAT32:
+    return None
+  return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+class MappedFlatIndex:
+  """
+    Read-only flat, float32 index over a memory-mapped matrix of
+    vectors, searched exactly with `faiss.knn`. faiss releases before
+    1.8 cannot map the codes of their own flat indexes, so snapshots of
+    flat indexes keep the matrix of their vectors in their payload file
+    instead (see `mldb.payload`), which every process opening it shares
+    in the page cache.
+    It supports the calls `Database` makes of a read-only index, and
+    its id selectors select positions (see `search`).
+  """
+  def __init__(self, vectors, ids, order=None):
+    """
+      Args:
+        vectors: (ntotal, d) `np.float32` matrix of the vectors
+        ids: `np.int64` array of the ids of the vectors
+        order: Positions of `ids` sorted by id (computed if `None`)
+    """
+    self.vectors = vectors
+    self.ids = ids
+    self.order = np.argsort(ids, kind="stable") if order is None else order
+    self.ntotal, self.d = vectors.shape
+
+  def search(self, vectors, k, selector=None):
+    """
+      Searches like `faiss.Index.search`, among the positions selected
+      by `selector` (of `id_selector`) if given.
+    """
+    if selector is None:
+      distances, positions = faiss.knn(vectors, self.vectors, k)
+    else:
+      # Only the selected rows are compared, read in order.
+      selected = np.sort(selector.selected)
+      if not len(selected):
+        return (np.full((len(vectors), k), np.inf, dtype=np.float32),
+                np.full((len(vectors), k), -1, dtype=np.int64))
+      distances, positions = faiss.knn(vectors, self.vectors[selected], k)
+      positions = np.where(positions >= 0, selected[positions], -1)
+    ids = np.full_like(positions, -1)
+    found = positions >= 0
+    ids[found] = self.ids[positions[found]]
+    return distances, ids
+
+  def _positions(self, keys):
+    keys = np.asarray(keys, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(self.ids, keys, sorter=self.order), self.ntotal - 1)
+    positions = self.order[positions]
+    if not np.array_equal(self.ids[positions], keys):
+      raise RuntimeError("Some of the ids are not in the index")
+    return positions
+
+  def reconstruct(self, key):
+    return np.array(self.vectors[self._positions([key])[0]])
+
+  def reconstruct_batch(self, keys):
+    return self.vectors[self._positions(keys)]
+
+def index_type_of(index):
+  """
+    Returns which of `INDEX_TYPES` a (loaded) index is.
+  """
+  if isinstance(index, MappedFlatIndex):
+    return FLAT
+  index = faiss.downcast_index(index)
+  if isinstance(index, faiss.IndexIDMap2):
+    index = faiss.downcast_index(index.index)
+  if isinstance(index, faiss.IndexHNSW):
+    return HNSW
+  if isinstance(index, faiss.IndexIVFPQ):
+    return IVF_PQ
+  if isinstance(index, faiss.IndexIVF):
+    return IVF_FLAT
+  return FLAT
+
+def storage_of(index):
+  """
+    Returns which of `STORAGE_TYPES` the vectors of a (loaded) index
+    are stored as.
+  """
+  if isinstance(index, MappedFlatIndex):
+    return FLOAT32
+  index = faiss.downcast_index(index)
+  if isinstance(index, faiss.IndexIDMap2):
+    index = faiss.downcast_index(index.index)
+  if isinstance(index, faiss.IndexHNSW):
+    index = faiss.downcast_index(index.storage)
+  if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+    for storage, qtype in _QUANTIZER_TYPES.items():
+      if index.sq.qtype == qtype:
+        return storage
+  return FLOAT32
+
+def supports_remove(index_type):
+  return index_type != HNSW
+
+def id_selector(keys):
+  """
+    Returns a `faiss.IDSelector` selecting exactly `keys`.
+  """
+  keys = np.asarray(keys, dtype=np.int64)
+  if len(keys) and keys.min() >= 0 and keys.max() < BITMAP_DENSITY * len(keys):
+    members = np.zeros(int(keys.max()) + 1, dtype=bool)
+    members[keys] = True
+    bitmap = np.packbits(members, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+  else:
+    bitmap = keys
+    selector = faiss.IDSelectorBatch(len(keys), faiss.swig_ptr(keys))
+  # faiss does not copy the array, it has to outlive the selector.
+  selector.referenced_objects = [bitmap]
+  # For the indexes that are not searched by faiss.
+  selector.selected = keys
+  return selector
+
+def search_parameters(index_type, nprobe=None, ef_search=None, selector=None):
+  """
+    Returns the per-call `faiss.SearchParameters` for an index type,
+    or `None` if there is nothing to tune.
+    Args:
+      nprobe (int): Number of inverted lists to visit (IVF indexes)
+      ef_search (int): Size of the candidate list (HNSW indexes)
+      selector (faiss.IDSelector): Keys the search may return
+  """
+  if index_type in (IVF_FLAT, IVF_PQ) and (nprobe or selector):
+    params = faiss.SearchParametersIVF(sel=selector)
+    if nprobe:
+      params.nprobe = nprobe
+    return params
+  if index_type == HNSW and (ef_search or selector):
+    params = faiss.SearchParametersHNSW(sel=selector)
+    if ef_search:
+      params.efSearch = ef_search
+    return params
+  if selector is not None:
+    return faiss.SearchParameters(sel=selector)
+  return None
+
+def selects_positions(index):
+  """
+    Tells whether the id selectors given to `search` for `index` select
+    positions in it (the order its rows were added in) rather than ids.
+  """
+  return isinstance(index, MappedFlatIndex) or \
+         isinstance(faiss.downcast_index(index), faiss.IndexIDMap)
+
+def search(index, vectors, k, index_type=FLAT, nprobe=None, ef_search=None, selector=None):
+  """
+    Searches `index` with the per-call parameters of
+    `search_parameters`. The `IndexIDMap`s of faiss 1.7 reject them,
+    and are searched through the index they wrap instead, whose
+    results are mapped back to ids: `selector` then selects positions
+    (see `selects_positions`).
+    Returns:
+      The distances and ids of the results, as `faiss.Index.search`
+  """
+  if isinstance(index, MappedFlatIndex):
+    return index.search(vectors, k, selector)
+  params = search_parameters(index_type, nprobe=nprobe, ef_search=ef_search, selector=selector)
+  index = faiss.downcast_index(index)
+  if params is None or not isinstance(index, faiss.IndexIDMap):
+    return index.search(vectors, k, params=params)
+  distances, positions = faiss.downcast_index(index.index).search(vectors, k, params=params)
+  id_map = faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+  ids = np.full_like(positions, -1)
+  found = positions >= 0
+  ids[found] = id_map[positions[found]]
+  return distances, ids
+
+def widened_search(index, index_type, nprobe=None, ef_search=None):
+  """
+    Returns the search parameters of a wider search than one with
+    `nprobe` and `ef_search` (the defaults of the index if `None`):
+    twice as many inverted lists or candidates. Filtered IVF and HNSW
+    searches may find less than the asked number of results, which
+    wider ones do.
+    Returns:
+      A `(nprobe, ef_search)` tuple, or `None` if the search is already
+      exhaustive
+  """
+  if index_type in (IVF_FLAT, IVF_PQ):
+    ivf = faiss.extract_index_ivf(index)
+    nprobe = nprobe or ivf.nprobe
+    if nprobe >= ivf.nlist:
+      return None
+    return min(2 * nprobe, ivf.nlist), ef_search
+  if index_type == HNSW:
+    hnsw = faiss.downcast_index(faiss.downcast_index(index).index)
+    ef_search = ef_search or hnsw.hnsw.efSearch
+    if ef_search >= index.ntotal:
+      return None
+    return nprobe, min(2 * ef_search, index.ntotal)
+  return None
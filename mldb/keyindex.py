@@ -0,0 +1,297 @@
+"""
+  Key Index Module: Maps integer keys to the rows of an index and back.
+  Classes:
+    - KeyIndex
+"""
+import numpy as np
+
+class KeyIndex:
+  """
+    Compact, bidirectional key <-> row mapping with tombstones.
+    row -> key is a growable `np.int64` array (amortised doubling) and
+    key -> row is a dict of the live keys. Removing a key only records
+    a tombstone, so rows never move until `compact` drops the dead
+    ones (keeping the order of the others, as `faiss` does).
+    A removed key that is appended again gets a new row, and its old
+    one is kept, dead, as a superseded row until it is dropped.
+    Every row may also carry a few `np.float32` attributes, stored in
+    a matrix aligned with the keys, that searches can be filtered on.
+    Read-only (e.g. memory-mapped) arrays of keys and attributes are
+    used as they are, and only copied once rows are added or dropped.
+    Given the order of such keys, they are looked up by bisection
+    instead of in a dict, which then only holds the keys added since.
+  """
+  MIN_CAPACITY = 16
+
+  def __init__(self, keys=None, tombstones=None, attributes=None, num_attributes=0, order=None):
+    """
+      Args:
+        keys (iterable(int)): Keys of the existing rows, in row order
+        tombstones (iterable(int)): Keys of the rows that are removed
+        attributes: `np.float32` matrix of the attributes of the
+                    existing rows, of shape (len(keys), num_attributes)
+        num_attributes (int): Number of attributes per row
+        order: `np.int64` array of the rows sorted by key, used (with
+               read-only keys) to look the keys up
+    """
+    keys = np.asarray([] if keys is None else keys, dtype=np.int64)
+    self._size = len(keys)
+    if attributes is None:
+      attributes = np.zeros((self._size, num_attributes), dtype=np.float32)
+    attributes = np.asarray(attributes, dtype=np.float32)
+    # Rows of the sorted keys, and how many rows they cover.
+    self._order, self._sorted = None, 0
+    if keys.flags.writeable or (attributes.size and attributes.flags.writeable):
+      self._keys, self._attributes = self._grown(keys, attributes, self._size)
+    else:
+      self._keys, self._attributes = keys, attributes
+      if order is not None:
+        self._order, self._sorted = np.asarray(order, dtype=np.int64), self._size
+    self._tombstones = set(np.asarray([] if tombstones is None else tombstones,
+                                      dtype=np.int64).tolist())
+    self._superseded = set()
+    self._version = 0
+    self._rebuild()
+
+  @staticmethod
+  def _grown(keys, attributes, size, capacity=0):
+    # Copies of the first `size` rows, with room for at least `capacity`.
+    capacity = max(capacity, size, KeyIndex.MIN_CAPACITY)
+    grown_keys = np.empty(capacity, dtype=np.int64)
+    grown_keys[:size] = keys[:size]
+    grown_attributes = np.zeros((capacity, attributes.shape[1]), dtype=np.float32)
+    grown_attributes[:size] = attributes[:size]
+    return grown_keys, grown_attributes
+
+  def _rebuild(self):
+    start = self._sorted
+    self._rows = dict(zip(self._keys[start:self._size].tolist(), range(start, self._size)))
+    for key in self._tombstones:
+      self._rows.pop(key, None)
+
+  def _sorted_row(self, key):
+    # Row of `key` among the sorted keys, tombstoned or not.
+    if not self._sorted:
+      return None
+    position = int(np.searchsorted(self._keys[:self._sorted], key, sorter=self._order))
+    if position < self._sorted and self._keys[self._order[position]] == key:
+      return int(self._order[position])
+    return None
+
+  def __len__(self):
+    """
+      Number of live keys.
+    """
+    if self._sorted:
+      return self._size - self.dead
+    return len(self._rows)
+
+  def __contains__(self, key):
+    return self.row(key) is not None
+
+  def contains_many(self, keys):
+    """
+      Returns a boolean `np.ndarray` telling which of `keys` are live,
+      looking the sorted keys up with a single bisection of all of them.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    found = np.zeros(len(keys), dtype=bool)
+    if self._sorted and len(keys):
+      positions = np.searchsorted(self._keys[:self._sorted], keys, sorter=self._order)
+      rows = self._order[np.minimum(positions, self._sorted - 1)]
+      found = self._keys[rows] == keys
+      if self._tombstones:
+        found &= ~np.isin(keys, np.fromiter(self._tombstones, dtype=np.int64,
+                                            count=len(self._tombstones)))
+    if self._rows:
+      found |= np.fromiter(map(self._rows.__contains__, keys.tolist()), dtype=bool, count=len(keys))
+    return found
+
+  @property
+  def total(self):
+    """
+      Number of rows, including the removed ones.
+    """
+    return self._size
+
+  @property
+  def version(self):
+    """
+      Number of changes (appends, removals, compactions) made so far.
+    """
+    return self._version
+
+  @property
+  def dead(self):
+    """
+      Number of dead rows: those of the tombstones and the superseded ones.
+    """
+    return len(self._tombstones) + len(self._superseded)
+
+  @property
+  def num_attributes(self):
+    return self._attributes.shape[1]
+
+  @property
+  def keys(self):
+    """
+      `np.int64` array of keys, indexed by row, including the removed
+      ones. It is a view and must not be modified.
+    """
+    return self._keys[:self._size]
+
+  @property
+  def attributes(self):
+    """
+      `np.float32` matrix of attributes, indexed by row, including the
+      removed ones. It is a view and must not be modified.
+    """
+    return self._attributes[:self._size]
+
+  @property
+  def live_keys(self):
+    """
+      `np.int64` array of the live keys, in row order.
+    """
+    keys = self._keys[:self._size]
+    if not self.dead:
+      return keys.copy()
+    return keys[self.live_mask()]
+
+  def live_mask(self):
+    """
+      Boolean `np.ndarray` telling which rows are live.
+    """
+    mask = ~np.isin(self._keys[:self._size],
+                    np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones)))
+    mask[np.fromiter(self._superseded, dtype=np.int64, count=len(self._superseded))] = False
+    return mask
+
+  @property
+  def tombstones(self):
+    """
+      Set of the removed keys that still have a row.
+    """
+    return self._tombstones
+
+  @property
+  def superseded(self):
+    """
+      Set of the dead rows of keys that were appended again since.
+    """
+    return self._superseded
+
+  def is_tombstoned(self, key):
+    return int(key) in self._tombstones
+
+  def row(self, key, default=None):
+    """
+      Returns the row of the live `key`, or `default` if it is not present.
+    """
+    key = int(key)
+    row = self._rows.get(key, None)
+    if row is None and key not in self._tombstones:
+      row = self._sorted_row(key)
+    return default if row is None else row
+
+  def key(self, row):
+    return int(self._keys[row])
+
+  def add(self, key, attributes=None):
+    """
+      Appends `key` as the last row. The key must not have a row.
+      Returns:
+        The row of the key
+    """
+    if attributes is not None:
+      attributes = np.asarray(attributes, dtype=np.float32).reshape(1, -1)
+    return self.extend([key], attributes)
+
+  def extend(self, keys, attributes=None):
+    """
+      Appends `keys` as the last rows. None of them may be live; the
+      rows of the removed ones are superseded by the new ones.
+      Args:
+        keys (iterable(int)): Keys to append
+        attributes: `np.float32` matrix of their attributes
+      Returns:
+        The row of the first key
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    start, end = self._size, self._size + len(keys)
+    if end > len(self._keys) or not self._keys.flags.writeable:
+      capacity = max(len(self._keys), KeyIndex.MIN_CAPACITY)
+      while capacity < end:
+        capacity *= 2
+      self._keys, self._attributes = self._grown(self._keys, self._attributes, start, capacity)
+    self._keys[start:end] = keys
+    if attributes is not None:
+      self._attributes[start:end] = attributes
+    revived = self._tombstones.intersection(keys.tolist())
+    if revived:
+      self._superseded.update(self._dead_rows(revived, start))
+      self._tombstones.difference_update(revived)
+    self._rows.update(zip(keys.tolist(), range(start, end)))
+    self._size = end
+    self._version += 1
+    return start
+
+  def remove(self, key):
+    """
+      Records a tombstone for `key`.
+      Returns:
+        `True` if the key was live, `False` if not.
+    """
+    key = int(key)
+    if self._rows.pop(key, None) is None and \
+       (key in self._tombstones or self._sorted_row(key) is None):
+      return False
+    self._tombstones.add(key)
+    self._version += 1
+    return True
+
+  def _dead_rows(self, keys, size):
+    # The last rows, among the first `size`, of the tombstoned `keys`.
+    keys = np.fromiter(keys, dtype=np.int64, count=len(keys))
+    rows = np.flatnonzero(np.isin(self._keys[:size], keys))
+    return set(dict(zip(self._keys[rows].tolist(), rows.tolist())).values())
+
+  def drop(self, keys):
+    """
+      Drops the rows of the removed `keys` (keeping the order of the
+      other rows, as `faiss.Index.remove_ids` does).
+      Returns:
+        A boolean `np.ndarray` telling, for every row before, whether
+        it was kept
+    """
+    keys = np.asarray([key for key in np.asarray(keys, dtype=np.int64).tolist()
+                       if key in self._tombstones], dtype=np.int64)
+    keep = ~np.isin(self._keys[:self._size], keys)
+    self._tombstones.difference_update(keys.tolist())
+    return self._drop_rows(keep)
+
+  def compact(self):
+    """
+      Drops the rows of the removed keys.
+      Returns:
+        A boolean `np.ndarray` telling, for every row before compaction,
+        whether it was kept
+    """
+    keep = self.live_mask()
+    self._tombstones = set()
+    return self._drop_rows(keep)
+
+  def _drop_rows(self, keep):
+    if not self._keys.flags.writeable:
+      self._keys, self._attributes = self._grown(self._keys, self._attributes, self._size)
+    kept = self._keys[:self._size][keep]
+    self._attributes[:len(kept)] = self._attributes[:self._size][keep]
+    # Superseded rows that are kept move up with the others.
+    rows = np.cumsum(keep) - 1
+    self._superseded = set(int(rows[row]) for row in self._superseded if keep[row])
+    self._size = len(kept)
+    self._keys[:self._size] = kept
+    self._order, self._sorted = None, 0
+    self._version += 1
+    self._rebuild()
+    return keep
@@ -0,0 +1,199 @@
+"""
+  Metrics Module: Opt-in timers and counters of mldb operations.
+  Nothing is measured until a sink is added, and timers then cost a
+  couple of `time.perf_counter` calls.
+  Classes:
+    - Sink
+    - LogSink
+    - HistogramSink
+  Functions:
+    - add_sink
+    - remove_sink
+    - get_sinks
+    - enabled
+    - count
+    - timing
+    - timer
+    - timed
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+
+class Sink:
+  """
+    Receives the measurements. Sinks are called from every thread that
+    measures something, so they must be thread-safe.
+  """
+  def timing(self, name, seconds):
+    """
+      Records that the operation `name` took `seconds`.
+    """
+
+  def count(self, name, value):
+    """
+      Adds `value` to the counter `name`.
+    """
+
+class LogSink(Sink):
+  """
+    Logs every measurement.
+  """
+  def __init__(self, logger=None, level=logging.DEBUG):
+    """
+      Args:
+        logger (logging.Logger): Logger to log to, the one of this
+                                 module by default
+        level (int): Level to log at
+    """
+    self._logger = logger or logging.getLogger(__name__)
+    self._level = level
+
+  def timing(self, name, seconds):
+    self._logger.log(self._level, "%s: %.3fms", name, seconds * 1000)
+
+  def count(self, name, value):
+    self._logger.log(self._level, "%s: +%s", name, value)
+
+class HistogramSink(Sink):
+  """
+    Keeps counters, and histograms of timings in buckets growing by a
+    factor of 2 from 1µs, from which percentiles are estimated (as the
+    upper bound of their bucket).
+  """
+  BOUNDS = tuple(1e-6 * 2 ** i for i in range(28))
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._timers = dict()
+    self._counters = dict()
+
+  def timing(self, name, seconds):
+    with self._lock:
+      timer = self._timers.get(name, None)
+      if timer is None:
+        timer = self._timers[name] = {
+            "count": 0, "total": 0.0, "min": seconds, "max": seconds,
+            "buckets": [0] * (len(HistogramSink.BOUNDS) + 1)}
+      timer["count"] += 1
+      timer["total"] += seconds
+      timer["min"] = min(timer["min"], seconds)
+      timer["max"] = max(timer["max"], seconds)
+      timer["buckets"][bisect.bisect_left(HistogramSink.BOUNDS, seconds)] += 1
+
+  def count(self, name, value):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  @staticmethod
+  def _percentile(timer, fraction):
+    rank = fraction * timer["count"]
+    seen = 0
+    for bucket, size in enumerate(timer["buckets"]):
+      seen += size
+      if seen >= rank and size:
+        if bucket == len(HistogramSink.BOUNDS):
+          return timer["max"]
+        return min(HistogramSink.BOUNDS[bucket], timer["max"])
+    return timer["max"]
+
+  def snapshot(self):
+    """
+      Returns:
+        A dict of the `timers` (count, total, mean, min, max, p50, p90
+        and p99 in seconds) and of the `counters`, by name
+    """
+    with self._lock:
+      timers = {
+          name: {
+              "count": timer["count"],
+              "total": timer["total"],
+              "mean": timer["total"] / timer["count"],
+              "min": timer["min"],
+              "max": timer["max"],
+              "p50": HistogramSink._percentile(timer, 0.5),
+              "p90": HistogramSink._percentile(timer, 0.9),
+              "p99": HistogramSink._percentile(timer, 0.99),
+          }
+          for name, timer in self._timers.items()
+      }
+      return {"timers": timers, "counters": dict(self._counters)}
+
+  def reset(self):
+    with self._lock:
+      self._timers.clear()
+      self._counters.clear()
+
+# Replaced rather than modified, so that it is read without a lock.
+_sinks = ()
+_sinks_lock = threading.Lock()
+
+def add_sink(sink):
+  global _sinks
+  with _sinks_lock:
+    _sinks = _sinks + (sink,)
+
+def remove_sink(sink):
+  global _sinks
+  with _sinks_lock:
+    _sinks = tuple(added for added in _sinks if added is not sink)
+
+def get_sinks():
+  return _sinks
+
+def enabled():
+  return bool(_sinks)
+
+def timing(name, seconds):
+  for sink in _sinks:
+    sink.timing(name, seconds)
+
+def count(name, value=1):
+  for sink in _sinks:
+    sink.count(name, value)
+
+class _Timer:
+  def __init__(self, name):
+    self._name = name
+    self._start = None
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *_):
+    timing(self._name, time.perf_counter() - self._start)
+
+class _NullTimer:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    pass
+
+_NULL_TIMER = _NullTimer()
+
+def timer(name):
+  """
+    Returns a context manager timing its block as `name`.
+  """
+  return _Timer(name) if _sinks else _NULL_TIMER
+
+def timed(name):
+  """
+    Decorator timing every call of a function as `name`.
+  """
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not _sinks:
+        return function(*args, **kwargs)
+      start = time.perf_counter()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        timing(name, time.perf_counter() - start)
+    return wrapper
+  return decorator
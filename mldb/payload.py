@@ -0,0 +1,122 @@
+"""
+  Payload Module: Single-file format of the keys, tombstones,
+  attributes and (for flat, float32 indexes) vectors of a snapshot.
+  The vectors of other indexes are in their faiss index file.
+  A payload file is a 64 byte header followed by fixed-width columns
+  that are read without copies through a memory map:
+    - the `np.int64` keys, by row
+    - the `np.int64` order of the keys (the rows sorted by key), for
+      keys to be looked up without building a dict of them
+    - the `np.int64` tombstones
+    - the `np.float32` attributes, a (count, num_attributes) matrix
+    - the `np.float32` vectors, a (count, vector_dim) matrix, if any
+  The header holds the format version, the generation of the snapshot,
+  the dimension of its vectors, the sizes of the columns, a CRC32 of
+  them and whether the vectors are stored. Version 1 files, which
+  never store the vectors, are read as well.
+  Classes:
+    - Payload
+  Functions:
+    - is_payload
+    - read_payload
+    - write_payload
+"""
+import collections
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"MLDBPAYL"
+VERSION = 2
+# magic, version, generation, vector_dim, count, dead, num_attributes,
+# checksum, has_vectors (added by version 2, in what used to be padding)
+HEADER = struct.Struct("<8sIQIQQIII")
+HEADER_SIZE = 64
+
+Payload = collections.namedtuple(
+    "Payload", ["generation", "vector_dim", "keys", "order", "tombstones", "attributes", "vectors"])
+
+def is_payload(path):
+  """
+    Tells whether the file at `path` is a payload file (rather than
+    one of the `np.save`d arrays older snapshots were made of).
+  """
+  with open(path, "rb") as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+def write_payload(path, generation, vector_dim, keys, tombstones=None, attributes=None,
+                  vectors=None):
+  """
+    Writes a payload file.
+    Args:
+      path (str): Path of the file
+      generation (int): Generation of the snapshot
+      vector_dim (int): Dimension of the vectors of the snapshot
+      keys: `np.int64` array of the keys, by row
+      tombstones: `np.int64` array of the removed keys
+      attributes: `np.float32` matrix of the attributes, by row
+      vectors: `np.float32` matrix of the vectors, by row, to store
+               (`None` if they are stored in an index file)
+  """
+  keys = np.ascontiguousarray(keys, dtype=np.int64)
+  tombstones = np.ascontiguousarray([] if tombstones is None else tombstones, dtype=np.int64)
+  if attributes is None:
+    attributes = np.zeros((len(keys), 0), dtype=np.float32)
+  attributes = np.ascontiguousarray(attributes, dtype=np.float32)
+  columns = [keys, np.argsort(keys, kind="stable").astype(np.int64), tombstones, attributes]
+  if vectors is not None:
+    columns.append(np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(keys), vector_dim))
+  checksum = 0
+  for column in columns:
+    checksum = zlib.crc32(column, checksum)
+  header = HEADER.pack(MAGIC, VERSION, generation, vector_dim, len(keys),
+                       len(tombstones), attributes.shape[1], checksum, vectors is not None)
+  with open(path, "wb") as f:
+    f.write(header.ljust(HEADER_SIZE, b"\0"))
+    for column in columns:
+      column.tofile(f)
+
+def read_payload(path, mmap=False):
+  """
+    Reads a payload file.
+    Args:
+      path (str): Path of the file
+      mmap (bool): Memory-map the file, read-only, instead of reading
+                   it: the columns are then views of the map, and the
+                   checksum is not verified (it would read every page)
+    Returns:
+      A `Payload`
+    Raises:
+      ValueError: If the file is not a payload file, is of a newer
+                  version, or is corrupted
+  """
+  if mmap:
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+  else:
+    data = np.fromfile(path, dtype=np.uint8)
+  if len(data) < HEADER_SIZE:
+    raise ValueError("%s is not an mldb payload file" % path)
+  magic, version, generation, vector_dim, count, dead, num_attributes, checksum, has_vectors = \
+      HEADER.unpack(data[:HEADER.size].tobytes())
+  if magic != MAGIC:
+    raise ValueError("%s is not an mldb payload file" % path)
+  if version > VERSION:
+    raise ValueError("%s is of version %d, only versions up to %d are supported"
+                     % (path, version, VERSION))
+  sizes = [8 * count, 8 * count, 8 * dead, 4 * count * num_attributes]
+  if has_vectors:
+    sizes.append(4 * count * vector_dim)
+  if len(data) != HEADER_SIZE + sum(sizes):
+    raise ValueError("%s is truncated" % path)
+  body = data[HEADER_SIZE:]
+  if not mmap and zlib.crc32(body) != checksum:
+    raise ValueError("%s is corrupted (checksum mismatch)" % path)
+  columns, offset = [], 0
+  for size in sizes:
+    columns.append(body[offset:offset + size])
+    offset += size
+  keys, order, tombstones = (column.view(np.int64) for column in columns[:3])
+  attributes = columns[3].view(np.float32).reshape(count, num_attributes)
+  vectors = columns[4].view(np.float32).reshape(count, vector_dim) if has_vectors else None
+  return Payload(generation, vector_dim, keys, order, tombstones, attributes, vectors)
@@ -0,0 +1,100 @@
+"""
+  Model Registry Module: Loads spaCy models once per process.
+  Classes:
+    - ModelRegistry
+  Functions:
+    - get_model
+    - get_dimension
+"""
+import threading
+
+import spacy
+
+import mldb.metrics as metrics
+
+DEFAULT_MODEL = "en_core_web_sm"
+# Pipeline components that produce `doc.tensor`, which `doc.vector`
+# is computed from when the model has no static word vectors.
+VECTOR_COMPONENTS = ("tok2vec", "tensorizer", "tagger")
+# Components of the spaCy (v2) pipelines that do not contribute to
+# `doc.tensor`. Lean models are loaded without them.
+LEAN_DISABLE = ("parser", "ner", "textcat", "entity_linker", "entity_ruler", "sentencizer",
+                "merge_noun_chunks", "merge_entities", "merge_subtokens")
+
+class ModelRegistry:
+  """
+    Thread-safe, lazily-initialised registry of spaCy models.
+    Each named model is loaded at most once per process (and mode),
+    together with the size of the vectors it produces, so that callers
+    can learn the dimension without running the model again.
+    A lean model only has the components needed for `doc.vector` (see
+    `VECTOR_COMPONENTS`): it loads faster, takes less memory and runs
+    faster, and its `doc.vector`s are the same as the full model's.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._model_locks = dict()
+    self._models = dict()
+    self._dimensions = dict()
+
+  def _model_lock(self, model_name):
+    with self._lock:
+      return self._model_locks.setdefault(model_name, threading.Lock())
+
+  @staticmethod
+  def _load(model_name, lean):
+    if not lean:
+      return spacy.load(model_name)
+    model = spacy.load(model_name, disable=LEAN_DISABLE)
+    # Components unknown to `LEAN_DISABLE` are loaded, but not run.
+    for name in model.pipe_names:
+      if name not in VECTOR_COMPONENTS:
+        model.remove_pipe(name)
+    return model
+
+  def get(self, model_name=DEFAULT_MODEL, lean=False):
+    """
+      Returns the loaded spaCy model, loading it on first use.
+      Args:
+        model_name (str): Name of the spaCy model
+        lean (bool): Load only the components needed for `doc.vector`
+      Returns:
+        The `spacy.language.Language` object for `model_name`
+    """
+    key = (model_name, lean)
+    model = self._models.get(key, None)
+    if model is not None:
+      return model
+    # Only callers asking for the same model wait on each other.
+    with self._model_lock(key):
+      model = self._models.get(key, None)
+      if model is None:
+        with metrics.timer("mldb.registry.load"):
+          model = ModelRegistry._load(model_name, lean)
+        self._dimensions[key] = model("NA").vector.size
+        self._models[key] = model
+    return model
+
+  def dimension(self, model_name=DEFAULT_MODEL, lean=False):
+    """
+      Returns the size of the document vectors produced by the model.
+      Args:
+        model_name (str): Name of the spaCy model
+        lean (bool): See `get`
+      Returns:
+        `int` size of `doc.vector`
+    """
+    if (model_name, lean) not in self._dimensions:
+      self.get(model_name, lean)
+    return self._dimensions[(model_name, lean)]
+
+  def is_loaded(self, model_name=DEFAULT_MODEL, lean=False):
+    return (model_name, lean) in self._models
+
+_registry = ModelRegistry()
+
+def get_model(model_name=DEFAULT_MODEL, lean=False):
+  return _registry.get(model_name, lean)
+
+def get_dimension(model_name=DEFAULT_MODEL, lean=False):
+  return _registry.dimension(model_name, lean)
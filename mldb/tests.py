@@ -0,0 +1,655 @@
+"""
+  Tests of the mldb modules. Run with `python manage.py test mldb`
+  (or `python -m unittest mldb.tests`).
+"""
+import collections
+import concurrent.futures
+import datetime
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+from unittest import mock
+
+import faiss
+import numpy as np
+import spacy
+
+import mldb.backends as backends
+import mldb.embeddings as embeddings
+import mldb.filters as filters
+import mldb.indexes as indexes
+import mldb.payload as payload
+import mldb.registry as registry
+from mldb.cache import ResultCache
+from mldb.database import Database
+from mldb.handle import SharedDatabase
+from mldb.handle import get_shared_database
+from mldb.vectorizer import Vectorizer
+from mldb.vectorstore import VectorStore
+from mldb.wal import WriteAheadLog
+
+DIM = 8
+
+def _vectors(count, seed=0):
+  return np.random.RandomState(seed).rand(count, DIM).astype(np.float32)
+
+def _clustered_vectors(count, seed=0):
+  # Points around a few centers, as embeddings are, rather than spread
+  # evenly: quantization keeps their neighbours apart.
+  random = np.random.RandomState(seed)
+  centers = random.rand(16, DIM)
+  vectors = centers[random.randint(16, size=count)] + 0.05 * random.randn(count, DIM)
+  return vectors.astype(np.float32)
+
+def _put_vectors(path, keys, vectors):
+  VectorStore(path, DIM).put_many(keys, vectors)
+
+class DatabaseTestCase(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "db")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def database(self, read_only=False, **options):
+    db = Database(self.path, DIM, **options)
+    db.open(read_only=read_only)
+    return db
+
+class KeyTest(DatabaseTestCase):
+  def test_remove_by_key_leaves_the_index_untouched(self):
+    db = self.database()
+    db.insert_many(range(1000), _vectors(1000))
+    db.remove_by_key(10)
+    self.assertEqual(db._index.ntotal, 1000)
+    self.assertNotIn(10, db)
+    self.assertNotIn(10, db.nearest(_vectors(1000)[10], 5))
+
+  def _write_legacy(self, keys):
+    os.makedirs(self.path)
+    index = faiss.IndexFlatL2(DIM)
+    index.add(_vectors(len(keys)))
+    faiss.write_index(index, os.path.join(self.path, "db.index"))
+    with open(os.path.join(self.path, "db.payload"), "wb") as f:
+      np.save(f, np.asarray(keys))
+
+  def test_legacy_string_keys_are_converted(self):
+    self._write_legacy(["3", "5"])
+    db = self.database()
+    self.assertIn(3, db)
+    self.assertIn(5, db)
+    np.testing.assert_allclose(db.search_vector(5), _vectors(2)[1])
+    self.assertEqual(db.nearest(_vectors(2)[0]), [3])
+
+  def test_legacy_non_integer_keys_are_rejected(self):
+    self._write_legacy(["3", "org-5"])
+    with self.assertRaisesRegex(ValueError, "'org-5'"):
+      self.database()
+
+class WriteAheadLogTest(DatabaseTestCase):
+  def test_replay_streams_records_and_ignores_a_torn_tail(self):
+    wal = WriteAheadLog(os.path.join(self.directory, "test.wal"))
+    vectors = _vectors(100)
+    for key, vector in enumerate(vectors):
+      wal.append_insert(key, vector)
+    inserted_size = wal.size
+    wal.append_remove(7)
+    wal.close()
+    os.truncate(wal.path, wal.size - 1)
+    original_read_size = WriteAheadLog.READ_SIZE
+    WriteAheadLog.READ_SIZE = 64
+    try:
+      records = list(wal.replay())
+    finally:
+      WriteAheadLog.READ_SIZE = original_read_size
+    self.assertEqual(len(records), 100)
+    for key, (operation, record_key, vector, _) in enumerate(records):
+      self.assertEqual((operation, record_key), (WriteAheadLog.INSERT, key))
+      np.testing.assert_array_equal(vector, vectors[key])
+    self.assertEqual(records[-1][3], inserted_size)
+
+  def test_open_replays_the_log(self):
+    db = self.database()
+    db.insert_many(range(10), _vectors(10))
+    db.remove_by_key(3)
+    db.commit()
+    db = self.database()
+    self.assertEqual(len(db._keys), 9)
+    self.assertNotIn(3, db)
+    np.testing.assert_array_equal(db.search_vector(9), _vectors(10)[9])
+
+  def test_insert_many_is_logged_in_batches_and_synced_once(self):
+    db = self.database()
+    vectors = _vectors(10000)
+    with mock.patch("mldb.wal.os.fsync") as fsync:
+      db.insert_many(range(10000), vectors)
+    self.assertEqual(fsync.call_count, 1)
+    records = list(db._wal.replay())
+    self.assertEqual([operation for operation, _, _, _ in records],
+                     [WriteAheadLog.GENERATION] + [WriteAheadLog.INSERT_MANY] * 3)
+    db = self.database()
+    self.assertEqual(len(db._keys), 10000)
+    np.testing.assert_array_equal(db.search_vector(9999), vectors[9999])
+
+class ContainsManyTest(DatabaseTestCase):
+  def test_contains_many_matches_contains(self):
+    db = self.database()
+    db.insert_many(range(0, 200, 2), _vectors(100))
+    db.write()
+    db.remove_by_key(10)
+    db.remove_by_key(12)
+    db.insert_many([12, 301], _vectors(2))
+    reader = self.database(read_only=True)
+    keys = np.arange(-5, 310)
+    with mock.patch.object(np, "searchsorted", wraps=np.searchsorted) as searchsorted:
+      found = reader._keys.contains_many(keys)
+    self.assertEqual(searchsorted.call_count, 1)
+    self.assertEqual(found.tolist(), [int(key) in reader._keys for key in keys])
+    self.assertEqual(db._keys.contains_many(keys).tolist(), found.tolist())
+
+class ReinsertTest(DatabaseTestCase):
+  def test_read_only_replay_of_remove_then_insert(self):
+    db = self.database()
+    vectors = _vectors(101)
+    db.insert_many(range(100), vectors[:100])
+    db.write()
+    db.remove_by_key(7)
+    db.insert(7, vectors[100])
+    reader = self.database(read_only=True)
+    self.assertIn(7, reader)
+    np.testing.assert_array_equal(reader.search_vector(7), vectors[100])
+    self.assertEqual(reader.nearest(vectors[100], 3), db.nearest(vectors[100], 3))
+    self.assertEqual(reader.nearest(vectors[7], 100).count(7), 1)
+    self.assertEqual(len(reader._keys), 100)
+
+  def test_reinsert_replaces_in_place(self):
+    db = self.database()
+    vectors = _vectors(101)
+    db.insert_many(range(100), vectors[:100])
+    db.remove_by_key(3)
+    db.remove_by_key(7)
+    db.insert(7, vectors[100])
+    self.assertEqual(db._index.ntotal, 100)
+    self.assertEqual(db._keys.tombstones, {3})
+    np.testing.assert_array_equal(db.search_vector(7), vectors[100])
+    self.assertEqual(db.nearest(vectors[100]), [7])
+
+  def test_ivf_reinsert_replaces_in_place(self):
+    for index_type in (indexes.IVF_FLAT, indexes.IVF_PQ):
+      with self.subTest(index_type=index_type):
+        shutil.rmtree(self.path, ignore_errors=True)
+        db = self.database(index_type=index_type, promote_at=0, index_options={"nlist": 4})
+        vectors = _vectors(1001)
+        db.insert_many(range(1000), vectors[:1000])
+        db.write()
+        self.assertEqual(db.index_type, index_type)
+        db.remove_by_key(7)
+        db.insert(7, vectors[1000])
+        self.assertEqual((db._index.ntotal, db._keys.dead), (1000, 0))
+        self.assertEqual(db.nearest(vectors[1000]), [7])
+        reader = self.database(read_only=True)
+        self.assertEqual(reader.nearest(vectors[1000]), [7])
+
+  def test_hnsw_reinsert_supersedes_the_old_row(self):
+    db = self.database(index_type=indexes.HNSW, promote_at=0)
+    vectors = _vectors(201)
+    db.insert_many(range(200), vectors[:200])
+    db.write()
+    db.remove_by_key(7)
+    db.insert(7, vectors[200])
+    self.assertEqual(db._index.ntotal, 201)
+    self.assertEqual(db.nearest(vectors[200]), [7])
+    self.assertEqual(db.nearest(vectors[7], 200).count(7), 1)
+    db.write()
+    self.assertEqual((db._index.ntotal, db._keys.dead), (200, 0))
+    np.testing.assert_array_equal(db.search_vector(7), vectors[200])
+
+class SwapTest(DatabaseTestCase):
+  def test_swap_into_replays_the_changes_logged_since_the_rebuild_started(self):
+    vectors = _vectors(20)
+    live = self.database(checkpoint_bytes=0)
+    live.insert_many(range(10), vectors[:10])
+    live.commit()
+    with live.hold_checkpoints():
+      since = live.log_position()
+      # Changes made while the rebuild runs, not checkpointed.
+      live = self.database(checkpoint_bytes=0)
+      live.remove_by_key(1)
+      live.remove_by_key(2)
+      live.insert_many([2, 10], vectors[[12, 10]])
+      live.commit()
+      self.assertEqual(live.generation, since[0])
+      rebuilt = Database(os.path.join(self.directory, "rebuild", "db"), DIM)
+      rebuilt.open()
+      rebuilt.insert_many(range(5), vectors[:5])
+      rebuilt.swap_into(self.path, since=since)
+    live = self.database(read_only=True)
+    self.assertEqual(sorted(live._keys.live_keys.tolist()), [0, 2, 3, 4, 10])
+    np.testing.assert_array_equal(live.search_vector(2), vectors[12])
+    self.assertEqual(os.path.getsize(live.wal_path), 0)
+
+  def test_swap_into_refuses_to_drop_checkpointed_changes(self):
+    live = self.database()
+    since = live.log_position()
+    live.insert_many(range(10), _vectors(10))
+    live.write()
+    rebuilt = Database(os.path.join(self.directory, "rebuild", "db"), DIM)
+    rebuilt.open()
+    with self.assertRaisesRegex(ValueError, "checkpointed"):
+      rebuilt.swap_into(self.path, since=since)
+
+class MappedTest(DatabaseTestCase):
+  def test_read_only_flat_snapshots_are_mapped(self):
+    db = self.database()
+    vectors = _vectors(100)
+    db.insert_many(range(100), vectors)
+    db.write()
+    # The vectors are only stored once, in the payload file.
+    self.assertEqual(set(db.snapshot_files), {"payload"})
+    reader = self.database(read_only=True)
+    self.assertIsInstance(reader._index, indexes.MappedFlatIndex)
+    self.assertIsInstance(reader._index.vectors.base, np.memmap)
+    writer = self.database()
+    np.testing.assert_array_equal(writer.search_vector(42), vectors[42])
+    keys, distances = reader.nearest_many(vectors[:5], 3)
+    expected_keys, expected_distances = db.nearest_many(vectors[:5], 3)
+    self.assertEqual(keys, expected_keys)
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-5)
+    np.testing.assert_array_equal(reader.search_vector(42), vectors[42])
+
+  def test_every_index_type_opens_read_only(self):
+    vectors = _vectors(300)
+    for index_type in indexes.INDEX_TYPES:
+      for storage in indexes.STORAGE_TYPES:
+        with self.subTest(index_type=index_type, storage=storage):
+          shutil.rmtree(self.path, ignore_errors=True)
+          db = self.database(index_type=index_type, storage=storage, promote_at=0)
+          db.insert_many(range(300), vectors)
+          db.write()
+          self.assertEqual(db.index_type, index_type)
+          handle = SharedDatabase(self.path, DIM, index_type=index_type, storage=storage, promote_at=0)
+          self.assertEqual(handle.get().nearest_many(vectors[:3], 1)[0], db.nearest_many(vectors[:3], 1)[0])
+
+class SharedDatabaseTest(DatabaseTestCase):
+  def test_changes_on_disk_are_reloaded_in_the_background(self):
+    vectors = _vectors(20)
+    writer = self.database()
+    writer.insert_many(range(10), vectors[:10])
+    writer.write()
+    handle = get_shared_database(self.path, DIM, check_interval=0)
+    self.assertIs(get_shared_database(self.path, DIM), handle)
+    snapshot = handle.get()
+    self.assertIs(handle.get(), snapshot)
+
+    writer.insert_many(range(10, 20), vectors[10:])
+    writer.commit()
+    # The snapshot being read is kept until the new one is loaded.
+    self.assertNotIn(15, handle.get())
+    deadline = time.monotonic() + 10
+    while handle.get() is snapshot and time.monotonic() < deadline:
+      time.sleep(0.01)
+    self.assertIn(15, handle.get())
+    self.assertEqual(handle.get().nearest(vectors[15]), [15])
+    self.assertNotIn(15, snapshot)
+
+class FilterTest(DatabaseTestCase):
+  def test_selector_is_cached_until_the_items_change(self):
+    db = self.database(num_attributes=1)
+    vectors = _vectors(100)
+    db.insert_many(range(100), vectors)
+    where = filters.AttributeRange(0, high=0.5)
+    selectors = db._selector(where)
+    self.assertIs(db._selector(filters.AttributeRange(0, high=0.5)), selectors)
+    self.assertEqual(selectors[0], np.count_nonzero(vectors[:, 0] <= 0.5))
+    allowed = db.nearest(vectors[0], 100, where=where)
+    db.remove_by_key(allowed[0])
+    self.assertIsNot(db._selector(where), selectors)
+    self.assertNotIn(allowed[0], db.nearest(vectors[0], 100, where=where))
+
+  def test_exclude_is_applied_by_row(self):
+    db = self.database(num_attributes=1)
+    vectors = _vectors(100)
+    db.insert_many(range(100), vectors)
+    keys = db.nearest(vectors[0], 5, where=filters.Exclude([0, 1]) & filters.AttributeRange(0, low=0))
+    self.assertEqual(len(keys), 5)
+    self.assertNotIn(0, keys)
+    self.assertNotIn(1, keys)
+
+  def test_sparse_keys_are_selected_by_batch(self):
+    self.assertIsInstance(indexes.id_selector(np.arange(1000)), faiss.IDSelectorBitmap)
+    self.assertIsInstance(indexes.id_selector(np.asarray([1, 2 ** 40])), faiss.IDSelectorBatch)
+    self.assertIsInstance(indexes.id_selector(np.asarray([5, 10 ** 6])), faiss.IDSelectorBatch)
+
+  def test_short_filtered_ivf_searches_are_widened(self):
+    db = self.database(num_attributes=1, index_type=indexes.IVF_FLAT, promote_at=0,
+                       index_options={"nlist": 16, "nprobe": 1})
+    vectors = _vectors(2000)
+    db.insert_many(range(2000), vectors)
+    db.write()
+    self.assertEqual(db.index_type, indexes.IVF_FLAT)
+    where = filters.AttributeRange(0, high=0.05)
+    expected = np.flatnonzero(vectors[:, 0] <= 0.05)
+    keys, _ = db.nearest_many(vectors[:20], 10, where=where)
+    for row_keys in keys:
+      self.assertEqual(len(row_keys), 10)
+      self.assertTrue(set(row_keys) <= set(expected.tolist()))
+
+  def test_read_only_filtered_search_covers_the_delta(self):
+    db = self.database(num_attributes=1)
+    vectors = _vectors(200)
+    db.insert_many(range(100), vectors[:100])
+    db.write()
+    db.insert_many(range(100, 200), vectors[100:])
+    reader = self.database(read_only=True, num_attributes=1)
+    self.assertIsNotNone(reader._delta)
+    where = filters.Exclude([150])
+    self.assertEqual(reader.nearest(vectors[150], 2, where=where),
+                     db.nearest(vectors[150], 2, where=where))
+    self.assertNotIn(150, reader.nearest(vectors[150], 2, where=where))
+
+  def test_filtered_hnsw_search(self):
+    db = self.database(num_attributes=1, index_type=indexes.HNSW, promote_at=0)
+    vectors = _vectors(500)
+    db.insert_many(range(500), vectors)
+    db.write()
+    self.assertEqual(db.index_type, indexes.HNSW)
+    keys = db.nearest(vectors[0], 5, ef_search=64, where=filters.Exclude([0]))
+    self.assertEqual(len(keys), 5)
+    self.assertNotIn(0, keys)
+
+class StorageTest(DatabaseTestCase):
+  def _recall(self, storage):
+    self.path = os.path.join(self.directory, storage)
+    db = self.database(storage=storage, promote_at=0)
+    vectors = _clustered_vectors(5000)
+    db.insert_many(range(5000), vectors)
+    db.write()
+    queries = _clustered_vectors(100, seed=1)
+    exact = faiss.IndexFlatL2(DIM)
+    exact.add(vectors)
+    _, expected = exact.search(queries, 10)
+    keys, _ = db.nearest_many(queries, 10)
+    recall = np.mean([len(set(found) & set(row.tolist())) / 10
+                      for found, row in zip(keys, expected)])
+    # Past the 8 byte id of every row.
+    size = len(faiss.serialize_index(db._index)) - 8 * len(vectors)
+    self.assertEqual(db.storage, storage)
+    error = np.abs(db.search_vector(7) - vectors[7]).max()
+    return recall, size, error
+
+  def test_quantized_storage_trades_recall_for_memory(self):
+    recall, size, error = self._recall(indexes.FLOAT32)
+    fp16_recall, fp16_size, fp16_error = self._recall(indexes.FP16)
+    sq8_recall, sq8_size, sq8_error = self._recall(indexes.SQ8)
+    self.assertEqual(recall, 1.0)
+    self.assertEqual(error, 0)
+    self.assertGreaterEqual(fp16_recall, 0.99)
+    self.assertGreaterEqual(sq8_recall, 0.9)
+    self.assertLess(fp16_size, 0.51 * size)
+    self.assertLess(sq8_size, 0.26 * size)
+    self.assertLess(fp16_error, 0.01)
+    self.assertLess(sq8_error, 0.05)
+
+class PayloadTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "db.payload")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_round_trip(self):
+    keys = np.asarray([5, 3, 9], dtype=np.int64)
+    attributes = _vectors(3)[:, :2]
+    payload.write_payload(self.path, 4, DIM, keys, [3], attributes)
+    self.assertTrue(payload.is_payload(self.path))
+    for mmap in (False, True):
+      snapshot = payload.read_payload(self.path, mmap=mmap)
+      self.assertEqual((snapshot.generation, snapshot.vector_dim), (4, DIM))
+      np.testing.assert_array_equal(snapshot.keys, keys)
+      np.testing.assert_array_equal(snapshot.order, [1, 0, 2])
+      np.testing.assert_array_equal(snapshot.tombstones, [3])
+      np.testing.assert_array_equal(snapshot.attributes, attributes)
+
+  def test_vectors_round_trip(self):
+    vectors = _vectors(3)
+    payload.write_payload(self.path, 4, DIM, [5, 3, 9], vectors=vectors)
+    for mmap in (False, True):
+      snapshot = payload.read_payload(self.path, mmap=mmap)
+      np.testing.assert_array_equal(snapshot.vectors, vectors)
+    payload.write_payload(self.path, 4, DIM, [5, 3, 9])
+    self.assertIsNone(payload.read_payload(self.path).vectors)
+
+  def test_corruption_is_detected(self):
+    payload.write_payload(self.path, 1, DIM, np.arange(10))
+    with open(self.path, "r+b") as f:
+      f.seek(payload.HEADER_SIZE + 3)
+      f.write(b"\xff")
+    with self.assertRaisesRegex(ValueError, "corrupted"):
+      payload.read_payload(self.path)
+
+  def test_truncation_is_detected(self):
+    payload.write_payload(self.path, 1, DIM, np.arange(10))
+    with open(self.path, "r+b") as f:
+      f.truncate(payload.HEADER_SIZE + 8)
+    with self.assertRaisesRegex(ValueError, "truncated"):
+      payload.read_payload(self.path)
+
+class VectorStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _put_in_other_process(self, keys, vectors):
+    process = multiprocessing.Process(target=_put_vectors, args=(self.directory, keys, vectors))
+    process.start()
+    process.join()
+    self.assertEqual(process.exitcode, 0)
+
+  def test_writes_of_other_processes_are_seen(self):
+    store = VectorStore(self.directory, DIM)
+    vectors = _vectors(3)
+    store.put(1, vectors[0])
+    self._put_in_other_process([1, 2], vectors[1:])
+    matrix, found = store.get_many([1, 2, 3])
+    np.testing.assert_array_equal(found, [True, True, False])
+    np.testing.assert_array_equal(matrix[:2], vectors[1:])
+    np.testing.assert_array_equal(matrix[2], np.zeros(DIM))
+    self.assertEqual(len(store), 2)
+
+  def test_repeated_keys_keep_the_last_vector(self):
+    store = VectorStore(self.directory, DIM)
+    vectors = _vectors(2)
+    store.put_many([4, 4], vectors)
+    np.testing.assert_array_equal(store.get(4), vectors[1])
+    self.assertIsNone(store.get(5))
+
+class EmbeddingCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = embeddings.EmbeddingCache(os.path.join(self.directory, "embeddings.sqlite3"))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _used_at(self, key):
+    return self.cache._connection().execute(
+        "SELECT used_at FROM embeddings WHERE key = ?", (key,)).fetchone()[0]
+
+  def test_uses_are_written_in_batches(self):
+    self.cache.put_many([(b"a", _vectors(1)[0]), (b"b", _vectors(1)[0])])
+    used_at = self._used_at(b"a")
+    with mock.patch.object(self.cache, "_connection") as connection:
+      self.cache.touch([b"a"])
+      connection.assert_not_called()
+    self.cache.put_many([(b"c", _vectors(1)[0])])
+    self.assertGreater(self._used_at(b"a"), used_at)
+
+  def test_eviction_spares_embeddings_used_since_the_last_write(self):
+    self.cache._max_entries = 2
+    self.cache.put_many([(key, _vectors(1)[0]) for key in (b"a", b"b", b"c")])
+    self.cache.touch([b"a"])
+    self.cache.evict()
+    self.assertIsNotNone(self.cache.get(b"a"))
+    self.assertIsNone(self.cache.get(b"b"))
+
+class ChangeQueueTest(unittest.TestCase):
+  def test_pending_changes_are_applied_at_exit(self):
+    script = ("import sys\n"
+              "from mldb.changes import ChangeQueue\n"
+              "def apply(upserts, deletes):\n"
+              "  print(sorted(upserts), deletes)\n"
+              "queue = ChangeQueue(apply, interval=60)\n"
+              "queue.upsert(1, 'one')\n"
+              "queue.delete(2)\n")
+    output = subprocess.run([sys.executable, "-c", script], check=True, stdout=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    self.assertEqual(output.stdout, b"[1] [2]\n")
+
+_full_pipeline = []
+
+def _pipeline(name, disable=()):
+  # A spaCy v2 pipeline shaped like en_core_web_sm (whose tagger sets
+  # `doc.tensor`). Its vocab and components are shared by every
+  # pipeline loaded, as they would be loaded with the same weights.
+  if not _full_pipeline:
+    model = spacy.blank("en")
+    for component, label in (("tagger", "NN"), ("parser", "nsubj"), ("ner", "ORG")):
+      model.add_pipe(model.create_pipe(component))
+      if component == "tagger":
+        model.get_pipe(component).add_label(label, {"pos": "NOUN"})
+      else:
+        model.get_pipe(component).add_label(label)
+    with warnings.catch_warnings():
+      # About the lemmatization data the tagger has no use for here.
+      warnings.simplefilter("ignore")
+      model.begin_training()
+    _full_pipeline.append(model)
+  full = _full_pipeline[0]
+  model = type(full)(vocab=full.vocab)
+  for component, pipe in full.pipeline:
+    if component not in disable:
+      model.add_pipe(pipe, name=component)
+  return model
+
+class RegistryTest(unittest.TestCase):
+  @mock.patch.object(spacy, "load", side_effect=_pipeline)
+  def test_lean_models_only_run_the_tagger_and_embed_the_same(self, load):
+    texts = ["We plant trees in Pune.", "Free coding classes for children of 12 villages."]
+    lean = registry.ModelRegistry().get("pipeline", lean=True)
+    load.assert_called_with("pipeline", disable=registry.LEAN_DISABLE)
+    self.assertEqual(lean.pipe_names, ["tagger"])
+    full = registry.ModelRegistry().get("pipeline")
+    self.assertEqual(full.pipe_names, ["tagger", "parser", "ner"])
+    for text in texts:
+      np.testing.assert_array_equal(lean(text).vector, full(text).vector)
+
+_TEXTS = ["We plant trees in Pune.", "Free coding classes for children of 12 villages.", "",
+          "Clean water for every village, and clean water for every school."]
+
+class BackendTest(unittest.TestCase):
+  def _check(self, backend, dimension):
+    self.assertEqual(backend.dimension, dimension)
+    singles = np.vstack([backend.embed(text) for text in _TEXTS])
+    self.assertEqual(singles.shape, (len(_TEXTS), dimension))
+    self.assertEqual(singles.dtype, np.float32)
+    many = np.vstack(list(backend.embed_many(iter(_TEXTS), batch_size=3)))
+    np.testing.assert_allclose(many, singles, atol=1e-6)
+
+  def test_hashing_backend(self):
+    backend = backends.HashingBackend(dimension=16)
+    self._check(backend, 16)
+    self.assertFalse(backend.embed(_TEXTS[2]).any())
+
+  @mock.patch.object(spacy, "load", side_effect=_pipeline)
+  def test_spacy_backend(self, _):
+    backend = backends.SpacyBackend("backend-pipeline", lean=True)
+    self._check(backend, _pipeline("backend-pipeline")("NA").vector.size)
+
+  def test_vectorizer_dimension(self):
+    vectorizer = Vectorizer(backend=backends.HashingBackend(dimension=16))
+    self.assertEqual(vectorizer.dimension, 16 + Vectorizer.NUM_NUMERIC_FIELDS)
+
+class VectorizeManyTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _rows(self):
+    created_at = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+    rows = [(12.9 + i, 77.5 - i, created_at + datetime.timedelta(days=i), text)
+            for i, text in enumerate(_TEXTS)]
+    # Every kind of row: tuples, dicts and objects with the fields.
+    rows[1] = dict(zip(Vectorizer.FIELDS, rows[1]))
+    rows[2] = collections.namedtuple("Organization", Vectorizer.FIELDS)(*rows[2])
+    return rows
+
+  def _vectorize_many(self, vectorizer, rows):
+    chunks = list(vectorizer.vectorize_many(iter(rows), chunk_size=3, batch_size=2))
+    self.assertEqual([len(chunk_rows) for chunk_rows, _ in chunks], [3, 1])
+    for chunk_rows, matrix in chunks:
+      self.assertEqual(matrix.shape, (len(chunk_rows), vectorizer.dimension))
+      self.assertEqual(matrix.dtype, np.float32)
+      self.assertTrue(matrix.flags.c_contiguous)
+    self.assertEqual(sum((chunk_rows for chunk_rows, _ in chunks), []), rows)
+    return np.vstack([matrix for _, matrix in chunks])
+
+  def test_vectorize_many_matches_vectorize(self):
+    cache = embeddings.EmbeddingCache(os.path.join(self.directory, "embeddings.sqlite3"))
+    vectorizer = Vectorizer(backend=backends.HashingBackend(dimension=16))
+    rows = self._rows()
+    expected = np.vstack([vectorizer.vectorize(*Vectorizer._fields(row)) for row in rows])
+    np.testing.assert_allclose(self._vectorize_many(vectorizer, rows), expected, rtol=1e-6)
+    # Then again, embedding the descriptions through the cache.
+    cached = Vectorizer(backend=backends.HashingBackend(dimension=16), cache=cache)
+    np.testing.assert_allclose(self._vectorize_many(cached, rows), expected, rtol=1e-6)
+    np.testing.assert_allclose(self._vectorize_many(cached, rows), expected, rtol=1e-6)
+
+class ResultCacheTest(unittest.TestCase):
+  def test_concurrent_misses_compute_once(self):
+    cache = ResultCache()
+    calls = []
+
+    def compute():
+      calls.append(1)
+      time.sleep(0.1)
+      return [1, 2]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+      results = list(executor.map(lambda _: cache.get("key", compute), range(8)))
+    self.assertEqual(results, [[1, 2]] * 8)
+    self.assertEqual(len(calls), 1)
+
+  def test_least_recently_used_and_expired_values_are_evicted(self):
+    cache = ResultCache(max_size=2, ttl=60)
+    for key in ("a", "b"):
+      cache.get(key, lambda: key)
+    cache.get("a", lambda: None)
+    cache.get("c", lambda: "c")
+    self.assertEqual(cache.get("a", lambda: "again"), "a")
+    self.assertEqual(cache.get("b", lambda: "again"), "again")
+    expired = ResultCache(ttl=0)
+    expired.get("a", lambda: "a")
+    self.assertEqual(expired.get("a", lambda: "again"), "again")
+
+  def test_errors_are_not_cached(self):
+    cache = ResultCache()
+
+    def fail():
+      raise RuntimeError("search failed")
+
+    with self.assertRaisesRegex(RuntimeError, "search failed"):
+      cache.get("key", fail)
+    self.assertEqual(cache.get("key", lambda: "value"), "value")
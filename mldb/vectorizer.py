@@ -5,8 +5,15 @@
 
   Author: @captain-pool
 """
+import collections
+import itertools
+import time
+
 import numpy as np
-import spacy
+
+import mldb.metrics as metrics
+from mldb.backends import SpacyBackend
+from mldb.embeddings import embedding_key, normalize_text
 
 class Vectorizer:
   """
@@ -19,25 +26,48 @@ class Vectorizer:
   MAX_LAT = 90
   MAX_LONG = 180
   MAX_POSIX = 2147483647
+  FIELDS = ("latitude", "longitude", "created_at", "description")
+  # Positions of the scaled numeric fields in a vector, which precede
+  # the embedding of the description (and are the attributes of the
+  # database, see `mldb.database.Database`).
+  LATITUDE = 0
+  LONGITUDE = 1
+  CREATED_AT = 2
+  NUM_NUMERIC_FIELDS = 3
 
-  def __init__(self, model_name="en_core_web_sm"):
+  def __init__(self, model_name="en_core_web_sm", cache=None, lean=False, backend=None):
     """
       Args:
         model_name (str): Name of spacy model for vectorizing
                           description. If it doesn't work,
                           please download the spacy model first:
                           `$ python -m spacy download <model_name>`
+                          The model is shared through `mldb.registry`,
+                          so it is only loaded once per process.
+        cache (mldb.embeddings.EmbeddingCache): Cache of the embeddings
+                          of descriptions, so that only new or changed
+                          descriptions are run through the model
+        lean (bool): Load the model without the components that do not
+                     contribute to the vectors (see `mldb.registry`),
+                     which vectorizes the same, faster
+        backend (mldb.backends.Backend): Embedder of the descriptions,
+                     instead of the spaCy model `model_name`
       Properties:
         dimension [READ ONLY](float32): dimension of each vector.
     """
-    self._model = spacy.load(model_name)
-    size = self._model("NA").vector.size
-    self._vector_dim = size + 3
+    self._backend = backend or SpacyBackend(model_name, lean)
+    self._vector_dim = self._backend.dimension + Vectorizer.NUM_NUMERIC_FIELDS
+    self._cache = cache
 
   @property
   def dimension(self):
     return self._vector_dim
 
+  @property
+  def backend(self):
+    return self._backend
+
+  @metrics.timed("mldb.vectorizer.vectorize")
   def vectorize(self, latitude, longitude,
                 created_at, description):
     """
@@ -51,13 +81,8 @@ class Vectorizer:
       Returns:
         normalized numpy vector of shape, (1, Vectorizer.dimension)
     """
-    if not description:
-      description = "NA"
     posixtime = created_at.timestamp()
-    string_vector = self._model(description).vector
-
-    norm = np.linalg.norm(string_vector)
-    string_vector /= norm
+    string_vector = self._embed(normalize_text(description))
 
     latitude = np.asarray([latitude], dtype=np.float32)
     longitude = np.asarray([longitude], dtype=np.float32)
@@ -70,3 +95,96 @@ class Vectorizer:
         string_vector]
 
     return np.concatenate(final_vector)[np.newaxis, :]
+
+  def _key(self, text):
+    return embedding_key(self._backend.name, self._backend.version, text)
+
+  def _embed(self, text):
+    key = self._key(text) if self._cache is not None else None
+    if key is not None:
+      string_vector = self._cache.get(key)
+      if string_vector is not None:
+        self._cache.touch([key])
+        metrics.count("mldb.vectorizer.cache_hits")
+        return string_vector
+    with metrics.timer("mldb.vectorizer.model"):
+      string_vector = self._backend.embed(text)
+    norm = np.linalg.norm(string_vector)
+    if norm:
+      string_vector /= norm
+    if key is not None:
+      self._cache.put_many([(key, string_vector)])
+      metrics.count("mldb.vectorizer.cache_misses")
+    return string_vector
+
+  @staticmethod
+  def _fields(row):
+    if isinstance(row, dict):
+      return tuple(row[field] for field in Vectorizer.FIELDS)
+    if isinstance(row, (tuple, list)):
+      return tuple(row)
+    return tuple(getattr(row, field) for field in Vectorizer.FIELDS)
+
+  def vectorize_many(self, rows, chunk_size=1024, batch_size=256, n_process=1):
+    """
+      Vectorizes a stream of Organization entries chunk by chunk.
+      Descriptions are embedded in batches by the backend (`nlp.pipe`,
+      without the components that do not contribute to `doc.vector`,
+      for spaCy), and the numeric columns are scaled for the whole
+      chunk at once. Descriptions whose embedding is cached are not
+      run through the model.
+      Args:
+        rows (iterable): Organizations, dicts or tuples with their
+                         latitude, longitude, created_at and description
+        chunk_size (int): Number of rows per yielded matrix
+        batch_size (int): Batch size of the backend (`nlp.pipe`)
+        n_process (int): Number of processes of the backend
+      Yields:
+        Tuples of a list of rows and a contiguous `np.float32` matrix
+        of shape (len(rows), Vectorizer.dimension), in input order
+    """
+    pending = collections.deque()
+
+    def descriptions():
+      for row in rows:
+        fields = Vectorizer._fields(row)
+        text = normalize_text(fields[3])
+        key = string_vector = None
+        if self._cache is not None:
+          key = self._key(text)
+          string_vector = self._cache.get(key)
+        pending.append((row, fields, key, string_vector))
+        # Cached descriptions are embedded as (cheap) empty texts, so
+        # that the embeddings stay aligned with the rows.
+        yield "" if string_vector is not None else text
+
+    embeddings = self._backend.embed_many(descriptions(), batch_size=batch_size, n_process=n_process)
+    while True:
+      # Timed per chunk, which the (lazy) backend is run for.
+      start = time.perf_counter()
+      chunk_embeddings = list(itertools.islice(embeddings, chunk_size))
+      if not chunk_embeddings:
+        return
+      chunk = [pending.popleft() for _ in chunk_embeddings]
+      matrix = np.empty((len(chunk), self._vector_dim), dtype=np.float32)
+      latitude, longitude, created_at, _ = zip(*(fields for _, fields, _, _ in chunk))
+      matrix[:, Vectorizer.LATITUDE] = np.asarray(latitude, dtype=np.float32) / Vectorizer.MAX_LAT
+      matrix[:, Vectorizer.LONGITUDE] = np.asarray(longitude, dtype=np.float32) / Vectorizer.MAX_LONG
+      matrix[:, Vectorizer.CREATED_AT] = np.asarray([value.timestamp() for value in created_at],
+                                                    dtype=np.float32) / Vectorizer.MAX_POSIX
+      string_vectors = matrix[:, Vectorizer.NUM_NUMERIC_FIELDS:]
+      cached = np.asarray([string_vector is not None for _, _, _, string_vector in chunk])
+      for row, embedding in enumerate(chunk_embeddings):
+        string_vectors[row] = embedding if not cached[row] else chunk[row][3]
+      norms = np.linalg.norm(string_vectors[~cached], axis=1, keepdims=True)
+      # Texts without any feature (for the hashing backend) stay zero.
+      norms[norms == 0] = 1
+      string_vectors[~cached] /= norms
+      if self._cache is not None:
+        self._cache.touch([key for row, (_, _, key, _) in enumerate(chunk) if cached[row]])
+        self._cache.put_many(
+            [(key, string_vectors[row]) for row, (_, _, key, _) in enumerate(chunk) if not cached[row]])
+        metrics.count("mldb.vectorizer.cache_hits", int(np.count_nonzero(cached)))
+        metrics.count("mldb.vectorizer.cache_misses", int(np.count_nonzero(~cached)))
+      metrics.timing("mldb.vectorizer.vectorize_many", time.perf_counter() - start)
+      yield [row for row, _, _, _ in chunk], matrix
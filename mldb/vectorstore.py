@@ -0,0 +1,268 @@
+"""
+  Vector Store Module: `np.float32` vectors by (64 bit) key, such as
+  the preference vectors of users, stored as one contiguous matrix.
+  A store is two files:
+    - `<name>.vectors`: a 64 byte header (format version and dimension)
+      followed by the matrix of the vectors, one per row
+    - `<name>.keys`: the `np.int64` keys, by row
+  Vectors are updated in place, and new ones appended: their row is
+  written before their key, so the size of the keys file is what
+  commits them. Readers memory-map the matrix, so every process on a
+  host shares it and sees updates without reloading anything.
+  Classes:
+    - VectorStore
+"""
+import contextlib
+import fcntl
+import os
+import struct
+import threading
+
+import numpy as np
+
+import mldb.metrics as metrics
+
+MAGIC = b"MLDBVECS"
+VERSION = 1
+# magic, version, dimension
+HEADER = struct.Struct("<8sII")
+HEADER_SIZE = 64
+KEY_SIZE = np.dtype(np.int64).itemsize
+
+def _pwrite(fd, data, offset):
+  view = memoryview(data).cast("B")
+  while view:
+    written = os.pwrite(fd, view, offset)
+    view = view[written:]
+    offset += written
+
+class VectorStore:
+  """
+    Store of `np.float32` vectors of a fixed dimension, by key, read
+    and written in batches (`get_many`, `put_many`, `arrays`).
+    Keys are looked up by bisection of a sorted copy of them, and the
+    ones appended since it was sorted through a small dict, which is
+    folded into it once it holds more than `resort_at` of the keys.
+    Writers, in any process, serialize on an advisory (`flock`) lock;
+    readers never wait. A reader racing an update of a vector may read
+    a mix of its old and new components. Writes are only made durable
+    (fsynced) if the store is opened with `fsync`.
+  """
+  # Minimum number of keys of the dict of appended keys before it is
+  # folded into the sorted keys.
+  MIN_RECENT = 1024
+
+  def __init__(self, path, dimension, name="vectors", resort_at=0.125, fsync=False):
+    """
+      Args:
+        path (str): Path to the folder of the store
+        dimension (int): Dimension of the vectors
+        name (str): Name of the files of the store
+        resort_at (float): Fraction of the keys that may be appended
+                           before the sorted keys are rebuilt
+        fsync (bool): Make writes durable before they return, the
+                      vectors before the keys that commit them
+    """
+    self._keys_path = os.path.join(path, "%s.keys" % name)
+    self._vectors_path = os.path.join(path, "%s.vectors" % name)
+    self._lock_path = os.path.join(path, "%s.lock" % name)
+    self._dimension = dimension
+    self._resort_at = resort_at
+    self._fsync = fsync
+    self._mutex = threading.RLock()
+    self._lock_fd = None
+    self._lock_depth = 0
+    self._count = 0
+    # Keys by row, with room to grow.
+    self._keys = np.empty(0, dtype=np.int64)
+    self._sorted_keys = np.empty(0, dtype=np.int64)
+    self._sorted_rows = np.empty(0, dtype=np.int64)
+    self._recent = dict()
+    self._vectors = np.empty((0, dimension), dtype=np.float32)
+
+  @property
+  def dimension(self):
+    return self._dimension
+
+  def __len__(self):
+    with self._mutex:
+      self.refresh()
+      return self._count
+
+  def __contains__(self, key):
+    return bool(self._found([key])[0])
+
+  @contextlib.contextmanager
+  def lock(self):
+    """
+      Holds an exclusive, advisory (`flock`) lock on the store. Writes
+      take it. It is reentrant.
+    """
+    with self._mutex:
+      if not self._lock_depth:
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+      self._lock_depth += 1
+      try:
+        yield self
+      finally:
+        self._lock_depth -= 1
+        if not self._lock_depth:
+          fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+          os.close(self._lock_fd)
+          self._lock_fd = None
+
+  def _check_header(self):
+    with open(self._vectors_path, "rb") as f:
+      header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+      raise ValueError("%s is not an mldb vector store" % self._vectors_path)
+    magic, version, dimension = HEADER.unpack(header)
+    if magic != MAGIC:
+      raise ValueError("%s is not an mldb vector store" % self._vectors_path)
+    if version > VERSION:
+      raise ValueError("%s is of version %d, only versions up to %d are supported"
+                       % (self._vectors_path, version, VERSION))
+    if dimension != self._dimension:
+      raise ValueError("%s holds vectors of dimension %d, not %d"
+                       % (self._vectors_path, dimension, self._dimension))
+
+  def refresh(self):
+    """
+      Picks up the vectors appended (by any process) since the last
+      refresh. Every read does it.
+    """
+    with self._mutex:
+      try:
+        count = os.path.getsize(self._keys_path) // KEY_SIZE
+      except FileNotFoundError:
+        count = 0
+      if count <= self._count:
+        return
+      if not self._count:
+        self._check_header()
+      with open(self._keys_path, "rb") as f:
+        f.seek(self._count * KEY_SIZE)
+        keys = np.frombuffer(f.read((count - self._count) * KEY_SIZE), dtype=np.int64)
+      if len(self._keys) < count:
+        grown = np.empty(max(count, 2 * len(self._keys)), dtype=np.int64)
+        grown[:self._count] = self._keys[:self._count]
+        self._keys = grown
+      self._keys[self._count:count] = keys
+      if len(self._recent) + len(keys) > max(VectorStore.MIN_RECENT, self._resort_at * count):
+        self._sorted_rows = np.argsort(self._keys[:count], kind="stable")
+        self._sorted_keys = self._keys[self._sorted_rows]
+        self._recent = dict()
+      else:
+        self._recent.update(zip(keys.tolist(), range(self._count, count)))
+      self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                offset=HEADER_SIZE, shape=(count, self._dimension))
+      self._count = count
+
+  def _rows(self, keys):
+    """
+      Returns the rows of `keys`, -1 for the ones not in the store.
+    """
+    rows = np.full(len(keys), -1, dtype=np.int64)
+    if len(self._sorted_keys):
+      positions = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+      found = self._sorted_keys[positions] == keys
+      rows[found] = self._sorted_rows[positions[found]]
+    if self._recent:
+      for position in np.flatnonzero(rows < 0):
+        rows[position] = self._recent.get(int(keys[position]), -1)
+    return rows
+
+  def _found(self, keys):
+    with self._mutex:
+      self.refresh()
+      return self._rows(np.asarray(keys, dtype=np.int64).ravel()) >= 0
+
+  @metrics.timed("mldb.vectorstore.get_many")
+  def get_many(self, keys):
+    """
+      Reads the vectors of `keys`.
+      Args:
+        keys: Sequence of keys
+      Returns:
+        Tuple of a (len(keys), dimension) `np.float32` matrix of the
+        vectors, with zeros for the keys that are not in the store, and
+        a boolean mask of the keys that are
+    """
+    keys = np.asarray(keys, dtype=np.int64).ravel()
+    with self._mutex:
+      self.refresh()
+      rows = self._rows(keys)
+      vectors = self._vectors
+    found = rows >= 0
+    matrix = np.zeros((len(keys), self._dimension), dtype=np.float32)
+    matrix[found] = vectors[rows[found]]
+    return matrix, found
+
+  def get(self, key, default=None):
+    """
+      Returns a copy of the vector of `key`, or `default`.
+    """
+    vectors, found = self.get_many([key])
+    return vectors[0] if found[0] else default
+
+  def arrays(self):
+    """
+      Returns:
+        Tuple of the `np.int64` keys, by row, and of the read-only,
+        memory-mapped (count, dimension) matrix of all the vectors
+    """
+    with self._mutex:
+      self.refresh()
+      return self._keys[:self._count].copy(), self._vectors
+
+  @metrics.timed("mldb.vectorstore.put_many")
+  def put_many(self, keys, vectors):
+    """
+      Writes the vectors of `keys`, replacing the ones already stored.
+      Args:
+        keys: Sequence of keys. For repeated keys, the last vector wins
+        vectors: (len(keys), dimension) matrix of the vectors
+    """
+    keys = np.asarray(keys, dtype=np.int64).ravel()
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(keys), self._dimension)
+    if not len(keys):
+      return
+    _, last = np.unique(keys[::-1], return_index=True)
+    unique = np.sort(len(keys) - 1 - last)
+    keys, vectors = keys[unique], vectors[unique]
+    row_size = self._dimension * vectors.itemsize
+    with self.lock():
+      self.refresh()
+      rows = self._rows(keys)
+      fd = os.open(self._vectors_path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        if not self._count:
+          _pwrite(fd, HEADER.pack(MAGIC, VERSION, self._dimension).ljust(HEADER_SIZE, b"\0"), 0)
+        for position in np.flatnonzero(rows >= 0):
+          _pwrite(fd, vectors[position], HEADER_SIZE + int(rows[position]) * row_size)
+        appended = rows < 0
+        if appended.any():
+          # Past the committed rows, which may be followed by the rows of
+          # a write that was interrupted before its keys were written.
+          _pwrite(fd, vectors[appended], HEADER_SIZE + self._count * row_size)
+        if self._fsync:
+          os.fsync(fd)
+      finally:
+        os.close(fd)
+      if appended.any():
+        fd = os.open(self._keys_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+          _pwrite(fd, keys[appended], self._count * KEY_SIZE)
+          if self._fsync:
+            os.fsync(fd)
+        finally:
+          os.close(fd)
+        self.refresh()
+    metrics.count("mldb.vectorstore.puts", len(keys))
+
+  def put(self, key, vector):
+    """
+      Writes the vector of `key`.
+    """
+    self.put_many([key], np.asarray(vector, dtype=np.float32)[np.newaxis, :])
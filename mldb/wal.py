@@ -0,0 +1,156 @@
+"""
+  Write-Ahead Log Module: Durable, append-only log of database mutations.
+  Classes:
+    - WriteAheadLog
+"""
+import os
+import struct
+import zlib
+
+import numpy as np
+
+class WriteAheadLog:
+  """
+    Append-only log of `insert` and `remove` records.
+    Each record is a fixed header (crc32, operation, key, payload size)
+    followed by the raw `np.float32` vector for inserts. Batches of
+    inserts are logged as `INSERT_MANY` records, whose key is the number
+    of rows and whose payload is the `np.int64` keys followed by the
+    vectors. Records are written with a single `write` on a file opened
+    with `O_APPEND` and made durable in batches by `sync`. A torn or
+    corrupt tail is ignored by `replay`.
+    Once `generation` is set, the log starts with a record naming the
+    generation of the snapshot its other records apply to.
+  """
+  INSERT = 1
+  REMOVE = 2
+  GENERATION = 3
+  INSERT_MANY = 4
+  # Maximum number of rows of an `INSERT_MANY` record.
+  MAX_BATCH_ROWS = 4096
+  HEADER = struct.Struct("<IBqI")
+  # Size of the buffer `replay` reads the log through.
+  READ_SIZE = 1024 * 1024
+
+  def __init__(self, path, sync_every=64):
+    """
+      Args:
+        path (str): Path of the log file
+        sync_every (int): Number of appended records after which the
+                          log is synced to disk without waiting for
+                          an explicit `sync`
+    """
+    self._path = path
+    self._sync_every = sync_every
+    self._fd = None
+    self._pending = 0
+    self.generation = None
+
+  @property
+  def path(self):
+    return self._path
+
+  @property
+  def size(self):
+    try:
+      return os.path.getsize(self._path)
+    except OSError:
+      return 0
+
+  def _record(self, operation, key, payload):
+    body = struct.pack("<BqI", operation, key, len(payload)) + payload
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+  def _write(self, record):
+    if self._fd is None:
+      self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    if self.generation is not None and not os.fstat(self._fd).st_size:
+      record = self._record(WriteAheadLog.GENERATION, self.generation, b"") + record
+    os.write(self._fd, record)
+
+  def _append(self, record):
+    self._write(record)
+    self._pending += 1
+    if self._pending >= self._sync_every:
+      self.sync()
+
+  def append_insert(self, key, vector):
+    payload = np.ascontiguousarray(vector, dtype=np.float32).tobytes()
+    self._append(self._record(WriteAheadLog.INSERT, int(key), payload))
+
+  def append_inserts(self, keys, vectors):
+    """
+      Appends the inserts of a batch of rows, as `INSERT_MANY` records of
+      at most `MAX_BATCH_ROWS` rows (one `write` each), and syncs them
+      once.
+    """
+    keys = np.ascontiguousarray(keys, dtype=np.int64)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if not len(keys):
+      return
+    for start in range(0, len(keys), WriteAheadLog.MAX_BATCH_ROWS):
+      end = min(start + WriteAheadLog.MAX_BATCH_ROWS, len(keys))
+      payload = keys[start:end].tobytes() + vectors[start:end].tobytes()
+      self._write(self._record(WriteAheadLog.INSERT_MANY, end - start, payload))
+    self._pending += 1
+    self.sync()
+
+  def append_remove(self, key):
+    self._append(self._record(WriteAheadLog.REMOVE, int(key), b""))
+
+  def sync(self):
+    """
+      Makes every appended record durable.
+    """
+    if self._fd is not None and self._pending:
+      os.fsync(self._fd)
+    self._pending = 0
+
+  def replay(self):
+    """
+      Reads the log from the start, streaming it through a buffer of
+      `READ_SIZE` bytes, so that replaying it takes no more memory than
+      its largest record.
+      Yields:
+        `(operation, key, vector, offset)` for every valid record (the
+        key of a `GENERATION` record is the generation; those of an
+        `INSERT_MANY` record are an `np.int64` array of keys and a matrix
+        of vectors), `offset` being where the record ends: the log is
+        valid up to the offset of the last record yielded
+    """
+    if not os.path.exists(self._path):
+      return
+    header_size = WriteAheadLog.HEADER.size
+    offset = 0
+    with open(self._path, "rb", buffering=WriteAheadLog.READ_SIZE) as f:
+      while True:
+        header = f.read(header_size)
+        if len(header) < header_size:
+          return
+        crc, operation, key, size = WriteAheadLog.HEADER.unpack(header)
+        payload = f.read(size)
+        if len(payload) < size or zlib.crc32(payload, zlib.crc32(header[4:])) != crc:
+          return
+        vector = None
+        if operation == WriteAheadLog.INSERT:
+          vector = np.frombuffer(payload, dtype=np.float32)
+        elif operation == WriteAheadLog.INSERT_MANY:
+          count = key
+          key = np.frombuffer(payload, dtype=np.int64, count=count)
+          vector = np.frombuffer(payload, dtype=np.float32, offset=8 * count).reshape(count, -1)
+        offset += header_size + size
+        yield operation, key, vector, offset
+
+  def truncate(self, offset=0):
+    """
+      Drops every record after `offset` (all of them by default).
+    """
+    self.sync()
+    if os.path.exists(self._path):
+      os.truncate(self._path, offset)
+
+  def close(self):
+    if self._fd is not None:
+      self.sync()
+      os.close(self._fd)
+      self._fd = None